@@ -1,23 +1,33 @@
+import argparse
 import asyncio
 import atexit
 import base64
+import bisect
+import heapq
+import hmac
 import json
 import logging
+import math
 import os
+import queue
+import random
 import re
 import sqlite3
 import socket
+import sys
 import threading
 import time
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
+from functools import lru_cache, partial
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Protocol, Tuple
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
-from urllib.parse import urlparse
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import parse_qs, parse_qsl, urlparse
 
 import httpx
-from supabase import create_client
 from telegram import (
     BotCommand,
     ForceReply,
@@ -27,7 +37,7 @@ from telegram import (
     Update,
 )
 from telegram.constants import ParseMode
-from telegram.error import BadRequest, NetworkError, TimedOut
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
     Application,
     ApplicationHandlerStop,
@@ -40,6 +50,7 @@ from telegram.ext import (
     filters,
 )
 from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 
 try:
     from dotenv import load_dotenv
@@ -53,6 +64,18 @@ try:
 except Exception:
     pycountry = None
 
+try:
+    import psycopg
+    from psycopg.rows import dict_row
+except Exception:
+    psycopg = None
+    dict_row = None
+
+try:
+    from psycopg_pool import ConnectionPool
+except Exception:
+    ConnectionPool = None
+
 try:
     from telegram import CopyTextButton
 
@@ -67,6 +90,10 @@ API_KEY = os.getenv("TEMPLINE_API_KEY", os.getenv("SMSBOWER_API_KEY", ""))
 BASE_URL = os.getenv("TEMPLINE_BASE_URL", os.getenv("SMSBOWER_BASE_URL", "https://smsbower.app/web/stubs/handler_api.php"))
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "5742928021"))
 POLL_SECONDS = int(os.getenv("POLL_INTERVAL_SECONDS", "4"))
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "16"))
+POLL_MAX_SECONDS = int(os.getenv("POLL_MAX_INTERVAL_SECONDS", "30"))
+POLL_HOT_WINDOW_SECONDS = int(os.getenv("POLL_HOT_WINDOW_SECONDS", "90"))
+POLL_MAX_RPS = float(os.getenv("POLL_MAX_RPS", "20"))
 SEARCH_STATE = 1
 DEPOSIT_AMOUNT_STATE = 2
 DEPOSIT_PROOF_STATE = 3
@@ -75,10 +102,15 @@ PAYMENT_EDIT_STATE = 5
 PROFIT_EDIT_STATE = 6
 PAGE_SIZE = 10
 LOCK_FILE_PATH = os.getenv("BOT_LOCK_FILE", ".templine_bot.lock")
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", ".templine_catalog.json")
+CATALOG_SNAPSHOT_VERSION = 1
 LOCK_HANDLE = None
 CANCEL_LOCK_SECONDS = int(os.getenv("CANCEL_LOCK_SECONDS", "180"))
 MAX_MONITOR_SECONDS = int(os.getenv("MAX_MONITOR_SECONDS", "1500"))
 MIN_DEPOSIT_USD = Decimal(os.getenv("MIN_DEPOSIT_USD", "0.5"))
+SMS_WEBHOOK_SECRET = os.getenv("SMS_WEBHOOK_SECRET", "").strip()
+SMS_WEBHOOK_PATH = os.getenv("SMS_WEBHOOK_PATH", "/sms-webhook").strip() or "/sms-webhook"
+SMS_WEBHOOK_POLL_SECONDS = int(os.getenv("SMS_WEBHOOK_POLL_INTERVAL_SECONDS", "30"))
 
 SUPABASE_URL = os.getenv("SUPABASE_URL", "").strip()
 SUPABASE_DB_PASSWORD = os.getenv("SUPABASE_DB_PASSWORD", "").strip()
@@ -89,9 +121,51 @@ SUPABASE_DB_HOST = os.getenv("SUPABASE_DB_HOST", "").strip()
 SUPABASE_DB_DSN = os.getenv("SUPABASE_DB_DSN", "").strip()
 SUPABASE_DB_SSLMODE = os.getenv("SUPABASE_DB_SSLMODE", "require").strip() or "require"
 SUPABASE_DB_HOSTADDR = os.getenv("SUPABASE_DB_HOSTADDR", "").strip()
+SUPABASE_DB_POOL_MIN = int(os.getenv("SUPABASE_DB_POOL_MIN", "1"))
+SUPABASE_DB_POOL_MAX = int(os.getenv("SUPABASE_DB_POOL_MAX", "10"))
+SUPABASE_DB_POOL_TIMEOUT = float(os.getenv("SUPABASE_DB_POOL_TIMEOUT", "10"))
+SUPABASE_DB_PREPARE = os.getenv("SUPABASE_DB_PREPARE", "1").strip().lower() in {"1", "true", "yes", "on"}
 SUPABASE_FORCE_IPV4 = os.getenv("SUPABASE_FORCE_IPV4", "1").strip().lower() in {"1", "true", "yes", "on"}
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY", "").strip()
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "").strip()
+SUPABASE_HTTP_MAX_CONNECTIONS = int(os.getenv("SUPABASE_HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_SECONDS", "60"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "0").strip() == "1"
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "64"))
+STORAGE_BACKENDS = ("sqlite", "postgres", "postgrest")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgrest").strip().lower() or "postgrest"
+SQLITE_PATH = os.getenv("SQLITE_PATH", "templine_bot.sqlite3").strip() or "templine_bot.sqlite3"
+SQLITE_CACHE_MB = int(os.getenv("SQLITE_CACHE_MB", "16"))
+SQLITE_BATCH_SIZE = max(1, int(os.getenv("SQLITE_BATCH_SIZE", "64")))
+SQLITE_BATCH_WAIT_MS = float(os.getenv("SQLITE_BATCH_WAIT_MS", "2"))
+SQLITE_READERS = max(1, int(os.getenv("SQLITE_READERS", "8")))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "30"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "5000"))
+PRICE_CACHE_TTL_SECONDS = float(os.getenv("PRICE_CACHE_TTL_SECONDS", "20"))
+PRICE_CACHE_SIZE = int(os.getenv("PRICE_CACHE_SIZE", "256"))
+BROADCAST_RPS = float(os.getenv("BROADCAST_RPS", "25"))
+BROADCAST_CONCURRENCY = max(1, int(os.getenv("BROADCAST_CONCURRENCY", "8")))
+BROADCAST_PROGRESS_SECONDS = float(os.getenv("BROADCAST_PROGRESS_SECONDS", "5"))
+BROADCAST_BATCH = 100
+BROADCAST_JOB_KEY = "broadcast_job"
+USER_PAGE_SIZE = max(1, int(os.getenv("USER_PAGE_SIZE", "500")))
+PENDING_PAGE_SIZE = 20
+BROWSE_STATE_TTL_SECONDS = float(os.getenv("BROWSE_STATE_TTL_SECONDS", "1800"))
+BROWSE_STATE_SIZE = int(os.getenv("BROWSE_STATE_SIZE", "20000"))
+PRICE_ACTIONS = ("getPricesV3", "getPricesV2", "getPrices")
+API_MAX_ATTEMPTS = max(1, int(os.getenv("API_MAX_ATTEMPTS", "3")))
+API_RETRY_BUDGET_RPS = float(os.getenv("API_RETRY_BUDGET_RPS", "2"))
+API_BREAKER_FAILURES = max(1, int(os.getenv("API_BREAKER_FAILURES", "3")))
+API_BREAKER_COOLDOWN_SECONDS = float(os.getenv("API_BREAKER_COOLDOWN_SECONDS", "30"))
+API_HEDGE_REQUESTS = os.getenv("API_HEDGE_REQUESTS", "1").strip() == "1"
+API_HEDGE_ACTIONS = {"getStatus", "getBalance", *PRICE_ACTIONS}
+API_MAX_RPS = float(os.getenv("API_MAX_RPS", "30"))
+API_PRIORITY_URGENT, API_PRIORITY_BROWSE, API_PRIORITY_POLL = 0, 1, 2
+API_PRIORITY_NAMES = {API_PRIORITY_URGENT: "urgent", API_PRIORITY_BROWSE: "browse", API_PRIORITY_POLL: "poll"}
+API_ACTION_PRIORITY = {"getNumber": API_PRIORITY_URGENT, "getNumberV2": API_PRIORITY_URGENT, "setStatus": API_PRIORITY_URGENT, "getStatus": API_PRIORITY_POLL}
+PRICE_ACTION_TTL_SECONDS = float(os.getenv("PRICE_ACTION_TTL_SECONDS", "1800"))
 SUPABASE_KEY = (
     SUPABASE_SERVICE_ROLE_KEY
     or os.getenv("SUPABASE_KEY", "").strip()
@@ -236,7 +310,11 @@ TR["en"].update(
         "approve_cancel": "🚫 Cancel",
         "new_user_alert": "🆕 New user request\n👤 {name}\n🆔 {user_id}\n🌐 {user_lang}",
         "broadcast_prompt": "📣 Send the broadcast message now.",
-        "broadcast_done": "✅ Broadcast sent to {ok}/{total}.",
+        "broadcast_done": "✅ Broadcast sent to {ok}/{total}. Failed: {failed}. Unreachable chats pruned: {pruned}.",
+        "broadcast_started": "📣 Broadcast queued. Progress will appear here.",
+        "broadcast_progress": "📣 Broadcasting… {done}/{total} (sent {ok}, failed {failed}, pruned {pruned})",
+        "broadcast_busy": "⏳ A broadcast is already running. Wait for it to finish.",
+        "pending_more": "➡️ More pending users",
         "payment_show": "💳 Payment Settings\n\n{lines}",
         "payment_prompt": "✍️ Send payment settings lines:\n`telegram_username=@name`\n`binance=...`\n`bkash=...`\n`nagad=...`\nYou can add any new key too.",
         "payment_saved": "✅ Payment settings updated.",
@@ -558,10 +636,61 @@ def normalize_country_name(name: str) -> str:
     return s
 
 
+class CountryIndex:
+    def __init__(self):
+        self.exact: Dict[str, str] = {}
+        for c in list(pycountry.countries) if pycountry else []:
+            iso2 = str(getattr(c, "alpha_2", "") or "").upper()
+            if not iso2:
+                continue
+            for attr in ("name", "official_name", "common_name", "alpha_2", "alpha_3"):
+                key = normalize_country_name(str(getattr(c, attr, "") or ""))
+                if key:
+                    self.exact.setdefault(key, iso2)
+        for alias, target in COUNTRY_NAME_ALIASES.items():
+            iso2 = self.exact.get(normalize_country_name(target))
+            if iso2:
+                self.exact[normalize_country_name(alias)] = iso2
+        self.keys = sorted(self.exact)
+
+    def prefix(self, key: str) -> Optional[str]:
+        if len(key) < 4:
+            return None
+        i = bisect.bisect_left(self.keys, key)
+        found: Optional[str] = None
+        while i < len(self.keys) and self.keys[i].startswith(key):
+            iso2 = self.exact[self.keys[i]]
+            if found and iso2 != found:
+                return None
+            found = iso2
+            i += 1
+        return found
+
+    def lookup(self, name: str) -> Optional[str]:
+        key = normalize_country_name(name)
+        if not key:
+            return None
+        return self.exact.get(key) or self.prefix(key) or _fuzzy_country_iso2(key, name)
+
+
+_COUNTRY_INDEX: Optional[CountryIndex] = None
+
+
+def country_index() -> CountryIndex:
+    global _COUNTRY_INDEX
+    if _COUNTRY_INDEX is None:
+        _COUNTRY_INDEX = CountryIndex()
+    return _COUNTRY_INDEX
+
+
 def country_name_to_iso2(name: str) -> Optional[str]:
     if not name:
         return None
-    normalized = normalize_country_name(name)
+    return country_index().lookup(name)
+
+
+@lru_cache(maxsize=2048)
+def _fuzzy_country_iso2(normalized: str, name: str) -> Optional[str]:
     alias_name = COUNTRY_NAME_ALIASES.get(normalized, name)
     if not pycountry:
         return None
@@ -673,11 +802,80 @@ async def safe_reply_markdown(message, text: str, reply_markup=None) -> None:
         await message.reply_text(plain, reply_markup=reply_markup)
 
 
-async def adb(fn, *args, **kwargs):
-    return await asyncio.to_thread(fn, *args, **kwargs)
+async def iter_user_pages(db: Any, page_size: int = USER_PAGE_SIZE, after: Optional[Tuple[int, int]] = None, **filters: Any):
+    while True:
+        rows = await db.list_users_page(after=after, limit=page_size, **filters)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        after = (int(rows[-1].get("created") or 0), int(rows[-1]["user_id"]))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = max(0.1, float(rate))
+        self.capacity = max(1.0, float(burst if burst is not None else rate))
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, n: int = 1) -> int:
+        self._refill()
+        k = max(0, min(int(n), int(self.tokens)))
+        self.tokens -= k
+        return k
+
+
+_HTTP2_OK: Optional[bool] = None
+_SYNC_HTTP: Optional[httpx.Client] = None
+
+
+def http2_enabled() -> bool:
+    global _HTTP2_OK
+    if _HTTP2_OK is None:
+        _HTTP2_OK = False
+        if HTTP2_ENABLED:
+            try:
+                import h2  # noqa: F401
+
+                _HTTP2_OK = True
+            except ImportError:
+                logger.warning("HTTP2_ENABLED=1 but the h2 package is missing; staying on HTTP/1.1")
+    return _HTTP2_OK
+
+
+def http_limits(max_connections: int = HTTP_MAX_CONNECTIONS) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=min(max_connections, HTTP_MAX_KEEPALIVE),
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS,
+    )
+
+
+def sync_http() -> httpx.Client:
+    global _SYNC_HTTP
+    if _SYNC_HTTP is None:
+        _SYNC_HTTP = httpx.Client(limits=http_limits(4), http2=http2_enabled())
+        atexit.register(_SYNC_HTTP.close)
+    return _SYNC_HTTP
+
+
+def telegram_request(pool_size: int, **timeouts: float) -> HTTPXRequest:
+    return HTTPXRequest(
+        connection_pool_size=pool_size,
+        http_version="2" if http2_enabled() else "1.1",
+        httpx_kwargs={"limits": http_limits(pool_size)},
+        **timeouts,
+    )
 
 
-@dataclass
+@dataclass(slots=True)
 class PriceOption:
     service_code: str
     service_name: str
@@ -698,369 +896,239 @@ class PriceOption:
 
 
 class DB:
-    def __init__(self, path: str):
+    def __init__(self, path: str = SQLITE_PATH):
         self.path = path
-        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.readers: List[sqlite3.Connection] = []
+        self.readers_lock = threading.Lock()
+        self.writes: "queue.Queue[Optional[Tuple[Callable[[sqlite3.Connection], Any], Future]]]" = queue.Queue()
+        self.wconn = self._connect()
+        self.writer: Optional[threading.Thread] = None
         self.init()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True, name="sqlite-writer")
+        self.writer.start()
 
-    def conn(self) -> sqlite3.Connection:
-        c = sqlite3.connect(self.path)
+    def _connect(self) -> sqlite3.Connection:
+        c = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
         c.row_factory = sqlite3.Row
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("PRAGMA synchronous=NORMAL")
+        c.execute("PRAGMA busy_timeout=30000")
+        c.execute("PRAGMA temp_store=MEMORY")
+        c.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_MB * 1024}")
+        c.execute(f"PRAGMA mmap_size={SQLITE_CACHE_MB * 4 * 1024 * 1024}")
         return c
 
-    def init(self) -> None:
-        with self.lock:
-            c = self.conn()
-            c.execute(
-                """
-                CREATE TABLE IF NOT EXISTS users(
-                  user_id INTEGER PRIMARY KEY,
-                  chat_id INTEGER,
-                  lang TEXT NOT NULL DEFAULT 'en',
-                  activation_id TEXT,
-                  activation_started_at INTEGER,
-                  service_code TEXT,
-                  country_code TEXT,
-                  provider_id TEXT,
-                  phone TEXT,
-                  polling INTEGER NOT NULL DEFAULT 0,
-                  updated INTEGER NOT NULL DEFAULT (strftime('%s','now'))
-                )
-                """
-            )
-            cols = {r[1] for r in c.execute("PRAGMA table_info(users)").fetchall()}
-            if "activation_started_at" not in cols:
-                c.execute("ALTER TABLE users ADD COLUMN activation_started_at INTEGER")
-            c.execute(
-                """
-                CREATE TABLE IF NOT EXISTS activations(
-                  activation_id TEXT PRIMARY KEY,
-                  user_id INTEGER NOT NULL,
-                  chat_id INTEGER NOT NULL,
-                  service_code TEXT,
-                  country_code TEXT,
-                  provider_id TEXT,
-                  phone TEXT,
-                  status TEXT NOT NULL DEFAULT 'active',
-                  otp_code TEXT,
-                  created_at INTEGER NOT NULL DEFAULT (strftime('%s','now')),
-                  updated_at INTEGER NOT NULL DEFAULT (strftime('%s','now'))
-                )
-                """
-            )
-            c.execute("CREATE INDEX IF NOT EXISTS idx_activations_user_status ON activations(user_id, status)")
-            c.execute(
-                """
-                INSERT INTO activations(
-                  activation_id, user_id, chat_id, service_code, country_code, provider_id, phone, status, otp_code, created_at, updated_at
-                )
-                SELECT
-                  activation_id, user_id, chat_id, service_code, country_code, provider_id, phone, 'active', NULL,
-                  COALESCE(activation_started_at, strftime('%s','now')),
-                  strftime('%s','now')
-                FROM users
-                WHERE polling=1
-                  AND activation_id IS NOT NULL
-                  AND chat_id IS NOT NULL
-                  AND NOT EXISTS (
-                    SELECT 1 FROM activations a WHERE a.activation_id = users.activation_id
-                  )
-                """
-            )
-            c.commit()
-            c.close()
-
-    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
-        with self.lock:
-            c = self.conn()
-            row = c.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
-            c.close()
-            return dict(row) if row else None
+    def conn(self) -> sqlite3.Connection:
+        if threading.current_thread() is self.writer:
+            return self.wconn
+        c = getattr(self.local, "conn", None)
+        if c is None:
+            c = self._connect()
+            c.execute("PRAGMA query_only=ON")
+            self.local.conn = c
+            with self.readers_lock:
+                self.readers.append(c)
+        return c
 
-    def upsert(self, user_id: int, chat_id: int, lang: Optional[str] = None) -> Dict[str, Any]:
-        with self.lock:
-            c = self.conn()
-            row = c.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
-            if row is None:
-                c.execute(
-                    "INSERT INTO users(user_id, chat_id, lang, updated) VALUES (?,?,?,strftime('%s','now'))",
-                    (user_id, chat_id, lang or "en"),
-                )
-            elif lang:
-                c.execute(
-                    "UPDATE users SET chat_id=?, lang=?, updated=strftime('%s','now') WHERE user_id=?",
-                    (chat_id, lang, user_id),
-                )
+    def _write_loop(self) -> None:
+        c = self.wconn
+        while True:
+            item = self.writes.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + SQLITE_BATCH_WAIT_MS / 1000
+            stop = False
+            while len(batch) < SQLITE_BATCH_SIZE:
+                try:
+                    nxt = self.writes.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            results: List[Tuple[Future, Any, Optional[BaseException]]] = []
+            try:
+                c.execute("BEGIN IMMEDIATE")
+                for fn, fut in batch:
+                    c.execute("SAVEPOINT w")
+                    try:
+                        results.append((fut, fn(c), None))
+                        c.execute("RELEASE w")
+                    except Exception as e:
+                        c.execute("ROLLBACK TO w")
+                        c.execute("RELEASE w")
+                        results.append((fut, None, e))
+                c.execute("COMMIT")
+            except Exception as e:
+                if c.in_transaction:
+                    c.execute("ROLLBACK")
+                for _, fut in batch:
+                    fut.set_exception(e)
             else:
-                c.execute(
-                    "UPDATE users SET chat_id=?, updated=strftime('%s','now') WHERE user_id=?",
-                    (chat_id, user_id),
-                )
-            c.commit()
-            out = c.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
-            c.close()
-            return dict(out) if out else {}
+                for fut, res, err in results:
+                    if err is None:
+                        fut.set_result(res)
+                    else:
+                        fut.set_exception(err)
+            if stop:
+                return
 
-    def set_lang(self, user_id: int, chat_id: int, lang: str) -> None:
-        self.upsert(user_id, chat_id, lang)
+    def write(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        if self.writer is None or threading.current_thread() is self.writer:
+            return fn(self.wconn)
+        fut: Future = Future()
+        self.writes.put((fn, fut))
+        return fut.result()
+
+    def close(self) -> None:
+        if self.writer and self.writer.is_alive():
+            self.writes.put(None)
+            self.writer.join(timeout=10)
+        with self.readers_lock:
+            for c in self.readers:
+                c.close()
+            self.readers.clear()
+        self.wconn.close()
+
+    def _one(self, sql: str, args: Tuple[Any, ...] = ()) -> Optional[Dict[str, Any]]:
+        row = self.conn().execute(sql, args).fetchone()
+        return dict(row) if row else None
+
+    def _all(self, sql: str, args: Any = ()) -> List[Dict[str, Any]]:
+        return [dict(r) for r in self.conn().execute(sql, args).fetchall()]
 
-    def set_activation(
-        self,
-        user_id: int,
-        chat_id: int,
-        aid: str,
-        service: str,
-        country: str,
-        provider_id: Optional[str],
-        phone: str,
-    ) -> None:
-        with self.lock:
-            c = self.conn()
-            c.execute(
-                """
-                INSERT INTO users(
-                  user_id, chat_id, lang, activation_id, activation_started_at, service_code, country_code, provider_id, phone, polling, updated
-                )
-                VALUES(?,?,COALESCE((SELECT lang FROM users WHERE user_id=?),'en'),?,strftime('%s','now'),?,?,?,?,1,strftime('%s','now'))
-                ON CONFLICT(user_id) DO UPDATE SET
-                  chat_id=excluded.chat_id,
-                  activation_id=excluded.activation_id,
-                  activation_started_at=strftime('%s','now'),
-                  service_code=excluded.service_code,
-                  country_code=excluded.country_code,
-                  provider_id=excluded.provider_id,
-                  phone=excluded.phone,
-                  polling=1,
-                  updated=strftime('%s','now')
-                """,
-                (user_id, chat_id, user_id, aid, service, country, provider_id, phone),
+    def init(self) -> None:
+        c = self.wconn
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users(
+              user_id INTEGER PRIMARY KEY,
+              chat_id INTEGER,
+              username TEXT,
+              full_name TEXT,
+              lang TEXT NOT NULL DEFAULT 'en',
+              role TEXT NOT NULL DEFAULT 'pending',
+              approval_notified INTEGER NOT NULL DEFAULT 0,
+              approved_by INTEGER,
+              approved_at INTEGER,
+              balance TEXT NOT NULL DEFAULT '0',
+              activation_id TEXT,
+              activation_started_at INTEGER,
+              service_code TEXT,
+              country_code TEXT,
+              provider_id TEXT,
+              phone TEXT,
+              polling INTEGER NOT NULL DEFAULT 0,
+              created INTEGER NOT NULL DEFAULT (strftime('%s','now')),
+              updated INTEGER NOT NULL DEFAULT (strftime('%s','now'))
             )
-            c.commit()
-            c.close()
-
-    def clear_activation(self, user_id: int) -> None:
-        with self.lock:
-            c = self.conn()
-            c.execute(
-                """
-                UPDATE users SET
-                  activation_id=NULL, activation_started_at=NULL, service_code=NULL, country_code=NULL, provider_id=NULL, phone=NULL, polling=0,
-                  updated=strftime('%s','now')
-                WHERE user_id=?
-                """,
-                (user_id,),
+            """
+        )
+        cols = {r[1] for r in c.execute("PRAGMA table_info(users)").fetchall()}
+        for name, ddl in (
+            ("activation_started_at", "INTEGER"),
+            ("username", "TEXT"),
+            ("full_name", "TEXT"),
+            ("role", "TEXT NOT NULL DEFAULT 'pending'"),
+            ("approval_notified", "INTEGER NOT NULL DEFAULT 0"),
+            ("approved_by", "INTEGER"),
+            ("approved_at", "INTEGER"),
+            ("balance", "TEXT NOT NULL DEFAULT '0'"),
+            ("created", "INTEGER NOT NULL DEFAULT 0"),
+        ):
+            if name not in cols:
+                c.execute(f"ALTER TABLE users ADD COLUMN {name} {ddl}")
+        c.execute("UPDATE users SET created=updated WHERE created=0")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users(created, user_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_users_role_created ON users(role, created, user_id)")
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS settings(
+              key TEXT PRIMARY KEY,
+              value TEXT NOT NULL,
+              updated INTEGER NOT NULL DEFAULT (strftime('%s','now'))
             )
-            c.commit()
-            c.close()
-
-    def active_rows(self) -> List[Dict[str, Any]]:
-        with self.lock:
-            c = self.conn()
-            rows = c.execute(
-                "SELECT * FROM users WHERE polling=1 AND activation_id IS NOT NULL AND chat_id IS NOT NULL"
-            ).fetchall()
-            c.close()
-            return [dict(r) for r in rows]
-
-    def add_activation(
-        self,
-        user_id: int,
-        chat_id: int,
-        activation_id: str,
-        service_code: str,
-        country_code: str,
-        provider_id: Optional[str],
-        phone: str,
-    ) -> None:
-        with self.lock:
-            c = self.conn()
-            c.execute(
-                """
-                INSERT INTO activations(
-                  activation_id, user_id, chat_id, service_code, country_code, provider_id, phone, status, otp_code, created_at, updated_at
-                )
-                VALUES(?,?,?,?,?,?,?,'active',NULL,strftime('%s','now'),strftime('%s','now'))
-                ON CONFLICT(activation_id) DO UPDATE SET
-                  user_id=excluded.user_id,
-                  chat_id=excluded.chat_id,
-                  service_code=excluded.service_code,
-                  country_code=excluded.country_code,
-                  provider_id=excluded.provider_id,
-                  phone=excluded.phone,
-                  status='active',
-                  otp_code=NULL,
-                  updated_at=strftime('%s','now')
-                """,
-                (activation_id, user_id, chat_id, service_code, country_code, provider_id, phone),
+            """
+        )
+        c.execute("INSERT OR IGNORE INTO settings(key, value, updated) VALUES('profit_percent', '20', ?)", (now_ts(),))
+        c.execute("INSERT OR IGNORE INTO settings(key, value, updated) VALUES('payment_methods', ?, ?)", (json.dumps({}), now_ts()))
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS activations(
+              activation_id TEXT PRIMARY KEY,
+              user_id INTEGER NOT NULL,
+              chat_id INTEGER NOT NULL,
+              service_code TEXT,
+              country_code TEXT,
+              provider_id TEXT,
+              phone TEXT,
+              status TEXT NOT NULL DEFAULT 'active',
+              otp_code TEXT,
+              base_price TEXT NOT NULL DEFAULT '0',
+              charged_price TEXT NOT NULL DEFAULT '0',
+              refunded INTEGER NOT NULL DEFAULT 0,
+              refund_amount TEXT NOT NULL DEFAULT '0',
+              created_at INTEGER NOT NULL DEFAULT (strftime('%s','now')),
+              updated_at INTEGER NOT NULL DEFAULT (strftime('%s','now'))
             )
-            c.commit()
-            c.close()
-
-    def get_activation(self, activation_id: str) -> Optional[Dict[str, Any]]:
-        with self.lock:
-            c = self.conn()
-            row = c.execute("SELECT * FROM activations WHERE activation_id=?", (activation_id,)).fetchone()
-            c.close()
-            return dict(row) if row else None
-
-    def set_activation_status(self, activation_id: str, status: str, otp_code: Optional[str] = None) -> None:
-        with self.lock:
-            c = self.conn()
-            c.execute(
-                """
-                UPDATE activations
-                SET status=?, otp_code=COALESCE(?, otp_code), updated_at=strftime('%s','now')
-                WHERE activation_id=?
-                """,
-                (status, otp_code, activation_id),
+            """
+        )
+        cols = {r[1] for r in c.execute("PRAGMA table_info(activations)").fetchall()}
+        for name, ddl in (
+            ("base_price", "TEXT NOT NULL DEFAULT '0'"),
+            ("charged_price", "TEXT NOT NULL DEFAULT '0'"),
+            ("refunded", "INTEGER NOT NULL DEFAULT 0"),
+            ("refund_amount", "TEXT NOT NULL DEFAULT '0'"),
+        ):
+            if name not in cols:
+                c.execute(f"ALTER TABLE activations ADD COLUMN {name} {ddl}")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_activations_user_status ON activations(user_id, status)")
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS deposits(
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              user_id INTEGER NOT NULL,
+              amount TEXT NOT NULL,
+              txid TEXT,
+              screenshot_file_id TEXT,
+              status TEXT NOT NULL DEFAULT 'awaiting_proof',
+              reviewed_by INTEGER,
+              reviewed_at INTEGER,
+              note TEXT,
+              created_at INTEGER NOT NULL DEFAULT (strftime('%s','now')),
+              updated_at INTEGER NOT NULL DEFAULT (strftime('%s','now'))
             )
-            if status != "active":
-                c.execute(
-                    "UPDATE users SET polling=0, updated=strftime('%s','now') WHERE activation_id=?",
-                    (activation_id,),
-                )
-            c.commit()
-            c.close()
-
-    def list_active_activations(self) -> List[Dict[str, Any]]:
-        with self.lock:
-            c = self.conn()
-            rows = c.execute("SELECT * FROM activations WHERE status='active'").fetchall()
-            c.close()
-            return [dict(r) for r in rows]
-
-    def latest_active_activation_for_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        with self.lock:
-            c = self.conn()
-            row = c.execute(
-                """
-                SELECT * FROM activations
-                WHERE user_id=? AND status='active'
-                ORDER BY created_at DESC
-                LIMIT 1
-                """,
-                (user_id,),
-            ).fetchone()
-            c.close()
-            return dict(row) if row else None
-
-
-class SupabaseDB:
-    def __init__(self, dsn: str):
-        self.dsn = dsn
-        self.lock = threading.RLock()
-        self.init()
-
-    def conn(self, autocommit: bool = True):
-        return psycopg.connect(self.dsn, autocommit=autocommit)
-
-    def init(self) -> None:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor() as cur:
-                    cur.execute(
-                        """
-                        CREATE TABLE IF NOT EXISTS users(
-                          user_id BIGINT PRIMARY KEY,
-                          chat_id BIGINT,
-                          username TEXT,
-                          full_name TEXT,
-                          lang TEXT NOT NULL DEFAULT 'en',
-                          role TEXT NOT NULL DEFAULT 'pending',
-                          approval_notified BOOLEAN NOT NULL DEFAULT FALSE,
-                          approved_by BIGINT,
-                          approved_at BIGINT,
-                          balance NUMERIC(18,6) NOT NULL DEFAULT 0,
-                          activation_id TEXT,
-                          activation_started_at BIGINT,
-                          service_code TEXT,
-                          country_code TEXT,
-                          provider_id TEXT,
-                          phone TEXT,
-                          polling INTEGER NOT NULL DEFAULT 0,
-                          created BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT,
-                          updated BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT
-                        )
-                        """
-                    )
-                    cur.execute(
-                        """
-                        CREATE TABLE IF NOT EXISTS settings(
-                          key TEXT PRIMARY KEY,
-                          value TEXT NOT NULL,
-                          updated BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT
-                        )
-                        """
-                    )
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)")
-                    cur.execute(
-                        """
-                        INSERT INTO settings(key, value, updated)
-                        VALUES('profit_percent', '20', %s)
-                        ON CONFLICT (key) DO NOTHING
-                        """,
-                        (now_ts(),),
-                    )
-                    cur.execute(
-                        """
-                        INSERT INTO settings(key, value, updated)
-                        VALUES('payment_methods', %s, %s)
-                        ON CONFLICT (key) DO NOTHING
-                        """,
-                        (json.dumps({}), now_ts()),
-                    )
-
-                    cur.execute(
-                        """
-                        CREATE TABLE IF NOT EXISTS activations(
-                          activation_id TEXT PRIMARY KEY,
-                          user_id BIGINT NOT NULL,
-                          chat_id BIGINT NOT NULL,
-                          service_code TEXT,
-                          country_code TEXT,
-                          provider_id TEXT,
-                          phone TEXT,
-                          status TEXT NOT NULL DEFAULT 'active',
-                          otp_code TEXT,
-                          base_price NUMERIC(18,6) NOT NULL DEFAULT 0,
-                          charged_price NUMERIC(18,6) NOT NULL DEFAULT 0,
-                          refunded BOOLEAN NOT NULL DEFAULT FALSE,
-                          refund_amount NUMERIC(18,6) NOT NULL DEFAULT 0,
-                          created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT,
-                          updated_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT
-                        )
-                        """
-                    )
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_activations_user_status ON activations(user_id, status)")
-
-                    cur.execute(
-                        """
-                        CREATE TABLE IF NOT EXISTS deposits(
-                          id BIGSERIAL PRIMARY KEY,
-                          user_id BIGINT NOT NULL,
-                          amount NUMERIC(18,6) NOT NULL,
-                          txid TEXT,
-                          screenshot_file_id TEXT,
-                          status TEXT NOT NULL DEFAULT 'awaiting_proof',
-                          reviewed_by BIGINT,
-                          reviewed_at BIGINT,
-                          note TEXT,
-                          created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT,
-                          updated_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT
-                        )
-                        """
-                    )
-                    cur.execute("CREATE INDEX IF NOT EXISTS idx_deposits_status ON deposits(status)")
-
+            """
+        )
+        c.execute("CREATE INDEX IF NOT EXISTS idx_deposits_status ON deposits(status)")
+        c.execute(
+            """
+            INSERT INTO activations(
+              activation_id, user_id, chat_id, service_code, country_code, provider_id, phone, status, otp_code, created_at, updated_at
+            )
+            SELECT
+              activation_id, user_id, chat_id, service_code, country_code, provider_id, phone, 'active', NULL,
+              COALESCE(activation_started_at, strftime('%s','now')),
+              strftime('%s','now')
+            FROM users
+            WHERE polling=1
+              AND activation_id IS NOT NULL
+              AND chat_id IS NOT NULL
+              AND NOT EXISTS (
+                SELECT 1 FROM activations a WHERE a.activation_id = users.activation_id
+              )
+            """
+        )
         self.ensure_admin_user(ADMIN_USER_ID)
+        c.execute("COMMIT")
 
     def get(self, user_id: int) -> Optional[Dict[str, Any]]:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    cur.execute("SELECT * FROM users WHERE user_id=%s", (user_id,))
-                    row = cur.fetchone()
-                    return dict(row) if row else None
+        return self._one("SELECT * FROM users WHERE user_id=?", (user_id,))
 
     def upsert(
         self,
@@ -1071,151 +1139,116 @@ class SupabaseDB:
         username: Optional[str] = None,
         full_name: Optional[str] = None,
     ) -> Dict[str, Any]:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    cur.execute("SELECT * FROM users WHERE user_id=%s", (user_id,))
-                    row = cur.fetchone()
-                    ts = now_ts()
-                    if row is None:
-                        cur.execute(
-                            """
-                            INSERT INTO users(user_id, chat_id, username, full_name, lang, role, created, updated)
-                            VALUES(%s,%s,%s,%s,%s,%s,%s,%s)
-                            """,
-                            (user_id, chat_id, username, full_name, lang or "en", role or ROLE_PENDING, ts, ts),
-                        )
-                    else:
-                        cur.execute(
-                            """
-                            UPDATE users
-                            SET chat_id=%s,
-                                username=%s,
-                                full_name=%s,
-                                lang=COALESCE(%s, lang),
-                                role=COALESCE(%s, role),
-                                updated=%s
-                            WHERE user_id=%s
-                            """,
-                            (
-                                chat_id,
-                                username if username is not None else row.get("username"),
-                                full_name if full_name is not None else row.get("full_name"),
-                                lang,
-                                role,
-                                ts,
-                                user_id,
-                            ),
-                        )
-                    cur.execute("SELECT * FROM users WHERE user_id=%s", (user_id,))
-                    out = cur.fetchone()
-                    return dict(out) if out else {}
+        def run(c: sqlite3.Connection) -> Dict[str, Any]:
+            ts = now_ts()
+            c.execute(
+                """
+                INSERT INTO users(user_id, chat_id, username, full_name, lang, role, created, updated)
+                VALUES(?,?,?,?,?,?,?,?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                  chat_id=excluded.chat_id,
+                  username=COALESCE(?, username),
+                  full_name=COALESCE(?, full_name),
+                  lang=COALESCE(?, lang),
+                  role=COALESCE(?, role),
+                  updated=excluded.updated
+                """,
+                (user_id, chat_id, username, full_name, lang or "en", role or ROLE_PENDING, ts, ts, username, full_name, lang, role),
+            )
+            row = c.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
+            return dict(row) if row else {}
+
+        return self.write(run)
 
     def set_lang(self, user_id: int, chat_id: int, lang: str) -> None:
         self.upsert(user_id, chat_id, lang=lang)
 
     def ensure_admin_user(self, user_id: int) -> None:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    ts = now_ts()
-                    cur.execute("SELECT * FROM users WHERE user_id=%s", (user_id,))
-                    row = cur.fetchone()
-                    if row is None:
-                        cur.execute(
-                            """
-                            INSERT INTO users(user_id, chat_id, lang, role, approval_notified, approved_by, approved_at, created, updated)
-                            VALUES(%s,%s,'en',%s,TRUE,%s,%s,%s,%s)
-                            """,
-                            (user_id, user_id, ROLE_ADMIN, user_id, ts, ts, ts),
-                        )
-                    else:
-                        cur.execute(
-                            """
-                            UPDATE users
-                            SET role=%s, approval_notified=TRUE, approved_by=%s, approved_at=COALESCE(approved_at,%s), updated=%s
-                            WHERE user_id=%s
-                            """,
-                            (ROLE_ADMIN, user_id, ts, ts, user_id),
-                        )
+        def run(c: sqlite3.Connection) -> None:
+            ts = now_ts()
+            c.execute(
+                """
+                INSERT INTO users(user_id, chat_id, lang, role, approval_notified, approved_by, approved_at, created, updated)
+                VALUES(?,?,'en',?,1,?,?,?,?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                  role=excluded.role, approval_notified=1, approved_by=excluded.approved_by,
+                  approved_at=COALESCE(approved_at, excluded.approved_at), updated=excluded.updated
+                """,
+                (user_id, user_id, ROLE_ADMIN, user_id, ts, ts, ts),
+            )
+
+        self.write(run)
+
+    def _exec(self, sql: str, args: Any = ()) -> int:
+        return self.write(lambda c: c.execute(sql, args).rowcount)
 
     def mark_approval_notified(self, user_id: int) -> None:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor() as cur:
-                    cur.execute("UPDATE users SET approval_notified=TRUE, updated=%s WHERE user_id=%s", (now_ts(), user_id))
+        self._exec("UPDATE users SET approval_notified=1, updated=? WHERE user_id=?", (now_ts(), user_id))
 
-    def set_role(self, user_id: int, role: str, approved_by: Optional[int] = None) -> None:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor() as cur:
-                    ts = now_ts()
-                    cur.execute(
-                        """
-                        UPDATE users
-                        SET role=%s,
-                            approval_notified=TRUE,
-                            approved_by=COALESCE(%s, approved_by),
-                            approved_at=CASE WHEN %s IN ('admin','user','super_user') THEN %s ELSE approved_at END,
-                            updated=%s
-                        WHERE user_id=%s
-                        """,
-                        (role, approved_by, role, ts, ts, user_id),
-                    )
+    def clear_chat(self, user_id: int) -> None:
+        self._exec("UPDATE users SET chat_id=NULL, updated=? WHERE user_id=?", (now_ts(), user_id))
 
-    def list_pending_users(self) -> List[Dict[str, Any]]:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    cur.execute("SELECT * FROM users WHERE role=%s ORDER BY created ASC LIMIT 200", (ROLE_PENDING,))
-                    return [dict(r) for r in cur.fetchall()]
+    def set_role(self, user_id: int, role: str, approved_by: Optional[int] = None) -> None:
+        ts = now_ts()
+        self._exec(
+            """
+            UPDATE users
+            SET role=?,
+                approval_notified=1,
+                approved_by=COALESCE(?, approved_by),
+                approved_at=CASE WHEN ? IN ('admin','user','super_user') THEN ? ELSE approved_at END,
+                updated=?
+            WHERE user_id=?
+            """,
+            (role, approved_by, role, ts, ts, user_id),
+        )
 
-    def list_all_users(self, include_blocked: bool = True) -> List[Dict[str, Any]]:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    if include_blocked:
-                        cur.execute("SELECT * FROM users ORDER BY created ASC")
-                    else:
-                        cur.execute("SELECT * FROM users WHERE role<>%s ORDER BY created ASC", (ROLE_BLOCKED,))
-                    return [dict(r) for r in cur.fetchall()]
+    def list_users_page(
+        self,
+        after: Optional[Tuple[int, int]] = None,
+        limit: int = USER_PAGE_SIZE,
+        role: Optional[str] = None,
+        exclude_role: Optional[str] = None,
+        columns: str = "*",
+    ) -> List[Dict[str, Any]]:
+        where: List[str] = []
+        args: List[Any] = []
+        if after:
+            where.append("(created, user_id) > (?, ?)")
+            args += [int(after[0]), int(after[1])]
+        if role:
+            where.append("role=?")
+            args.append(role)
+        if exclude_role:
+            where.append("role<>?")
+            args.append(exclude_role)
+        sql = f"SELECT {columns} FROM users"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created ASC, user_id ASC LIMIT ?"
+        args.append(int(limit))
+        return self._all(sql, args)
 
     def user_stats(self) -> Dict[str, int]:
         out = {"total": 0, "pending": 0, "user": 0, "super_user": 0, "admin": 0, "blocked": 0}
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    cur.execute("SELECT role, COUNT(*) AS c FROM users GROUP BY role")
-                    rows = cur.fetchall()
-                    total = 0
-                    for r in rows:
-                        role = str(r.get("role") or ROLE_PENDING)
-                        cnt = int(r.get("c") or 0)
-                        out[role] = cnt
-                        total += cnt
-                    out["total"] = total
+        for r in self._all("SELECT role, COUNT(*) AS c FROM users GROUP BY role"):
+            out[str(r.get("role") or ROLE_PENDING)] = int(r.get("c") or 0)
+            out["total"] += int(r.get("c") or 0)
         return out
 
     def get_setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor() as cur:
-                    cur.execute("SELECT value FROM settings WHERE key=%s", (key,))
-                    row = cur.fetchone()
-                    return row[0] if row else default
+        row = self._one("SELECT value FROM settings WHERE key=?", (key,))
+        return row["value"] if row else default
 
     def set_setting(self, key: str, value: str) -> None:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor() as cur:
-                    cur.execute(
-                        """
-                        INSERT INTO settings(key, value, updated)
-                        VALUES(%s,%s,%s)
-                        ON CONFLICT(key) DO UPDATE SET value=EXCLUDED.value, updated=EXCLUDED.updated
-                        """,
-                        (key, value, now_ts()),
-                    )
+        self._exec(
+            """
+            INSERT INTO settings(key, value, updated)
+            VALUES(?,?,?)
+            ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated=excluded.updated
+            """,
+            (key, value, now_ts()),
+        )
 
     def get_profit_percent(self) -> Decimal:
         raw = self.get_setting("profit_percent", "20")
@@ -1236,41 +1269,31 @@ class SupabaseDB:
         return {}
 
     def update_payment_settings(self, items: Dict[str, str]) -> Dict[str, str]:
-        cur = self.get_payment_settings()
-        for k, v in items.items():
-            kk = str(k or "").strip().lower()
-            if not kk:
-                continue
-            cur[kk] = str(v or "").strip()
-        self.set_setting("payment_methods", json.dumps(cur, ensure_ascii=False))
-        return cur
+        def run(c: sqlite3.Connection) -> Dict[str, str]:
+            cur = self.get_payment_settings()
+            for k, v in items.items():
+                kk = str(k or "").strip().lower()
+                if not kk:
+                    continue
+                cur[kk] = str(v or "").strip()
+            self.set_setting("payment_methods", json.dumps(cur, ensure_ascii=False))
+            return cur
+
+        return self.write(run)
+
+    @staticmethod
+    def _credit(c: sqlite3.Connection, user_id: int, delta: Decimal, require_non_negative: bool = False) -> Optional[Decimal]:
+        row = c.execute("SELECT balance FROM users WHERE user_id=?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        bal = dec(row[0]) + dec(delta)
+        if require_non_negative and bal < 0:
+            return None
+        c.execute("UPDATE users SET balance=?, updated=? WHERE user_id=?", (format(bal, "f"), now_ts(), user_id))
+        return bal
 
     def adjust_balance(self, user_id: int, delta: Decimal, require_non_negative: bool = False) -> Optional[Decimal]:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor() as cur:
-                    if require_non_negative:
-                        cur.execute(
-                            """
-                            UPDATE users
-                            SET balance=balance+%s, updated=%s
-                            WHERE user_id=%s AND balance+%s >= 0
-                            RETURNING balance
-                            """,
-                            (dec(delta), now_ts(), user_id, dec(delta)),
-                        )
-                    else:
-                        cur.execute(
-                            """
-                            UPDATE users
-                            SET balance=balance+%s, updated=%s
-                            WHERE user_id=%s
-                            RETURNING balance
-                            """,
-                            (dec(delta), now_ts(), user_id),
-                        )
-                    row = cur.fetchone()
-                    return dec(row[0]) if row else None
+        return self.write(lambda c: self._credit(c, user_id, delta, require_non_negative))
 
     def get_balance(self, user_id: int) -> Decimal:
         row = self.get(user_id) or {}
@@ -1286,47 +1309,30 @@ class SupabaseDB:
         provider_id: Optional[str],
         phone: str,
     ) -> None:
-        with self.lock:
-            ts = now_ts()
-            with self.conn() as c:
-                with c.cursor() as cur:
-                    cur.execute(
-                        """
-                        UPDATE users
-                        SET chat_id=%s,
-                            activation_id=%s,
-                            activation_started_at=%s,
-                            service_code=%s,
-                            country_code=%s,
-                            provider_id=%s,
-                            phone=%s,
-                            polling=1,
-                            updated=%s
-                        WHERE user_id=%s
-                        """,
-                        (chat_id, aid, ts, service, country, provider_id, phone, ts, user_id),
-                    )
+        ts = now_ts()
+        self._exec(
+            """
+            UPDATE users
+            SET chat_id=?, activation_id=?, activation_started_at=?, service_code=?, country_code=?, provider_id=?, phone=?,
+                polling=1, updated=?
+            WHERE user_id=?
+            """,
+            (chat_id, aid, ts, service, country, provider_id, phone, ts, user_id),
+        )
 
     def clear_activation(self, user_id: int) -> None:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor() as cur:
-                    cur.execute(
-                        """
-                        UPDATE users SET
-                          activation_id=NULL, activation_started_at=NULL, service_code=NULL, country_code=NULL, provider_id=NULL, phone=NULL, polling=0,
-                          updated=%s
-                        WHERE user_id=%s
-                        """,
-                        (now_ts(), user_id),
-                    )
+        self._exec(
+            """
+            UPDATE users SET
+              activation_id=NULL, activation_started_at=NULL, service_code=NULL, country_code=NULL, provider_id=NULL, phone=NULL, polling=0,
+              updated=?
+            WHERE user_id=?
+            """,
+            (now_ts(), user_id),
+        )
 
     def active_rows(self) -> List[Dict[str, Any]]:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    cur.execute("SELECT * FROM users WHERE polling=1 AND activation_id IS NOT NULL AND chat_id IS NOT NULL")
-                    return [dict(r) for r in cur.fetchall()]
+        return self._all("SELECT * FROM users WHERE polling=1 AND activation_id IS NOT NULL AND chat_id IS NOT NULL")
 
     def add_activation(
         self,
@@ -1340,205 +1346,793 @@ class SupabaseDB:
         base_price: Any = 0,
         charged_price: Any = 0,
     ) -> None:
-        with self.lock:
+        ts = now_ts()
+        self._exec(
+            """
+            INSERT INTO activations(
+              activation_id, user_id, chat_id, service_code, country_code, provider_id, phone, status, otp_code,
+              base_price, charged_price, refunded, refund_amount, created_at, updated_at
+            )
+            VALUES(?,?,?,?,?,?,?,'active',NULL,?,?,0,'0',?,?)
+            ON CONFLICT(activation_id) DO UPDATE SET
+              user_id=excluded.user_id,
+              chat_id=excluded.chat_id,
+              service_code=excluded.service_code,
+              country_code=excluded.country_code,
+              provider_id=excluded.provider_id,
+              phone=excluded.phone,
+              status='active',
+              otp_code=NULL,
+              base_price=excluded.base_price,
+              charged_price=excluded.charged_price,
+              refunded=0,
+              refund_amount='0',
+              updated_at=excluded.updated_at
+            """,
+            (
+                activation_id,
+                user_id,
+                chat_id,
+                service_code,
+                country_code,
+                provider_id,
+                phone,
+                format(dec(base_price), "f"),
+                format(dec(charged_price), "f"),
+                ts,
+                ts,
+            ),
+        )
+
+    def get_activation(self, activation_id: str) -> Optional[Dict[str, Any]]:
+        return self._one("SELECT * FROM activations WHERE activation_id=?", (activation_id,))
+
+    def get_activations(self, activation_ids: List[str]) -> List[Dict[str, Any]]:
+        ids = [str(x) for x in activation_ids]
+        if not ids:
+            return []
+        marks = ",".join("?" for _ in ids)
+        return self._all(f"SELECT * FROM activations WHERE activation_id IN ({marks})", ids)
+
+    def set_activation_status(self, activation_id: str, status: str, otp_code: Optional[str] = None) -> None:
+        def run(c: sqlite3.Connection) -> None:
+            ts = now_ts()
+            c.execute(
+                "UPDATE activations SET status=?, otp_code=COALESCE(?, otp_code), updated_at=? WHERE activation_id=?",
+                (status, otp_code, ts, activation_id),
+            )
+            if status != "active":
+                c.execute("UPDATE users SET polling=0, updated=? WHERE activation_id=?", (ts, activation_id))
+
+        self.write(run)
+
+    def list_active_activations(self) -> List[Dict[str, Any]]:
+        return self._all("SELECT * FROM activations WHERE status='active'")
+
+    def expire_activations(self, activation_ids: List[str]) -> List[Dict[str, Any]]:
+        ids = [str(x) for x in activation_ids]
+        if not ids:
+            return []
+
+        def run(c: sqlite3.Connection) -> List[Dict[str, Any]]:
+            ts = now_ts()
+            marks = ",".join("?" for _ in ids)
+            rows = [
+                dict(r, status="expired", updated_at=ts)
+                for r in c.execute(f"SELECT * FROM activations WHERE status='active' AND activation_id IN ({marks})", ids).fetchall()
+            ]
+            hit = [r["activation_id"] for r in rows]
+            if hit:
+                marks = ",".join("?" for _ in hit)
+                c.execute(f"UPDATE activations SET status='expired', updated_at=? WHERE activation_id IN ({marks})", [ts, *hit])
+                c.execute(f"UPDATE users SET polling=0, updated=? WHERE activation_id IN ({marks})", [ts, *hit])
+            return rows
+
+        return self.write(run)
+
+    def latest_active_activation_for_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._one(
+            """
+            SELECT * FROM activations
+            WHERE user_id=? AND status='active'
+            ORDER BY created_at DESC
+            LIMIT 1
+            """,
+            (user_id,),
+        )
+
+    def refund_activation_if_needed(self, activation_id: str) -> Optional[Dict[str, Any]]:
+        def run(c: sqlite3.Connection) -> Optional[Dict[str, Any]]:
+            act = c.execute("SELECT * FROM activations WHERE activation_id=?", (activation_id,)).fetchone()
+            if not act:
+                return None
+            charged = dec(act["charged_price"])
+            if bool(act["refunded"]) or charged <= 0:
+                return None
+            uid = int(act["user_id"])
+            c.execute(
+                "UPDATE activations SET refunded=1, refund_amount=?, updated_at=? WHERE activation_id=?",
+                (format(charged, "f"), now_ts(), activation_id),
+            )
+            self._credit(c, uid, charged)
+            return {"user_id": uid, "amount": money(charged)}
+
+        return self.write(run)
+
+    def create_deposit(self, user_id: int, amount: Decimal) -> int:
+        ts = now_ts()
+        return self.write(
+            lambda c: c.execute(
+                "INSERT INTO deposits(user_id, amount, status, created_at, updated_at) VALUES(?,?,'awaiting_proof',?,?)",
+                (user_id, format(dec(amount), "f"), ts, ts),
+            ).lastrowid
+        )
+
+    def set_deposit_proof(self, deposit_id: int, txid: str, screenshot_file_id: str) -> None:
+        self._exec(
+            "UPDATE deposits SET txid=?, screenshot_file_id=?, status='pending', updated_at=? WHERE id=?",
+            (txid, screenshot_file_id, now_ts(), deposit_id),
+        )
+
+    def get_deposit(self, deposit_id: int) -> Optional[Dict[str, Any]]:
+        return self._one("SELECT * FROM deposits WHERE id=?", (deposit_id,))
+
+    def latest_open_deposit_for_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._one(
+            """
+            SELECT * FROM deposits
+            WHERE user_id=? AND status='awaiting_proof'
+            ORDER BY created_at DESC
+            LIMIT 1
+            """,
+            (user_id,),
+        )
+
+    def update_deposit_status(self, deposit_id: int, status: str, reviewed_by: int, note: Optional[str] = None) -> bool:
+        def run(c: sqlite3.Connection) -> bool:
+            dep = c.execute("SELECT * FROM deposits WHERE id=?", (deposit_id,)).fetchone()
+            if not dep or str(dep["status"]) not in {"pending", "awaiting_proof"}:
+                return False
             ts = now_ts()
-            with self.conn() as c:
-                with c.cursor() as cur:
+            c.execute(
+                "UPDATE deposits SET status=?, reviewed_by=?, reviewed_at=?, note=?, updated_at=? WHERE id=?",
+                (status, reviewed_by, ts, note, ts, deposit_id),
+            )
+            if status == "approved":
+                self._credit(c, int(dep["user_id"]), dec(dep["amount"]))
+            return True
+
+        return self.write(run)
+
+
+class SupabaseDB:
+    def __init__(self, dsn: str):
+        if psycopg is None or ConnectionPool is None:
+            raise SystemExit("psycopg[binary,pool] is required for the direct Postgres backend")
+        self.dsn = dsn
+        self.pool = ConnectionPool(
+            dsn,
+            min_size=max(1, SUPABASE_DB_POOL_MIN),
+            max_size=max(SUPABASE_DB_POOL_MIN, SUPABASE_DB_POOL_MAX, 1),
+            timeout=SUPABASE_DB_POOL_TIMEOUT,
+            kwargs={"autocommit": True, "prepare_threshold": 5 if SUPABASE_DB_PREPARE else None},
+            check=ConnectionPool.check_connection,
+            name="supabase-db",
+            open=True,
+        )
+        self.init()
+
+    def conn(self):
+        return self.pool.connection()
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def init(self) -> None:
+        with self.conn() as c:
+            with c.cursor() as cur:
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS users(
+                      user_id BIGINT PRIMARY KEY,
+                      chat_id BIGINT,
+                      username TEXT,
+                      full_name TEXT,
+                      lang TEXT NOT NULL DEFAULT 'en',
+                      role TEXT NOT NULL DEFAULT 'pending',
+                      approval_notified BOOLEAN NOT NULL DEFAULT FALSE,
+                      approved_by BIGINT,
+                      approved_at BIGINT,
+                      balance NUMERIC(18,6) NOT NULL DEFAULT 0,
+                      activation_id TEXT,
+                      activation_started_at BIGINT,
+                      service_code TEXT,
+                      country_code TEXT,
+                      provider_id TEXT,
+                      phone TEXT,
+                      polling INTEGER NOT NULL DEFAULT 0,
+                      created BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT,
+                      updated BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT
+                    )
+                    """
+                )
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS settings(
+                      key TEXT PRIMARY KEY,
+                      value TEXT NOT NULL,
+                      updated BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT
+                    )
+                    """
+                )
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)")
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users(created, user_id)")
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_users_role_created ON users(role, created, user_id)")
+                cur.execute(
+                    """
+                    INSERT INTO settings(key, value, updated)
+                    VALUES('profit_percent', '20', %s)
+                    ON CONFLICT (key) DO NOTHING
+                    """,
+                    (now_ts(),),
+                )
+                cur.execute(
+                    """
+                    INSERT INTO settings(key, value, updated)
+                    VALUES('payment_methods', %s, %s)
+                    ON CONFLICT (key) DO NOTHING
+                    """,
+                    (json.dumps({}), now_ts()),
+                )
+
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS activations(
+                      activation_id TEXT PRIMARY KEY,
+                      user_id BIGINT NOT NULL,
+                      chat_id BIGINT NOT NULL,
+                      service_code TEXT,
+                      country_code TEXT,
+                      provider_id TEXT,
+                      phone TEXT,
+                      status TEXT NOT NULL DEFAULT 'active',
+                      otp_code TEXT,
+                      base_price NUMERIC(18,6) NOT NULL DEFAULT 0,
+                      charged_price NUMERIC(18,6) NOT NULL DEFAULT 0,
+                      refunded BOOLEAN NOT NULL DEFAULT FALSE,
+                      refund_amount NUMERIC(18,6) NOT NULL DEFAULT 0,
+                      created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT,
+                      updated_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT
+                    )
+                    """
+                )
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_activations_user_status ON activations(user_id, status)")
+
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS deposits(
+                      id BIGSERIAL PRIMARY KEY,
+                      user_id BIGINT NOT NULL,
+                      amount NUMERIC(18,6) NOT NULL,
+                      txid TEXT,
+                      screenshot_file_id TEXT,
+                      status TEXT NOT NULL DEFAULT 'awaiting_proof',
+                      reviewed_by BIGINT,
+                      reviewed_at BIGINT,
+                      note TEXT,
+                      created_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT,
+                      updated_at BIGINT NOT NULL DEFAULT EXTRACT(EPOCH FROM now())::BIGINT
+                    )
+                    """
+                )
+                cur.execute("CREATE INDEX IF NOT EXISTS idx_deposits_status ON deposits(status)")
+
+        self.ensure_admin_user(ADMIN_USER_ID)
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute("SELECT * FROM users WHERE user_id=%s", (user_id,), prepare=SUPABASE_DB_PREPARE)
+                row = cur.fetchone()
+                return dict(row) if row else None
+
+    def upsert(
+        self,
+        user_id: int,
+        chat_id: int,
+        lang: Optional[str] = None,
+        role: Optional[str] = None,
+        username: Optional[str] = None,
+        full_name: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute("SELECT * FROM users WHERE user_id=%s", (user_id,))
+                row = cur.fetchone()
+                ts = now_ts()
+                if row is None:
                     cur.execute(
                         """
-                        INSERT INTO activations(
-                          activation_id, user_id, chat_id, service_code, country_code, provider_id, phone, status, otp_code,
-                          base_price, charged_price, refunded, refund_amount, created_at, updated_at
-                        )
-                        VALUES(%s,%s,%s,%s,%s,%s,%s,'active',NULL,%s,%s,FALSE,0,%s,%s)
-                        ON CONFLICT(activation_id) DO UPDATE SET
-                          user_id=EXCLUDED.user_id,
-                          chat_id=EXCLUDED.chat_id,
-                          service_code=EXCLUDED.service_code,
-                          country_code=EXCLUDED.country_code,
-                          provider_id=EXCLUDED.provider_id,
-                          phone=EXCLUDED.phone,
-                          status='active',
-                          otp_code=NULL,
-                          base_price=EXCLUDED.base_price,
-                          charged_price=EXCLUDED.charged_price,
-                          refunded=FALSE,
-                          refund_amount=0,
-                          updated_at=EXCLUDED.updated_at
+                        INSERT INTO users(user_id, chat_id, username, full_name, lang, role, created, updated)
+                        VALUES(%s,%s,%s,%s,%s,%s,%s,%s)
+                        """,
+                        (user_id, chat_id, username, full_name, lang or "en", role or ROLE_PENDING, ts, ts),
+                    )
+                else:
+                    cur.execute(
+                        """
+                        UPDATE users
+                        SET chat_id=%s,
+                            username=%s,
+                            full_name=%s,
+                            lang=COALESCE(%s, lang),
+                            role=COALESCE(%s, role),
+                            updated=%s
+                        WHERE user_id=%s
                         """,
                         (
-                            activation_id,
-                            user_id,
                             chat_id,
-                            service_code,
-                            country_code,
-                            provider_id,
-                            phone,
-                            dec(base_price),
-                            dec(charged_price),
-                            ts,
+                            username if username is not None else row.get("username"),
+                            full_name if full_name is not None else row.get("full_name"),
+                            lang,
+                            role,
                             ts,
+                            user_id,
                         ),
                     )
+                cur.execute("SELECT * FROM users WHERE user_id=%s", (user_id,))
+                out = cur.fetchone()
+                return dict(out) if out else {}
 
-    def get_activation(self, activation_id: str) -> Optional[Dict[str, Any]]:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    cur.execute("SELECT * FROM activations WHERE activation_id=%s", (activation_id,))
-                    row = cur.fetchone()
-                    return dict(row) if row else None
+    def set_lang(self, user_id: int, chat_id: int, lang: str) -> None:
+        self.upsert(user_id, chat_id, lang=lang)
 
-    def set_activation_status(self, activation_id: str, status: str, otp_code: Optional[str] = None) -> None:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor() as cur:
+    def ensure_admin_user(self, user_id: int) -> None:
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                ts = now_ts()
+                cur.execute("SELECT * FROM users WHERE user_id=%s", (user_id,))
+                row = cur.fetchone()
+                if row is None:
                     cur.execute(
                         """
-                        UPDATE activations
-                        SET status=%s, otp_code=COALESCE(%s, otp_code), updated_at=%s
-                        WHERE activation_id=%s
+                        INSERT INTO users(user_id, chat_id, lang, role, approval_notified, approved_by, approved_at, created, updated)
+                        VALUES(%s,%s,'en',%s,TRUE,%s,%s,%s,%s)
                         """,
-                        (status, otp_code, now_ts(), activation_id),
+                        (user_id, user_id, ROLE_ADMIN, user_id, ts, ts, ts),
                     )
-                    if status != "active":
-                        cur.execute("UPDATE users SET polling=0, updated=%s WHERE activation_id=%s", (now_ts(), activation_id))
-
-    def list_active_activations(self) -> List[Dict[str, Any]]:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    cur.execute("SELECT * FROM activations WHERE status='active'")
-                    return [dict(r) for r in cur.fetchall()]
-
-    def latest_active_activation_for_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor(row_factory=dict_row) as cur:
+                else:
                     cur.execute(
                         """
-                        SELECT * FROM activations
-                        WHERE user_id=%s AND status='active'
-                        ORDER BY created_at DESC
-                        LIMIT 1
+                        UPDATE users
+                        SET role=%s, approval_notified=TRUE, approved_by=%s, approved_at=COALESCE(approved_at,%s), updated=%s
+                        WHERE user_id=%s
                         """,
-                        (user_id,),
+                        (ROLE_ADMIN, user_id, ts, ts, user_id),
                     )
-                    row = cur.fetchone()
-                    return dict(row) if row else None
 
-    def refund_activation_if_needed(self, activation_id: str) -> Optional[Dict[str, Any]]:
-        with self.lock:
-            with self.conn(autocommit=False) as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    cur.execute("SELECT * FROM activations WHERE activation_id=%s FOR UPDATE", (activation_id,))
-                    act = cur.fetchone()
-                    if not act:
-                        c.rollback()
-                        return None
-                    charged = dec(act.get("charged_price", "0"))
-                    if bool(act.get("refunded")) or charged <= 0:
-                        c.rollback()
-                        return None
-                    uid = int(act.get("user_id"))
-                    ts = now_ts()
+    def mark_approval_notified(self, user_id: int) -> None:
+        with self.conn() as c:
+            with c.cursor() as cur:
+                cur.execute("UPDATE users SET approval_notified=TRUE, updated=%s WHERE user_id=%s", (now_ts(), user_id))
+
+    def clear_chat(self, user_id: int) -> None:
+        with self.conn() as c:
+            with c.cursor() as cur:
+                cur.execute("UPDATE users SET chat_id=NULL, updated=%s WHERE user_id=%s", (now_ts(), user_id))
+
+    def set_role(self, user_id: int, role: str, approved_by: Optional[int] = None) -> None:
+        with self.conn() as c:
+            with c.cursor() as cur:
+                ts = now_ts()
+                cur.execute(
+                    """
+                    UPDATE users
+                    SET role=%s,
+                        approval_notified=TRUE,
+                        approved_by=COALESCE(%s, approved_by),
+                        approved_at=CASE WHEN %s IN ('admin','user','super_user') THEN %s ELSE approved_at END,
+                        updated=%s
+                    WHERE user_id=%s
+                    """,
+                    (role, approved_by, role, ts, ts, user_id),
+                )
+
+    def list_users_page(
+        self,
+        after: Optional[Tuple[int, int]] = None,
+        limit: int = USER_PAGE_SIZE,
+        role: Optional[str] = None,
+        exclude_role: Optional[str] = None,
+        columns: str = "*",
+    ) -> List[Dict[str, Any]]:
+        where: List[str] = []
+        args: List[Any] = []
+        if after:
+            where.append("(created, user_id) > (%s, %s)")
+            args += [int(after[0]), int(after[1])]
+        if role:
+            where.append("role=%s")
+            args.append(role)
+        if exclude_role:
+            where.append("role<>%s")
+            args.append(exclude_role)
+        sql = f"SELECT {columns} FROM users"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created ASC, user_id ASC LIMIT %s"
+        args.append(int(limit))
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute(sql, args)
+                return [dict(r) for r in cur.fetchall()]
+
+    def user_stats(self) -> Dict[str, int]:
+        out = {"total": 0, "pending": 0, "user": 0, "super_user": 0, "admin": 0, "blocked": 0}
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute("SELECT role, COUNT(*) AS c FROM users GROUP BY role")
+                rows = cur.fetchall()
+                total = 0
+                for r in rows:
+                    role = str(r.get("role") or ROLE_PENDING)
+                    cnt = int(r.get("c") or 0)
+                    out[role] = cnt
+                    total += cnt
+                out["total"] = total
+        return out
+
+    def get_setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        with self.conn() as c:
+            with c.cursor() as cur:
+                cur.execute("SELECT value FROM settings WHERE key=%s", (key,))
+                row = cur.fetchone()
+                return row[0] if row else default
+
+    def set_setting(self, key: str, value: str) -> None:
+        with self.conn() as c:
+            with c.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO settings(key, value, updated)
+                    VALUES(%s,%s,%s)
+                    ON CONFLICT(key) DO UPDATE SET value=EXCLUDED.value, updated=EXCLUDED.updated
+                    """,
+                    (key, value, now_ts()),
+                )
+
+    def get_profit_percent(self) -> Decimal:
+        raw = self.get_setting("profit_percent", "20")
+        return profit_percent_from_settings({"profit_percent": raw})
+
+    def set_profit_percent(self, pct: Decimal) -> None:
+        p = max(Decimal("0"), min(Decimal("500"), dec(pct)))
+        self.set_setting("profit_percent", money(p))
+
+    def get_payment_settings(self) -> Dict[str, str]:
+        raw = self.get_setting("payment_methods", "{}") or "{}"
+        try:
+            data = json.loads(raw)
+            if isinstance(data, dict):
+                return {str(k): str(v) for k, v in data.items()}
+        except Exception:
+            pass
+        return {}
+
+    def update_payment_settings(self, items: Dict[str, str]) -> Dict[str, str]:
+        cur = self.get_payment_settings()
+        for k, v in items.items():
+            kk = str(k or "").strip().lower()
+            if not kk:
+                continue
+            cur[kk] = str(v or "").strip()
+        self.set_setting("payment_methods", json.dumps(cur, ensure_ascii=False))
+        return cur
+
+    def adjust_balance(self, user_id: int, delta: Decimal, require_non_negative: bool = False) -> Optional[Decimal]:
+        with self.conn() as c:
+            with c.cursor() as cur:
+                if require_non_negative:
                     cur.execute(
                         """
-                        UPDATE activations
-                        SET refunded=TRUE, refund_amount=%s, updated_at=%s
-                        WHERE activation_id=%s
+                        UPDATE users
+                        SET balance=balance+%s, updated=%s
+                        WHERE user_id=%s AND balance+%s >= 0
+                        RETURNING balance
                         """,
-                        (charged, ts, activation_id),
+                        (dec(delta), now_ts(), user_id, dec(delta)),
+                        prepare=SUPABASE_DB_PREPARE,
                     )
-                    cur.execute("UPDATE users SET balance=balance+%s, updated=%s WHERE user_id=%s", (charged, ts, uid))
-                    c.commit()
-                    return {"user_id": uid, "amount": money(charged)}
-
-    def create_deposit(self, user_id: int, amount: Decimal) -> int:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor() as cur:
+                else:
                     cur.execute(
                         """
-                        INSERT INTO deposits(user_id, amount, status, created_at, updated_at)
-                        VALUES(%s,%s,'awaiting_proof',%s,%s)
-                        RETURNING id
+                        UPDATE users
+                        SET balance=balance+%s, updated=%s
+                        WHERE user_id=%s
+                        RETURNING balance
                         """,
-                        (user_id, dec(amount), now_ts(), now_ts()),
+                        (dec(delta), now_ts(), user_id),
+                        prepare=SUPABASE_DB_PREPARE,
                     )
-                    row = cur.fetchone()
-                    return int(row[0])
+                row = cur.fetchone()
+                return dec(row[0]) if row else None
 
-    def set_deposit_proof(self, deposit_id: int, txid: str, screenshot_file_id: str) -> None:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor() as cur:
-                    cur.execute(
-                        """
-                        UPDATE deposits
-                        SET txid=%s, screenshot_file_id=%s, status='pending', updated_at=%s
-                        WHERE id=%s
-                        """,
-                        (txid, screenshot_file_id, now_ts(), deposit_id),
+    def get_balance(self, user_id: int) -> Decimal:
+        row = self.get(user_id) or {}
+        return dec(row.get("balance", "0"))
+
+    def set_activation(
+        self,
+        user_id: int,
+        chat_id: int,
+        aid: str,
+        service: str,
+        country: str,
+        provider_id: Optional[str],
+        phone: str,
+    ) -> None:
+        ts = now_ts()
+        with self.conn() as c:
+            with c.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE users
+                    SET chat_id=%s,
+                        activation_id=%s,
+                        activation_started_at=%s,
+                        service_code=%s,
+                        country_code=%s,
+                        provider_id=%s,
+                        phone=%s,
+                        polling=1,
+                        updated=%s
+                    WHERE user_id=%s
+                    """,
+                    (chat_id, aid, ts, service, country, provider_id, phone, ts, user_id),
+                )
+
+    def clear_activation(self, user_id: int) -> None:
+        with self.conn() as c:
+            with c.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE users SET
+                      activation_id=NULL, activation_started_at=NULL, service_code=NULL, country_code=NULL, provider_id=NULL, phone=NULL, polling=0,
+                      updated=%s
+                    WHERE user_id=%s
+                    """,
+                    (now_ts(), user_id),
+                )
+
+    def active_rows(self) -> List[Dict[str, Any]]:
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute("SELECT * FROM users WHERE polling=1 AND activation_id IS NOT NULL AND chat_id IS NOT NULL")
+                return [dict(r) for r in cur.fetchall()]
+
+    def add_activation(
+        self,
+        user_id: int,
+        chat_id: int,
+        activation_id: str,
+        service_code: str,
+        country_code: str,
+        provider_id: Optional[str],
+        phone: str,
+        base_price: Any = 0,
+        charged_price: Any = 0,
+    ) -> None:
+        ts = now_ts()
+        with self.conn() as c:
+            with c.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO activations(
+                      activation_id, user_id, chat_id, service_code, country_code, provider_id, phone, status, otp_code,
+                      base_price, charged_price, refunded, refund_amount, created_at, updated_at
                     )
+                    VALUES(%s,%s,%s,%s,%s,%s,%s,'active',NULL,%s,%s,FALSE,0,%s,%s)
+                    ON CONFLICT(activation_id) DO UPDATE SET
+                      user_id=EXCLUDED.user_id,
+                      chat_id=EXCLUDED.chat_id,
+                      service_code=EXCLUDED.service_code,
+                      country_code=EXCLUDED.country_code,
+                      provider_id=EXCLUDED.provider_id,
+                      phone=EXCLUDED.phone,
+                      status='active',
+                      otp_code=NULL,
+                      base_price=EXCLUDED.base_price,
+                      charged_price=EXCLUDED.charged_price,
+                      refunded=FALSE,
+                      refund_amount=0,
+                      updated_at=EXCLUDED.updated_at
+                    """,
+                    (
+                        activation_id,
+                        user_id,
+                        chat_id,
+                        service_code,
+                        country_code,
+                        provider_id,
+                        phone,
+                        dec(base_price),
+                        dec(charged_price),
+                        ts,
+                        ts,
+                    ),
+                )
+
+    def get_activation(self, activation_id: str) -> Optional[Dict[str, Any]]:
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute("SELECT * FROM activations WHERE activation_id=%s", (activation_id,), prepare=SUPABASE_DB_PREPARE)
+                row = cur.fetchone()
+                return dict(row) if row else None
+
+    def get_activations(self, activation_ids: List[str]) -> List[Dict[str, Any]]:
+        ids = [str(x) for x in activation_ids]
+        if not ids:
+            return []
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute("SELECT * FROM activations WHERE activation_id = ANY(%s)", (ids,))
+                return [dict(r) for r in cur.fetchall()]
+
+    def set_activation_status(self, activation_id: str, status: str, otp_code: Optional[str] = None) -> None:
+        with self.conn() as c:
+            with c.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE activations
+                    SET status=%s, otp_code=COALESCE(%s, otp_code), updated_at=%s
+                    WHERE activation_id=%s
+                    """,
+                    (status, otp_code, now_ts(), activation_id),
+                )
+                if status != "active":
+                    cur.execute("UPDATE users SET polling=0, updated=%s WHERE activation_id=%s", (now_ts(), activation_id))
+
+    def list_active_activations(self) -> List[Dict[str, Any]]:
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute("SELECT * FROM activations WHERE status='active'")
+                return [dict(r) for r in cur.fetchall()]
+
+    def expire_activations(self, activation_ids: List[str]) -> List[Dict[str, Any]]:
+        ids = [str(x) for x in activation_ids]
+        if not ids:
+            return []
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                ts = now_ts()
+                cur.execute(
+                    """
+                    UPDATE activations SET status='expired', updated_at=%s
+                    WHERE activation_id = ANY(%s) AND status='active'
+                    RETURNING *
+                    """,
+                    (ts, ids),
+                )
+                rows = [dict(r) for r in cur.fetchall()]
+                hit = [r["activation_id"] for r in rows]
+                if hit:
+                    cur.execute("UPDATE users SET polling=0, updated=%s WHERE activation_id = ANY(%s)", (ts, hit))
+                return rows
+
+    def latest_active_activation_for_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute(
+                    """
+                    SELECT * FROM activations
+                    WHERE user_id=%s AND status='active'
+                    ORDER BY created_at DESC
+                    LIMIT 1
+                    """,
+                    (user_id,),
+                )
+                row = cur.fetchone()
+                return dict(row) if row else None
+
+    def refund_activation_if_needed(self, activation_id: str) -> Optional[Dict[str, Any]]:
+        with self.conn() as c, c.transaction():
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute("SELECT * FROM activations WHERE activation_id=%s FOR UPDATE", (activation_id,))
+                act = cur.fetchone()
+                if not act:
+                    return None
+                charged = dec(act.get("charged_price", "0"))
+                if bool(act.get("refunded")) or charged <= 0:
+                    return None
+                uid = int(act.get("user_id"))
+                ts = now_ts()
+                cur.execute(
+                    """
+                    UPDATE activations
+                    SET refunded=TRUE, refund_amount=%s, updated_at=%s
+                    WHERE activation_id=%s
+                    """,
+                    (charged, ts, activation_id),
+                )
+                cur.execute("UPDATE users SET balance=balance+%s, updated=%s WHERE user_id=%s", (charged, ts, uid))
+                return {"user_id": uid, "amount": money(charged)}
+
+    def create_deposit(self, user_id: int, amount: Decimal) -> int:
+        with self.conn() as c:
+            with c.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO deposits(user_id, amount, status, created_at, updated_at)
+                    VALUES(%s,%s,'awaiting_proof',%s,%s)
+                    RETURNING id
+                    """,
+                    (user_id, dec(amount), now_ts(), now_ts()),
+                )
+                row = cur.fetchone()
+                return int(row[0])
+
+    def set_deposit_proof(self, deposit_id: int, txid: str, screenshot_file_id: str) -> None:
+        with self.conn() as c:
+            with c.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE deposits
+                    SET txid=%s, screenshot_file_id=%s, status='pending', updated_at=%s
+                    WHERE id=%s
+                    """,
+                    (txid, screenshot_file_id, now_ts(), deposit_id),
+                )
 
     def get_deposit(self, deposit_id: int) -> Optional[Dict[str, Any]]:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    cur.execute("SELECT * FROM deposits WHERE id=%s", (deposit_id,))
-                    row = cur.fetchone()
-                    return dict(row) if row else None
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute("SELECT * FROM deposits WHERE id=%s", (deposit_id,))
+                row = cur.fetchone()
+                return dict(row) if row else None
 
     def latest_open_deposit_for_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        with self.lock:
-            with self.conn() as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    cur.execute(
-                        """
-                        SELECT * FROM deposits
-                        WHERE user_id=%s AND status='awaiting_proof'
-                        ORDER BY created_at DESC
-                        LIMIT 1
-                        """,
-                        (user_id,),
-                    )
-                    row = cur.fetchone()
-                    return dict(row) if row else None
+        with self.conn() as c:
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute(
+                    """
+                    SELECT * FROM deposits
+                    WHERE user_id=%s AND status='awaiting_proof'
+                    ORDER BY created_at DESC
+                    LIMIT 1
+                    """,
+                    (user_id,),
+                )
+                row = cur.fetchone()
+                return dict(row) if row else None
 
     def update_deposit_status(self, deposit_id: int, status: str, reviewed_by: int, note: Optional[str] = None) -> bool:
-        with self.lock:
-            with self.conn(autocommit=False) as c:
-                with c.cursor(row_factory=dict_row) as cur:
-                    cur.execute("SELECT * FROM deposits WHERE id=%s FOR UPDATE", (deposit_id,))
-                    dep = cur.fetchone()
-                    if not dep:
-                        c.rollback()
-                        return False
-                    if str(dep.get("status")) not in {"pending", "awaiting_proof"}:
-                        c.rollback()
-                        return False
-                    ts = now_ts()
+        with self.conn() as c, c.transaction():
+            with c.cursor(row_factory=dict_row) as cur:
+                cur.execute("SELECT * FROM deposits WHERE id=%s FOR UPDATE", (deposit_id,))
+                dep = cur.fetchone()
+                if not dep:
+                    return False
+                if str(dep.get("status")) not in {"pending", "awaiting_proof"}:
+                    return False
+                ts = now_ts()
+                cur.execute(
+                    """
+                    UPDATE deposits
+                    SET status=%s, reviewed_by=%s, reviewed_at=%s, note=%s, updated_at=%s
+                    WHERE id=%s
+                    """,
+                    (status, reviewed_by, ts, note, ts, deposit_id),
+                )
+                if status == "approved":
                     cur.execute(
-                        """
-                        UPDATE deposits
-                        SET status=%s, reviewed_by=%s, reviewed_at=%s, note=%s, updated_at=%s
-                        WHERE id=%s
-                        """,
-                        (status, reviewed_by, ts, note, ts, deposit_id),
+                        "UPDATE users SET balance=balance+%s, updated=%s WHERE user_id=%s",
+                        (dec(dep.get("amount", "0")), ts, int(dep.get("user_id"))),
                     )
-                    if status == "approved":
-                        cur.execute(
-                            "UPDATE users SET balance=balance+%s, updated=%s WHERE user_id=%s",
-                            (dec(dep.get("amount", "0")), ts, int(dep.get("user_id"))),
-                        )
-                    c.commit()
-                    return True
+                return True
 
 
 class SupabaseRESTDB:
     def __init__(self):
-        self.lock = threading.RLock()
         if not SUPABASE_URL:
             raise SystemExit("SUPABASE_URL is required")
         if not SUPABASE_KEY:
@@ -1549,40 +2143,86 @@ class SupabaseRESTDB:
                 "Supabase key role is not service_role. "
                 "Use Secret/Service Role key (not Publishable/Anon key)."
             )
-        self.sb = create_client(SUPABASE_URL, SUPABASE_KEY)
-        self.init()
+        self.http = httpx.AsyncClient(
+            base_url=f"{SUPABASE_URL.rstrip('/')}/rest/v1",
+            headers={"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"},
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            limits=http_limits(SUPABASE_HTTP_MAX_CONNECTIONS),
+            http2=http2_enabled(),
+        )
+        self.stats_rpc_after = 0.0
 
     @staticmethod
-    def _rows(resp: Any) -> List[Dict[str, Any]]:
-        data = getattr(resp, "data", None)
+    def _rows(data: Any) -> List[Dict[str, Any]]:
         if isinstance(data, list):
             return [dict(x) for x in data if isinstance(x, dict)]
         if isinstance(data, dict):
             return [dict(data)]
         return []
 
-    @classmethod
-    def _one(cls, resp: Any) -> Optional[Dict[str, Any]]:
-        rows = cls._rows(resp)
+    @staticmethod
+    def _in(values: List[Any]) -> str:
+        return "in.(" + ",".join('"' + str(v).replace('"', '\\"') + '"' for v in values) + ")"
+
+    async def _req(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        body: Any = None,
+        prefer: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        headers = {"Prefer": prefer} if prefer else None
+        r = await self.http.request(method, f"/{path}", params=params, json=body, headers=headers)
+        if r.status_code >= 400:
+            raise RuntimeError(f"PostgREST {method} {path} failed: {r.status_code} {r.text}")
+        if not r.content:
+            return []
+        return self._rows(r.json(parse_float=Decimal))
+
+    async def _rpc(self, fn: str, args: Dict[str, Any]) -> Any:
+        r = await self.http.post(f"/rpc/{fn}", json=args)
+        if r.status_code >= 400:
+            raise RuntimeError(f"PostgREST rpc {fn} failed: {r.status_code} {r.text}")
+        return r.json(parse_float=Decimal) if r.content else None
+
+    async def _count(self, path: str, params: Optional[Dict[str, Any]] = None) -> int:
+        r = await self.http.head(f"/{path}", params=params, headers={"Prefer": "count=exact"})
+        if r.status_code >= 400:
+            raise RuntimeError(f"PostgREST HEAD {path} failed: {r.status_code}")
+        total = r.headers.get("content-range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else 0
+
+    async def _one(self, path: str, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        rows = await self._req("GET", path, {"select": "*", "limit": "1", **params})
         return rows[0] if rows else None
 
-    def _require_schema(self) -> None:
+    async def _update(self, path: str, params: Dict[str, Any], payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return await self._req("PATCH", path, params, payload, prefer="return=representation")
+
+    async def close(self) -> None:
+        await self.http.aclose()
+
+    async def _require_schema(self) -> None:
         try:
-            self.sb.table("users").select("user_id").limit(1).execute()
-            self.sb.table("activations").select("activation_id").limit(1).execute()
-            self.sb.table("deposits").select("id").limit(1).execute()
-            self.sb.table("settings").select("key").limit(1).execute()
+            await asyncio.gather(
+                self._req("GET", "users", {"select": "user_id", "limit": "1"}),
+                self._req("GET", "activations", {"select": "activation_id", "limit": "1"}),
+                self._req("GET", "deposits", {"select": "id", "limit": "1"}),
+                self._req("GET", "settings", {"select": "key", "limit": "1"}),
+                self._rpc("bot_refund_activation", {"p_activation_id": ""}),
+            )
         except Exception as e:
             raise SystemExit(
-                "Supabase tables are missing. Run SQL from `supabase_schema.sql` in Supabase SQL Editor. "
+                "Supabase tables or functions are missing. Run SQL from `supabase_schema.sql` in Supabase SQL Editor. "
                 f"Details: {e}"
             )
 
-    def init(self) -> None:
-        self._require_schema()
+    async def init(self) -> None:
+        await self._require_schema()
         try:
-            self.set_setting("profit_percent", self.get_setting("profit_percent", "20") or "20")
-            self.set_setting("payment_methods", self.get_setting("payment_methods", "{}") or "{}")
+            await self.set_setting("profit_percent", await self.get_setting("profit_percent", "20") or "20")
+            await self.set_setting("payment_methods", await self.get_setting("payment_methods", "{}") or "{}")
         except Exception as e:
             msg = str(e)
             if "row-level security policy" in msg.lower() or "42501" in msg:
@@ -1591,13 +2231,12 @@ class SupabaseRESTDB:
                     "(RLS disabled for bot tables)."
                 )
             raise
-        self.ensure_admin_user(ADMIN_USER_ID)
+        await self.ensure_admin_user(ADMIN_USER_ID)
 
-    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
-        with self.lock:
-            return self._one(self.sb.table("users").select("*").eq("user_id", int(user_id)).limit(1).execute())
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return await self._one("users", {"user_id": f"eq.{int(user_id)}"})
 
-    def upsert(
+    async def upsert(
         self,
         user_id: int,
         chat_id: int,
@@ -1606,120 +2245,148 @@ class SupabaseRESTDB:
         username: Optional[str] = None,
         full_name: Optional[str] = None,
     ) -> Dict[str, Any]:
-        with self.lock:
-            old = self.get(user_id)
-            ts = now_ts()
-            if not old:
-                self.sb.table("users").insert(
-                    {
-                        "user_id": int(user_id),
-                        "chat_id": int(chat_id),
-                        "username": username,
-                        "full_name": full_name,
-                        "lang": lang or "en",
-                        "role": role or ROLE_PENDING,
-                        "created": ts,
-                        "updated": ts,
-                    }
-                ).execute()
-            else:
-                payload: Dict[str, Any] = {
-                    "chat_id": int(chat_id),
-                    "username": username if username is not None else old.get("username"),
-                    "full_name": full_name if full_name is not None else old.get("full_name"),
-                    "updated": ts,
-                }
-                if lang is not None:
-                    payload["lang"] = lang
-                if role is not None:
-                    payload["role"] = role
-                self.sb.table("users").update(payload).eq("user_id", int(user_id)).execute()
-            return self.get(user_id) or {}
+        ts = now_ts()
+        payload: Dict[str, Any] = {"chat_id": int(chat_id), "updated": ts}
+        if username is not None:
+            payload["username"] = username
+        if full_name is not None:
+            payload["full_name"] = full_name
+        if lang is not None:
+            payload["lang"] = lang
+        if role is not None:
+            payload["role"] = role
+        rows = await self._update("users", {"user_id": f"eq.{int(user_id)}"}, payload)
+        if rows:
+            return rows[0]
+        rows = await self._req(
+            "POST",
+            "users",
+            {"on_conflict": "user_id"},
+            {
+                "user_id": int(user_id),
+                "chat_id": int(chat_id),
+                "username": username,
+                "full_name": full_name,
+                "lang": lang or "en",
+                "role": role or ROLE_PENDING,
+                "created": ts,
+                "updated": ts,
+            },
+            prefer="return=representation,resolution=ignore-duplicates",
+        )
+        return rows[0] if rows else (await self.get(user_id) or {})
 
-    def set_lang(self, user_id: int, chat_id: int, lang: str) -> None:
-        self.upsert(user_id, chat_id, lang=lang)
+    async def set_lang(self, user_id: int, chat_id: int, lang: str) -> None:
+        await self.upsert(user_id, chat_id, lang=lang)
 
-    def ensure_admin_user(self, user_id: int) -> None:
-        with self.lock:
-            ts = now_ts()
-            row = self.get(user_id)
-            if not row:
-                self.sb.table("users").insert(
-                    {
-                        "user_id": int(user_id),
-                        "chat_id": int(user_id),
-                        "lang": "en",
-                        "role": ROLE_ADMIN,
-                        "approval_notified": True,
-                        "approved_by": int(user_id),
-                        "approved_at": ts,
-                        "created": ts,
-                        "updated": ts,
-                    }
-                ).execute()
-            else:
-                self.sb.table("users").update(
-                    {
-                        "role": ROLE_ADMIN,
-                        "approval_notified": True,
-                        "approved_by": int(user_id),
-                        "approved_at": row.get("approved_at") or ts,
-                        "updated": ts,
-                    }
-                ).eq("user_id", int(user_id)).execute()
+    async def ensure_admin_user(self, user_id: int) -> None:
+        ts = now_ts()
+        row = await self.get(user_id)
+        if not row:
+            await self._req(
+                "POST",
+                "users",
+                body={
+                    "user_id": int(user_id),
+                    "chat_id": int(user_id),
+                    "lang": "en",
+                    "role": ROLE_ADMIN,
+                    "approval_notified": True,
+                    "approved_by": int(user_id),
+                    "approved_at": ts,
+                    "created": ts,
+                    "updated": ts,
+                },
+            )
+        else:
+            await self._update(
+                "users",
+                {"user_id": f"eq.{int(user_id)}"},
+                {
+                    "role": ROLE_ADMIN,
+                    "approval_notified": True,
+                    "approved_by": int(user_id),
+                    "approved_at": row.get("approved_at") or ts,
+                    "updated": ts,
+                },
+            )
 
-    def mark_approval_notified(self, user_id: int) -> None:
-        with self.lock:
-            self.sb.table("users").update({"approval_notified": True, "updated": now_ts()}).eq("user_id", int(user_id)).execute()
+    async def mark_approval_notified(self, user_id: int) -> None:
+        await self._update("users", {"user_id": f"eq.{int(user_id)}"}, {"approval_notified": True, "updated": now_ts()})
 
-    def set_role(self, user_id: int, role: str, approved_by: Optional[int] = None) -> None:
-        with self.lock:
-            ts = now_ts()
-            payload: Dict[str, Any] = {"role": role, "approval_notified": True, "updated": ts}
-            if approved_by is not None:
-                payload["approved_by"] = int(approved_by)
-            if role in {ROLE_ADMIN, ROLE_USER, ROLE_SUPER}:
-                payload["approved_at"] = ts
-            self.sb.table("users").update(payload).eq("user_id", int(user_id)).execute()
-
-    def list_pending_users(self) -> List[Dict[str, Any]]:
-        with self.lock:
-            return self._rows(self.sb.table("users").select("*").eq("role", ROLE_PENDING).order("created", desc=False).limit(200).execute())
+    async def clear_chat(self, user_id: int) -> None:
+        await self._update("users", {"user_id": f"eq.{int(user_id)}"}, {"chat_id": None, "updated": now_ts()})
 
-    def list_all_users(self, include_blocked: bool = True) -> List[Dict[str, Any]]:
-        with self.lock:
-            q = self.sb.table("users").select("*").order("created", desc=False)
-            if not include_blocked:
-                q = q.neq("role", ROLE_BLOCKED)
-            return self._rows(q.execute())
+    async def set_role(self, user_id: int, role: str, approved_by: Optional[int] = None) -> None:
+        ts = now_ts()
+        payload: Dict[str, Any] = {"role": role, "approval_notified": True, "updated": ts}
+        if approved_by is not None:
+            payload["approved_by"] = int(approved_by)
+        if role in {ROLE_ADMIN, ROLE_USER, ROLE_SUPER}:
+            payload["approved_at"] = ts
+        await self._update("users", {"user_id": f"eq.{int(user_id)}"}, payload)
 
-    def user_stats(self) -> Dict[str, int]:
+    async def list_users_page(
+        self,
+        after: Optional[Tuple[int, int]] = None,
+        limit: int = USER_PAGE_SIZE,
+        role: Optional[str] = None,
+        exclude_role: Optional[str] = None,
+        columns: str = "*",
+    ) -> List[Dict[str, Any]]:
+        params: Dict[str, Any] = {"select": columns, "order": "created.asc,user_id.asc", "limit": str(int(limit))}
+        if after:
+            c, u = int(after[0]), int(after[1])
+            params["or"] = f"(created.gt.{c},and(created.eq.{c},user_id.gt.{u}))"
+        if role:
+            params["role"] = f"eq.{role}"
+        elif exclude_role:
+            params["role"] = f"neq.{exclude_role}"
+        return await self._req("GET", "users", params)
+
+    async def user_stats(self) -> Dict[str, int]:
         out = {"total": 0, "pending": 0, "user": 0, "super_user": 0, "admin": 0, "blocked": 0}
-        rows = self.list_all_users(include_blocked=True)
-        out["total"] = len(rows)
-        for r in rows:
-            k = role_of(r)
-            out[k] = out.get(k, 0) + 1
+        if time.monotonic() >= self.stats_rpc_after:
+            try:
+                rows = self._rows(await self._rpc("bot_user_stats", {}))
+                for r in rows:
+                    out[str(r.get("role") or ROLE_PENDING)] = int(r.get("n") or 0)
+                out["total"] = sum(int(r.get("n") or 0) for r in rows)
+                return out
+            except Exception as e:
+                logger.warning("bot_user_stats unavailable, using count queries (re-run supabase_schema.sql): %s", e)
+                self.stats_rpc_after = time.monotonic() + 300
+        roles = [ROLE_PENDING, ROLE_USER, ROLE_SUPER, ROLE_ADMIN, ROLE_BLOCKED]
+        counts = await asyncio.gather(
+            self._count("users", {"select": "user_id"}),
+            *(self._count("users", {"select": "user_id", "role": f"eq.{r}"}) for r in roles),
+        )
+        out["total"] = counts[0]
+        out.update(zip(roles, counts[1:]))
         return out
 
-    def get_setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
-        with self.lock:
-            row = self._one(self.sb.table("settings").select("value").eq("key", key).limit(1).execute())
-            return str(row.get("value")) if row else default
-
-    def set_setting(self, key: str, value: str) -> None:
-        with self.lock:
-            self.sb.table("settings").upsert({"key": key, "value": str(value), "updated": now_ts()}, on_conflict="key").execute()
+    async def get_setting(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        row = await self._one("settings", {"key": f"eq.{key}"})
+        return str(row.get("value")) if row else default
+
+    async def set_setting(self, key: str, value: str) -> None:
+        await self._req(
+            "POST",
+            "settings",
+            {"on_conflict": "key"},
+            {"key": key, "value": str(value), "updated": now_ts()},
+            prefer="resolution=merge-duplicates",
+        )
 
-    def get_profit_percent(self) -> Decimal:
-        return profit_percent_from_settings({"profit_percent": self.get_setting("profit_percent", "20")})
+    async def get_profit_percent(self) -> Decimal:
+        return profit_percent_from_settings({"profit_percent": await self.get_setting("profit_percent", "20")})
 
-    def set_profit_percent(self, pct: Decimal) -> None:
+    async def set_profit_percent(self, pct: Decimal) -> None:
         p = max(Decimal("0"), min(Decimal("500"), dec(pct)))
-        self.set_setting("profit_percent", money(p))
+        await self.set_setting("profit_percent", money(p))
 
-    def get_payment_settings(self) -> Dict[str, str]:
-        raw = self.get_setting("payment_methods", "{}") or "{}"
+    async def get_payment_settings(self) -> Dict[str, str]:
+        raw = await self.get_setting("payment_methods", "{}") or "{}"
         try:
             obj = json.loads(raw)
             if isinstance(obj, dict):
@@ -1728,145 +2395,492 @@ class SupabaseRESTDB:
             pass
         return {}
 
-    def update_payment_settings(self, items: Dict[str, str]) -> Dict[str, str]:
-        cur = self.get_payment_settings()
+    async def update_payment_settings(self, items: Dict[str, str]) -> Dict[str, str]:
+        cur = await self.get_payment_settings()
         for k, v in items.items():
             kk = str(k or "").strip().lower()
             if kk:
                 cur[kk] = str(v or "").strip()
-        self.set_setting("payment_methods", json.dumps(cur, ensure_ascii=False))
+        await self.set_setting("payment_methods", json.dumps(cur, ensure_ascii=False))
         return cur
 
-    def adjust_balance(self, user_id: int, delta: Decimal, require_non_negative: bool = False) -> Optional[Decimal]:
-        with self.lock:
-            row = self.get(user_id)
-            if not row:
-                return None
-            new_bal = dec(row.get("balance", "0")) + dec(delta)
-            if require_non_negative and new_bal < 0:
-                return None
-            self.sb.table("users").update({"balance": money(new_bal), "updated": now_ts()}).eq("user_id", int(user_id)).execute()
-            return new_bal
+    async def adjust_balance(self, user_id: int, delta: Decimal, require_non_negative: bool = False) -> Optional[Decimal]:
+        bal = await self._rpc(
+            "bot_adjust_balance",
+            {"p_user_id": int(user_id), "p_delta": money(dec(delta)), "p_require_non_negative": bool(require_non_negative)},
+        )
+        return None if bal is None else dec(bal)
 
-    def get_balance(self, user_id: int) -> Decimal:
-        return dec((self.get(user_id) or {}).get("balance", "0"))
+    async def get_balance(self, user_id: int) -> Decimal:
+        return dec((await self.get(user_id) or {}).get("balance", "0"))
 
-    def set_activation(self, user_id: int, chat_id: int, aid: str, service: str, country: str, provider_id: Optional[str], phone: str) -> None:
-        with self.lock:
-            self.sb.table("users").update(
-                {
-                    "chat_id": int(chat_id),
-                    "activation_id": str(aid),
-                    "activation_started_at": now_ts(),
-                    "service_code": str(service),
-                    "country_code": str(country),
-                    "provider_id": provider_id,
-                    "phone": phone,
-                    "polling": 1,
-                    "updated": now_ts(),
-                }
-            ).eq("user_id", int(user_id)).execute()
+    async def set_activation(self, user_id: int, chat_id: int, aid: str, service: str, country: str, provider_id: Optional[str], phone: str) -> None:
+        await self._update(
+            "users",
+            {"user_id": f"eq.{int(user_id)}"},
+            {
+                "chat_id": int(chat_id),
+                "activation_id": str(aid),
+                "activation_started_at": now_ts(),
+                "service_code": str(service),
+                "country_code": str(country),
+                "provider_id": provider_id,
+                "phone": phone,
+                "polling": 1,
+                "updated": now_ts(),
+            },
+        )
 
-    def clear_activation(self, user_id: int) -> None:
-        with self.lock:
-            self.sb.table("users").update(
-                {
-                    "activation_id": None,
-                    "activation_started_at": None,
-                    "service_code": None,
-                    "country_code": None,
-                    "provider_id": None,
-                    "phone": None,
-                    "polling": 0,
-                    "updated": now_ts(),
-                }
-            ).eq("user_id", int(user_id)).execute()
+    async def clear_activation(self, user_id: int) -> None:
+        await self._update(
+            "users",
+            {"user_id": f"eq.{int(user_id)}"},
+            {
+                "activation_id": None,
+                "activation_started_at": None,
+                "service_code": None,
+                "country_code": None,
+                "provider_id": None,
+                "phone": None,
+                "polling": 0,
+                "updated": now_ts(),
+            },
+        )
 
-    def active_rows(self) -> List[Dict[str, Any]]:
-        rows = self._rows(self.sb.table("users").select("*").eq("polling", 1).execute())
+    async def active_rows(self) -> List[Dict[str, Any]]:
+        rows = await self._req("GET", "users", {"select": "*", "polling": "eq.1"})
         return [r for r in rows if r.get("activation_id") and r.get("chat_id")]
 
-    def add_activation(self, user_id: int, chat_id: int, activation_id: str, service_code: str, country_code: str, provider_id: Optional[str], phone: str, base_price: Any = 0, charged_price: Any = 0) -> None:
-        with self.lock:
-            ts = now_ts()
-            self.sb.table("activations").upsert(
-                {
-                    "activation_id": str(activation_id),
-                    "user_id": int(user_id),
-                    "chat_id": int(chat_id),
-                    "service_code": str(service_code),
-                    "country_code": str(country_code),
-                    "provider_id": provider_id,
-                    "phone": phone,
-                    "status": "active",
-                    "otp_code": None,
-                    "base_price": money(dec(base_price)),
-                    "charged_price": money(dec(charged_price)),
-                    "refunded": False,
-                    "refund_amount": "0",
-                    "created_at": ts,
-                    "updated_at": ts,
-                },
-                on_conflict="activation_id",
-            ).execute()
+    async def add_activation(self, user_id: int, chat_id: int, activation_id: str, service_code: str, country_code: str, provider_id: Optional[str], phone: str, base_price: Any = 0, charged_price: Any = 0) -> None:
+        ts = now_ts()
+        await self._req(
+            "POST",
+            "activations",
+            {"on_conflict": "activation_id"},
+            {
+                "activation_id": str(activation_id),
+                "user_id": int(user_id),
+                "chat_id": int(chat_id),
+                "service_code": str(service_code),
+                "country_code": str(country_code),
+                "provider_id": provider_id,
+                "phone": phone,
+                "status": "active",
+                "otp_code": None,
+                "base_price": money(dec(base_price)),
+                "charged_price": money(dec(charged_price)),
+                "refunded": False,
+                "refund_amount": "0",
+                "created_at": ts,
+                "updated_at": ts,
+            },
+            prefer="resolution=merge-duplicates",
+        )
 
-    def get_activation(self, activation_id: str) -> Optional[Dict[str, Any]]:
-        return self._one(self.sb.table("activations").select("*").eq("activation_id", str(activation_id)).limit(1).execute())
+    async def get_activation(self, activation_id: str) -> Optional[Dict[str, Any]]:
+        return await self._one("activations", {"activation_id": f"eq.{activation_id}"})
+
+    async def get_activations(self, activation_ids: List[str]) -> List[Dict[str, Any]]:
+        ids = [str(x) for x in activation_ids]
+        chunks = [ids[i : i + 100] for i in range(0, len(ids), 100)]
+        pages = await asyncio.gather(*(self._req("GET", "activations", {"select": "*", "activation_id": self._in(c)}) for c in chunks))
+        return [r for page in pages for r in page]
+
+    async def set_activation_status(self, activation_id: str, status: str, otp_code: Optional[str] = None) -> None:
+        payload: Dict[str, Any] = {"status": status, "updated_at": now_ts()}
+        if otp_code is not None:
+            payload["otp_code"] = otp_code
+        await self._update("activations", {"activation_id": f"eq.{activation_id}"}, payload)
+        if status != "active":
+            await self._update("users", {"activation_id": f"eq.{activation_id}"}, {"polling": 0, "updated": now_ts()})
+
+    async def list_active_activations(self) -> List[Dict[str, Any]]:
+        return await self._req("GET", "activations", {"select": "*", "status": "eq.active"})
+
+    async def expire_activations(self, activation_ids: List[str]) -> List[Dict[str, Any]]:
+        ids = [str(x) for x in activation_ids]
+        out: List[Dict[str, Any]] = []
+        for i in range(0, len(ids), 100):
+            rows = await self._update(
+                "activations",
+                {"activation_id": self._in(ids[i : i + 100]), "status": "eq.active"},
+                {"status": "expired", "updated_at": now_ts()},
+            )
+            hit = [str(r.get("activation_id")) for r in rows]
+            if hit:
+                await self._update("users", {"activation_id": self._in(hit)}, {"polling": 0, "updated": now_ts()})
+            out.extend(rows)
+        return out
 
-    def set_activation_status(self, activation_id: str, status: str, otp_code: Optional[str] = None) -> None:
-        with self.lock:
-            payload: Dict[str, Any] = {"status": status, "updated_at": now_ts()}
-            if otp_code is not None:
-                payload["otp_code"] = otp_code
-            self.sb.table("activations").update(payload).eq("activation_id", str(activation_id)).execute()
-            if status != "active":
-                self.sb.table("users").update({"polling": 0, "updated": now_ts()}).eq("activation_id", str(activation_id)).execute()
+    async def latest_active_activation_for_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return await self._one("activations", {"user_id": f"eq.{int(user_id)}", "status": "eq.active", "order": "created_at.desc"})
 
-    def list_active_activations(self) -> List[Dict[str, Any]]:
-        return self._rows(self.sb.table("activations").select("*").eq("status", "active").execute())
+    async def refund_activation_if_needed(self, activation_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._rows(await self._rpc("bot_refund_activation", {"p_activation_id": str(activation_id)}))
+        if not rows:
+            return None
+        return {"user_id": int(rows[0]["user_id"]), "amount": money(dec(rows[0].get("amount", "0")))}
+
+    async def create_deposit(self, user_id: int, amount: Decimal) -> int:
+        rows = await self._req(
+            "POST",
+            "deposits",
+            body={"user_id": int(user_id), "amount": money(dec(amount)), "status": "awaiting_proof", "created_at": now_ts(), "updated_at": now_ts()},
+            prefer="return=representation",
+        )
+        if not rows:
+            raise RuntimeError("failed to create deposit")
+        return int(rows[0]["id"])
 
-    def latest_active_activation_for_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        return self._one(self.sb.table("activations").select("*").eq("user_id", int(user_id)).eq("status", "active").order("created_at", desc=True).limit(1).execute())
+    async def set_deposit_proof(self, deposit_id: int, txid: str, screenshot_file_id: str) -> None:
+        await self._update(
+            "deposits",
+            {"id": f"eq.{int(deposit_id)}"},
+            {"txid": txid, "screenshot_file_id": screenshot_file_id, "status": "pending", "updated_at": now_ts()},
+        )
 
-    def refund_activation_if_needed(self, activation_id: str) -> Optional[Dict[str, Any]]:
-        with self.lock:
-            act = self.get_activation(activation_id)
-            if not act:
-                return None
-            charged = dec(act.get("charged_price", "0"))
-            if bool(act.get("refunded")) or charged <= 0:
-                return None
-            self.sb.table("activations").update({"refunded": True, "refund_amount": money(charged), "updated_at": now_ts()}).eq("activation_id", str(activation_id)).eq("refunded", False).execute()
-            uid = int(act.get("user_id"))
-            self.adjust_balance(uid, charged, require_non_negative=False)
-            return {"user_id": uid, "amount": money(charged)}
+    async def get_deposit(self, deposit_id: int) -> Optional[Dict[str, Any]]:
+        return await self._one("deposits", {"id": f"eq.{int(deposit_id)}"})
 
-    def create_deposit(self, user_id: int, amount: Decimal) -> int:
-        resp = self.sb.table("deposits").insert({"user_id": int(user_id), "amount": money(dec(amount)), "status": "awaiting_proof", "created_at": now_ts(), "updated_at": now_ts()}).execute()
-        row = self._one(resp)
-        if not row:
-            raise RuntimeError("failed to create deposit")
-        return int(row["id"])
+    async def latest_open_deposit_for_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return await self._one("deposits", {"user_id": f"eq.{int(user_id)}", "status": "eq.awaiting_proof", "order": "created_at.desc"})
 
-    def set_deposit_proof(self, deposit_id: int, txid: str, screenshot_file_id: str) -> None:
-        self.sb.table("deposits").update({"txid": txid, "screenshot_file_id": screenshot_file_id, "status": "pending", "updated_at": now_ts()}).eq("id", int(deposit_id)).execute()
+    async def update_deposit_status(self, deposit_id: int, status: str, reviewed_by: int, note: Optional[str] = None) -> bool:
+        ok = await self._rpc(
+            "bot_review_deposit",
+            {"p_deposit_id": int(deposit_id), "p_status": status, "p_reviewed_by": int(reviewed_by), "p_note": note},
+        )
+        return bool(ok)
 
-    def get_deposit(self, deposit_id: int) -> Optional[Dict[str, Any]]:
-        return self._one(self.sb.table("deposits").select("*").eq("id", int(deposit_id)).limit(1).execute())
 
-    def latest_open_deposit_for_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        return self._one(self.sb.table("deposits").select("*").eq("user_id", int(user_id)).eq("status", "awaiting_proof").order("created_at", desc=True).limit(1).execute())
+class Repository(Protocol):
+    async def init(self) -> None: ...
+    async def close(self) -> None: ...
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]: ...
+    async def upsert(
+        self,
+        user_id: int,
+        chat_id: int,
+        lang: Optional[str] = None,
+        role: Optional[str] = None,
+        username: Optional[str] = None,
+        full_name: Optional[str] = None,
+    ) -> Dict[str, Any]: ...
+    async def set_lang(self, user_id: int, chat_id: int, lang: str) -> None: ...
+    async def ensure_admin_user(self, user_id: int) -> None: ...
+    async def mark_approval_notified(self, user_id: int) -> None: ...
+    async def clear_chat(self, user_id: int) -> None: ...
+    async def set_role(self, user_id: int, role: str, approved_by: Optional[int] = None) -> None: ...
+    async def list_users_page(
+        self,
+        after: Optional[Tuple[int, int]] = None,
+        limit: int = USER_PAGE_SIZE,
+        role: Optional[str] = None,
+        exclude_role: Optional[str] = None,
+        columns: str = "*",
+    ) -> List[Dict[str, Any]]: ...
+    async def user_stats(self) -> Dict[str, int]: ...
+    async def get_setting(self, key: str, default: Optional[str] = None) -> Optional[str]: ...
+    async def set_setting(self, key: str, value: str) -> None: ...
+    async def get_profit_percent(self) -> Decimal: ...
+    async def set_profit_percent(self, pct: Decimal) -> None: ...
+    async def get_payment_settings(self) -> Dict[str, str]: ...
+    async def update_payment_settings(self, items: Dict[str, str]) -> Dict[str, str]: ...
+    async def adjust_balance(self, user_id: int, delta: Decimal, require_non_negative: bool = False) -> Optional[Decimal]: ...
+    async def get_balance(self, user_id: int) -> Decimal: ...
+    async def set_activation(
+        self, user_id: int, chat_id: int, aid: str, service: str, country: str, provider_id: Optional[str], phone: str
+    ) -> None: ...
+    async def clear_activation(self, user_id: int) -> None: ...
+    async def active_rows(self) -> List[Dict[str, Any]]: ...
+    async def add_activation(
+        self,
+        user_id: int,
+        chat_id: int,
+        activation_id: str,
+        service_code: str,
+        country_code: str,
+        provider_id: Optional[str],
+        phone: str,
+        base_price: Any = 0,
+        charged_price: Any = 0,
+    ) -> None: ...
+    async def get_activation(self, activation_id: str) -> Optional[Dict[str, Any]]: ...
+    async def get_activations(self, activation_ids: List[str]) -> List[Dict[str, Any]]: ...
+    async def set_activation_status(self, activation_id: str, status: str, otp_code: Optional[str] = None) -> None: ...
+    async def list_active_activations(self) -> List[Dict[str, Any]]: ...
+    async def expire_activations(self, activation_ids: List[str]) -> List[Dict[str, Any]]: ...
+    async def latest_active_activation_for_user(self, user_id: int) -> Optional[Dict[str, Any]]: ...
+    async def refund_activation_if_needed(self, activation_id: str) -> Optional[Dict[str, Any]]: ...
+    async def create_deposit(self, user_id: int, amount: Decimal) -> int: ...
+    async def set_deposit_proof(self, deposit_id: int, txid: str, screenshot_file_id: str) -> None: ...
+    async def get_deposit(self, deposit_id: int) -> Optional[Dict[str, Any]]: ...
+    async def latest_open_deposit_for_user(self, user_id: int) -> Optional[Dict[str, Any]]: ...
+    async def update_deposit_status(self, deposit_id: int, status: str, reviewed_by: int, note: Optional[str] = None) -> bool: ...
 
-    def update_deposit_status(self, deposit_id: int, status: str, reviewed_by: int, note: Optional[str] = None) -> bool:
-        dep = self.get_deposit(deposit_id)
-        if not dep:
-            return False
-        if str(dep.get("status")) not in {"pending", "awaiting_proof"}:
-            return False
-        self.sb.table("deposits").update({"status": status, "reviewed_by": int(reviewed_by), "reviewed_at": now_ts(), "note": note, "updated_at": now_ts()}).eq("id", int(deposit_id)).execute()
-        if status == "approved":
-            self.adjust_balance(int(dep.get("user_id")), dec(dep.get("amount", "0")), require_non_negative=False)
-        return True
+
+REPOSITORY_METHODS = tuple(n for n in vars(Repository) if not n.startswith("_"))
+
+
+class AsyncRepository:
+    def __init__(self, backend: Any, workers: int = 8):
+        self.backend = backend
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="repo")
+
+    def __getattr__(self, name: str) -> Callable[..., Awaitable[Any]]:
+        if name.startswith("_") or name not in REPOSITORY_METHODS:
+            raise AttributeError(name)
+        fn = getattr(self.backend, name)
+
+        async def call(*args: Any, **kwargs: Any) -> Any:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+        setattr(self, name, call)
+        return call
+
+    async def init(self) -> None:
+        return None
+
+    async def close(self) -> None:
+        close = getattr(self.backend, "close", None)
+        if close:
+            await asyncio.get_running_loop().run_in_executor(self.executor, close)
+        self.executor.shutdown(wait=False)
+
+
+def open_repository(backend: str = STORAGE_BACKEND, sqlite_path: str = SQLITE_PATH) -> Repository:
+    if backend == "postgrest":
+        return SupabaseRESTDB()
+    if backend == "postgres":
+        return AsyncRepository(SupabaseDB(build_supabase_pg_dsn()), workers=max(SUPABASE_DB_POOL_MAX, 1))
+    if backend == "sqlite":
+        return AsyncRepository(DB(sqlite_path), workers=SQLITE_READERS)
+    raise SystemExit(f"Unknown STORAGE_BACKEND {backend!r}; use one of: {', '.join(STORAGE_BACKENDS)}")
+
+
+class UserRowCache:
+    def __init__(self, db: Any, ttl: float = USER_CACHE_TTL_SECONDS, size: int = USER_CACHE_SIZE):
+        self.db = db
+        self.ttl = ttl
+        self.size = max(1, size)
+        self.rows: "OrderedDict[int, Tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+        self.seq = 0
+        self.floor = 0
+        self.versions: "OrderedDict[int, int]" = OrderedDict()
+        self.owners: "OrderedDict[str, int]" = OrderedDict()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.db, name)
+
+    def _put(self, user_id: int, row: Optional[Dict[str, Any]]) -> None:
+        if self.ttl <= 0:
+            return
+        self.rows[user_id] = (time.monotonic() + self.ttl, row)
+        self.rows.move_to_end(user_id)
+        while len(self.rows) > self.size:
+            self.rows.popitem(last=False)
+
+    def version(self, user_id: int) -> int:
+        return max(self.versions.get(int(user_id), 0), self.floor)
+
+    def invalidate(self, user_id: Optional[int] = None) -> None:
+        self.seq += 1
+        if user_id is None:
+            self.floor = self.seq
+            self.versions.clear()
+            self.rows.clear()
+            return
+        uid = int(user_id)
+        self.versions[uid] = self.seq
+        self.versions.move_to_end(uid)
+        while len(self.versions) > self.size:
+            self.floor = max(self.floor, self.versions.popitem(last=False)[1])
+        self.rows.pop(uid, None)
+
+    def _own(self, activation_id: str, user_id: int) -> None:
+        self.owners[str(activation_id)] = int(user_id)
+        self.owners.move_to_end(str(activation_id))
+        while len(self.owners) > self.size:
+            self.owners.popitem(last=False)
+
+    def _invalidate_activations(self, activation_ids: List[str]) -> None:
+        ids = {str(x) for x in activation_ids}
+        hit = {uid for uid, (_, row) in self.rows.items() if row and str(row.get("activation_id") or "") in ids}
+        unknown = False
+        for aid in ids:
+            uid = self.owners.get(aid)
+            if uid is None:
+                unknown = True
+            else:
+                hit.add(uid)
+        for uid in hit:
+            self.invalidate(uid)
+        if unknown:
+            self.seq += 1
+            self.floor = self.seq
+
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        uid = int(user_id)
+        hit = self.rows.get(uid)
+        if hit and hit[0] > time.monotonic():
+            return dict(hit[1]) if hit[1] else None
+        seq = self.seq
+        row = await self.db.get(uid)
+        if self.version(uid) <= seq:
+            self._put(uid, dict(row) if row else None)
+        return row
+
+    async def _write(self, user_id: int, fn: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            self.invalidate(user_id)
+
+    async def upsert(self, user_id: int, *args: Any, **kwargs: Any) -> Dict[str, Any]:
+        row = await self._write(user_id, self.db.upsert, user_id, *args, **kwargs)
+        if row:
+            self._put(int(user_id), dict(row))
+        return row
+
+    async def set_role(self, user_id: int, *args: Any, **kwargs: Any) -> Any:
+        return await self._write(user_id, self.db.set_role, user_id, *args, **kwargs)
+
+    async def set_lang(self, user_id: int, *args: Any, **kwargs: Any) -> Any:
+        return await self._write(user_id, self.db.set_lang, user_id, *args, **kwargs)
+
+    async def adjust_balance(self, user_id: int, *args: Any, **kwargs: Any) -> Any:
+        return await self._write(user_id, self.db.adjust_balance, user_id, *args, **kwargs)
+
+    async def mark_approval_notified(self, user_id: int, *args: Any, **kwargs: Any) -> Any:
+        return await self._write(user_id, self.db.mark_approval_notified, user_id, *args, **kwargs)
+
+    async def clear_chat(self, user_id: int) -> Any:
+        return await self._write(user_id, self.db.clear_chat, user_id)
+
+    async def ensure_admin_user(self, user_id: int, *args: Any, **kwargs: Any) -> Any:
+        return await self._write(user_id, self.db.ensure_admin_user, user_id, *args, **kwargs)
+
+    async def set_activation(self, user_id: int, chat_id: int, aid: str, *args: Any, **kwargs: Any) -> Any:
+        self._own(aid, user_id)
+        return await self._write(user_id, self.db.set_activation, user_id, chat_id, aid, *args, **kwargs)
+
+    async def add_activation(self, user_id: int, chat_id: int, activation_id: str, *args: Any, **kwargs: Any) -> Any:
+        self._own(activation_id, user_id)
+        return await self.db.add_activation(user_id, chat_id, activation_id, *args, **kwargs)
+
+    async def clear_activation(self, user_id: int, *args: Any, **kwargs: Any) -> Any:
+        return await self._write(user_id, self.db.clear_activation, user_id, *args, **kwargs)
+
+    async def set_activation_status(self, activation_id: str, *args: Any, **kwargs: Any) -> Any:
+        try:
+            return await self.db.set_activation_status(activation_id, *args, **kwargs)
+        finally:
+            self._invalidate_activations([activation_id])
+
+    async def expire_activations(self, activation_ids: List[str]) -> List[Dict[str, Any]]:
+        try:
+            return await self.db.expire_activations(activation_ids)
+        finally:
+            self._invalidate_activations(activation_ids)
+
+    async def refund_activation_if_needed(self, activation_id: str) -> Optional[Dict[str, Any]]:
+        out = await self.db.refund_activation_if_needed(activation_id)
+        if out:
+            self.invalidate(int(out["user_id"]))
+        return out
+
+    async def update_deposit_status(self, deposit_id: int, *args: Any, **kwargs: Any) -> bool:
+        ok = await self.db.update_deposit_status(deposit_id, *args, **kwargs)
+        if ok:
+            dep = await self.db.get_deposit(deposit_id)
+            self.invalidate(int(dep["user_id"]) if dep else None)
+        return ok
+
+
+async def get_user_row(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> Optional[Dict[str, Any]]:
+    db = context.application.bot_data["db"]
+    slot = getattr(context, "user_rows", None)
+    if slot is None:
+        slot = context.user_rows = {}
+    gen = db.version(user_id) if hasattr(db, "version") else 0
+    hit = slot.get(int(user_id))
+    if hit is None or hit[0] != gen:
+        hit = slot[int(user_id)] = (gen, await db.get(int(user_id)))
+    return hit[1]
+
+
+class RequestScheduler:
+    def __init__(self, rps: float = API_MAX_RPS):
+        self.bucket = TokenBucket(rps)
+        self.queue: List[Tuple[int, int, asyncio.Future]] = []
+        self.seq = 0
+        self.task: Optional[asyncio.Task] = None
+        self.waited = {p: 0 for p in API_PRIORITY_NAMES}
+
+    def depth(self) -> Dict[str, int]:
+        out = {name: 0 for name in API_PRIORITY_NAMES.values()}
+        for prio, _, fut in self.queue:
+            if not fut.done():
+                out[API_PRIORITY_NAMES[prio]] += 1
+        return out
+
+    async def acquire(self, priority: int) -> None:
+        if not self.queue and self.bucket.take():
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        heapq.heappush(self.queue, (priority, self.seq, fut))
+        self.waited[priority] += 1
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._pump())
+        await fut
+
+    async def _pump(self) -> None:
+        while self.queue:
+            if self.queue[0][2].done():
+                heapq.heappop(self.queue)
+                continue
+            if self.bucket.take():
+                heapq.heappop(self.queue)[2].set_result(None)
+                continue
+            await asyncio.sleep(max(0.005, (1.0 - self.bucket.tokens) / self.bucket.rate))
+
+
+class EndpointHealth:
+    def __init__(self, url: str):
+        self.url = url
+        self.latency = 1.0
+        self.errors = 0.0
+        self.fails = 0
+        self.open_until = 0.0
+        self.samples: deque = deque(maxlen=100)
+
+    def ok(self, dt: float) -> None:
+        self.latency = 0.8 * self.latency + 0.2 * dt
+        self.errors *= 0.8
+        self.fails = 0
+        self.open_until = 0.0
+        self.samples.append(dt)
+
+    def fail(self) -> None:
+        self.errors = 0.8 * self.errors + 0.2
+        self.fails += 1
+        if self.fails >= API_BREAKER_FAILURES:
+            self.open_until = time.monotonic() + API_BREAKER_COOLDOWN_SECONDS
+
+    @property
+    def closed(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    @property
+    def score(self) -> float:
+        return self.latency * (1.0 + 4.0 * self.errors)
+
+    def p95(self) -> float:
+        if len(self.samples) < 5:
+            return 1.0
+        xs = sorted(self.samples)
+        return xs[min(len(xs) - 1, int(len(xs) * 0.95))]
 
 
 class TemplineAPI:
@@ -1874,7 +2888,16 @@ class TemplineAPI:
         self.key = api_key
         self.base = base_url
         self.base_urls = self._build_base_urls(base_url)
-        self.http = httpx.AsyncClient(timeout=httpx.Timeout(12.0, connect=6.0), follow_redirects=True)
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(12.0, connect=6.0),
+            limits=http_limits(),
+            http2=http2_enabled(),
+            follow_redirects=True,
+        )
+        self.health = {u: EndpointHealth(u) for u in self.base_urls}
+        self.retry_budget = TokenBucket(API_RETRY_BUDGET_RPS, API_RETRY_BUDGET_RPS * 5)
+        self.scheduler = RequestScheduler()
+        self.price_pref: Dict[str, Tuple[str, float]] = {}
 
     @staticmethod
     def _build_base_urls(primary: str) -> List[str]:
@@ -1904,22 +2927,111 @@ class TemplineAPI:
     async def close(self) -> None:
         await self.http.aclose()
 
-    async def call(self, action: str, **kwargs: Any) -> Any:
-        params = {"api_key": self.key, "action": action}
-        params.update({k: v for k, v in kwargs.items() if v is not None and v != ""})
-        last = None
-        for base in self.base_urls:
-            for _ in range(2):
+    def _ranked(self, tried: List[str]) -> List[EndpointHealth]:
+        eps = [self.health[u] for u in self.base_urls]
+        return sorted(eps, key=lambda h: (h.url in tried, not h.closed, h.open_until if not h.closed else h.score))
+
+    async def _send(self, ep: EndpointHealth, params: Dict[str, Any], priority: int) -> Any:
+        await self.scheduler.acquire(priority)
+        t0 = time.monotonic()
+        try:
+            r = await self.http.get(ep.url, params=params)
+            r.raise_for_status()
+        except Exception:
+            ep.fail()
+            raise
+        ep.ok(time.monotonic() - t0)
+        return json_maybe(r.text.strip())
+
+    async def _hedged(self, ep: EndpointHealth, backup: EndpointHealth, params: Dict[str, Any], priority: int) -> Any:
+        first = asyncio.create_task(self._send(ep, params, priority))
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=ep.p95())
+            if not done and backup.closed:
+                tasks.append(asyncio.create_task(self._send(backup, params, priority)))
+            last: Optional[BaseException] = None
+            for fut in asyncio.as_completed(tasks):
                 try:
-                    r = await self.http.get(base, params=params)
-                    r.raise_for_status()
-                    return json_maybe(r.text.strip())
+                    return await fut
                 except Exception as e:
                     last = e
-                    await asyncio.sleep(0.35)
-            logger.warning("API endpoint failed for action=%s url=%s err=%s", action, base, last)
+            raise last or RuntimeError("hedged request failed")
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    async def call(self, action: str, priority: Optional[int] = None, **kwargs: Any) -> Any:
+        if priority is None:
+            priority = API_ACTION_PRIORITY.get(action, API_PRIORITY_BROWSE)
+        params = {"api_key": self.key, "action": action}
+        params.update({k: v for k, v in kwargs.items() if v is not None and v != ""})
+        hedge = API_HEDGE_REQUESTS and action in API_HEDGE_ACTIONS and len(self.base_urls) > 1
+        last = None
+        tried: List[str] = []
+        for attempt in range(API_MAX_ATTEMPTS):
+            if attempt:
+                if not self.retry_budget.take():
+                    break
+                await asyncio.sleep(random.uniform(0, min(2.0, 0.2 * 2 ** attempt)))
+            eps = self._ranked(tried)
+            ep = eps[0]
+            backup = next((h for h in eps[1:] if h.closed and h.url not in tried), None) if hedge else None
+            tried.append(ep.url)
+            try:
+                if backup:
+                    return await self._hedged(ep, backup, params, priority)
+                return await self._send(ep, params, priority)
+            except Exception as e:
+                last = e
+                logger.warning("API endpoint failed for action=%s url=%s err=%s", action, ep.url, e)
         raise RuntimeError(f"request failed: {last}")
 
+    def _price_learn(self, service: str, action: Optional[str]) -> None:
+        if action is None:
+            self.price_pref.pop(service, None)
+        else:
+            self.price_pref[service] = (action, time.time() + PRICE_ACTION_TTL_SECONDS)
+
+    async def _try_prices(self, action: str, service: str) -> Tuple[str, Any]:
+        try:
+            payload = await self.call(action, service=service)
+        except Exception:
+            return action, None
+        return action, payload if isinstance(payload, (dict, list)) and payload else None
+
+    def metrics(self) -> str:
+        lines = [f'templine_queue_depth{{priority="{k}"}} {v}' for k, v in self.scheduler.depth().items()]
+        lines += [f'templine_queued_total{{priority="{API_PRIORITY_NAMES[k]}"}} {v}' for k, v in self.scheduler.waited.items()]
+        for h in self.health.values():
+            lines.append(f'templine_endpoint_latency_seconds{{url="{h.url}"}} {h.latency:.3f}')
+            lines.append(f'templine_endpoint_open{{url="{h.url}"}} {0 if h.closed else 1}')
+        return "\n".join(lines) + "\n"
+
+    async def get_prices(self, service: str) -> Any:
+        pref = self.price_pref.get(service)
+        tried = None
+        if pref and pref[1] > time.time():
+            tried = pref[0]
+            _, payload = await self._try_prices(tried, service)
+            if payload is not None:
+                return payload
+            self.price_pref.pop(service, None)
+        race = [a for a in PRICE_ACTIONS[:2] if a != tried]
+        for action, payload in await asyncio.gather(*(self._try_prices(a, service) for a in race)):
+            if payload is not None:
+                self._price_learn(service, action)
+                return payload
+        for a in PRICE_ACTIONS[2:]:
+            if a == tried:
+                continue
+            action, payload = await self._try_prices(a, service)
+            if payload is not None:
+                self._price_learn(service, action)
+                return payload
+        self._price_learn(service, None)
+        return None
+
 
 def parse_services(payload: Any) -> List[Dict[str, str]]:
     items: List[Dict[str, str]] = []
@@ -2097,59 +3209,189 @@ def parse_status(payload: Any) -> Tuple[str, Optional[str]]:
     return "ERROR", "UNKNOWN"
 
 
-def api_error(lang: str, raw: str) -> str:
-    key = ERR_MAP.get(raw, "generic_fail")
-    return tt(lang, key) if key in TR["en"] else f"{tt(lang, 'generic_fail')} ({raw})"
+def parse_sms_webhook(payload: Any) -> Tuple[Optional[str], Optional[str]]:
+    if not isinstance(payload, dict):
+        return None, None
+    aid = payload.get("activationId") or payload.get("activation_id") or payload.get("id")
+    code = str(payload.get("code") or payload.get("otp") or "").strip()
+    if not code:
+        m = re.search(r"\b\d{4,8}\b", str(payload.get("text") or ""))
+        code = m.group(0) if m else ""
+    if not aid or not code:
+        return None, None
+    return str(aid).strip(), code
+
+
+def api_error(lang: str, raw: str) -> str:
+    key = ERR_MAP.get(raw, "generic_fail")
+    return tt(lang, key) if key in TR["en"] else f"{tt(lang, 'generic_fail')} ({raw})"
+
+
+def norm(s: str) -> str:
+    return re.sub(r"\s+", " ", s.strip().lower())
+
+
+def _trigrams(s: str) -> set:
+    s = f" {s} "
+    return {s[i : i + 3] for i in range(len(s) - 2)}
+
+
+class ServiceIndex:
+    def __init__(self, services: List[Dict[str, str]]):
+        self.items: List[Dict[str, str]] = []
+        self.names: List[str] = []
+        self.codes: Dict[str, int] = {}
+        self.grams: Dict[str, List[int]] = {}
+        tokens: List[Tuple[str, int]] = []
+        for s in services:
+            code = norm(s["code"])
+            if code in self.codes:
+                continue
+            i = len(self.items)
+            name = norm(s["name"])
+            self.items.append(s)
+            self.names.append(name)
+            self.codes[code] = i
+            for g in _trigrams(name):
+                self.grams.setdefault(g, []).append(i)
+            tokens.extend((t, i) for t in re.split(r"[^\w]+", name) if t)
+        self.tokens = sorted(tokens)
+        self.aliases: Dict[str, List[str]] = {}
+        for canon, aliases in SERVICE_ALIAS.items():
+            for a in (canon, *aliases):
+                self.aliases.setdefault(norm(a), []).append(canon)
+        self.memo: "OrderedDict[str, List[Dict[str, str]]]" = OrderedDict()
+
+    def _token_prefix(self, q: str) -> List[int]:
+        out = []
+        i = bisect.bisect_left(self.tokens, (q, -1))
+        while i < len(self.tokens) and self.tokens[i][0].startswith(q):
+            out.append(self.tokens[i][1])
+            i += 1
+        return out
+
+    def _substring(self, q: str) -> List[int]:
+        if len(q) < 3:
+            return [i for i, name in enumerate(self.names) if q in name]
+        grams = sorted(_trigrams(q) - {f" {q[:2]}", f"{q[-2:]} "}, key=lambda g: len(self.grams.get(g, ())))
+        if not grams:
+            return []
+        cand = set(self.grams.get(grams[0], ()))
+        for g in grams[1:]:
+            cand.intersection_update(self.grams.get(g, ()))
+            if not cand:
+                return []
+        return [i for i in cand if q in self.names[i]]
+
+    def _fuzzy(self, q: str) -> Dict[int, float]:
+        qg = _trigrams(q)
+        hits: Dict[int, int] = {}
+        for g in qg:
+            for i in self.grams.get(g, ()):
+                hits[i] = hits.get(i, 0) + 1
+        out = {}
+        for i, n in hits.items():
+            sim = n / (len(qg) + len(_trigrams(self.names[i])) - n)
+            if sim >= 0.3:
+                out[i] = sim
+        return out
+
+    def search(self, query: str) -> List[Dict[str, str]]:
+        q = norm(query)
+        if not q:
+            return []
+        if q in self.memo:
+            self.memo.move_to_end(q)
+            return self.memo[q]
+        score: Dict[int, float] = {}
+
+        def hit(i: int, v: float) -> None:
+            if v > score.get(i, 0.0):
+                score[i] = v
+
+        if q in self.codes:
+            hit(self.codes[q], 100.0)
+        for i in self._substring(q):
+            hit(i, 95.0 if self.names[i] == q else 80.0 if self.names[i].startswith(q) else 60.0)
+        for i in self._token_prefix(q):
+            hit(i, 70.0)
+        for canon in self.aliases.get(q, ()):
+            for i in self._substring(canon):
+                hit(i, 90.0)
+        if len(q) >= 3:
+            for i, sim in self._fuzzy(q).items():
+                hit(i, 50.0 * sim)
+        out = [self.items[i] for i in sorted(score, key=lambda i: (-score[i], len(self.names[i]), self.names[i]))]
+        self.memo[q] = out
+        while len(self.memo) > 512:
+            self.memo.popitem(last=False)
+        return out
 
 
-def norm(s: str) -> str:
-    return re.sub(r"\s+", " ", s.strip().lower())
+def match_services(query: str, services: List[Dict[str, str]], index: Optional[ServiceIndex] = None) -> List[Dict[str, str]]:
+    return (index or ServiceIndex(services)).search(query)
 
 
-def match_services(query: str, services: List[Dict[str, str]]) -> List[Dict[str, str]]:
-    q = norm(query)
-    if not q:
-        return []
-    canon_hits = {c for c, aliases in SERVICE_ALIAS.items() if q == c or q in aliases}
-    out = []
-    for s in services:
-        name = norm(s["name"])
-        code = norm(s["code"])
-        if q in name or q == code:
-            out.append(s)
-            continue
-        if any(c in name for c in canon_hits):
-            out.append(s)
-    seen, uniq = set(), []
-    for x in out:
-        if x["code"] in seen:
-            continue
-        seen.add(x["code"])
-        uniq.append(x)
-    return uniq
+_PRICE_KEYS = ("cost", "price", "activationCost", "activation_cost")
+_CONTAINERS = (dict, list)
 
 
-def _collect_price_nodes(rows: List[Dict[str, Any]], country: str, node: Any, hint: Optional[str] = None) -> None:
-    if isinstance(node, dict):
-        price = None
-        for k in ("cost", "price", "activationCost", "activation_cost"):
-            if k in node:
-                price = node.get(k)
-                break
-        if price is not None:
-            pid = node.get("providerId") or node.get("provider_id")
-            pname = node.get("providerName") or node.get("provider_name") or node.get("provider") or node.get("operator")
-            if pid is None and hint and hint.isdigit():
-                pid = hint
-            if pname is None and hint and not hint.isdigit():
-                pname = hint
-            rows.append({"country": country, "price": str(price), "pid": pid, "pname": pname})
+def _price_of(node: Dict[str, Any]) -> Any:
+    for k in _PRICE_KEYS:
+        if k in node:
+            return node[k]
+    return None
+
+
+def _price_row(rows: List[Tuple[str, Any, Any, Any]], country: str, node: Dict[str, Any], price: Any, hint: Optional[str]) -> None:
+    pid = node.get("providerId") or node.get("provider_id")
+    pname = node.get("providerName") or node.get("provider_name") or node.get("provider") or node.get("operator")
+    if pid is None and hint and hint.isdigit():
+        pid = hint
+    if pname is None and hint and not hint.isdigit():
+        pname = hint
+    rows.append((country, price, pid, pname))
+
+
+def _is_leaf(node: Dict[str, Any]) -> bool:
+    for v in node.values():
+        if isinstance(v, _CONTAINERS):
+            return False
+    return True
+
+
+def _price_sort_key(price: str) -> float:
+    head, dot, tail = price.partition(".")
+    return float(price) if head.isdecimal() and (not dot or tail.isdecimal()) else 999999.0
+
+
+def _collect_price_nodes(rows: List[Tuple[str, Any, Any, Any]], country: str, node: Any) -> None:
+    if isinstance(node, dict) and _price_of(node) is None:
+        flat = []
         for k, v in node.items():
-            if isinstance(v, (dict, list)):
-                _collect_price_nodes(rows, country, v, str(k))
-    elif isinstance(node, list):
-        for v in node:
-            _collect_price_nodes(rows, country, v, hint)
+            if not isinstance(v, dict) or not _is_leaf(v):
+                break
+            flat.append((k, v))
+        else:
+            for k, v in flat:
+                price = _price_of(v)
+                if price is not None:
+                    _price_row(rows, country, v, price, str(k))
+            return
+    elif isinstance(node, dict) and _is_leaf(node):
+        _price_row(rows, country, node, _price_of(node), None)
+        return
+    stack: List[Tuple[Any, Optional[str]]] = [(node, None)]
+    while stack:
+        cur, hint = stack.pop()
+        if isinstance(cur, dict):
+            price = _price_of(cur)
+            if price is not None:
+                _price_row(rows, country, cur, price, hint)
+            kids = [(v, str(k)) for k, v in cur.items() if isinstance(v, (dict, list))]
+            stack.extend(reversed(kids))
+        elif isinstance(cur, list):
+            stack.extend((v, hint) for v in reversed(cur) if isinstance(v, (dict, list)))
 
 
 def parse_prices(
@@ -2160,7 +3402,7 @@ def parse_prices(
     lang: str,
 ) -> List[PriceOption]:
     data = payload["data"] if isinstance(payload, dict) and isinstance(payload.get("data"), (dict, list)) else payload
-    rows: List[Dict[str, Any]] = []
+    rows: List[Tuple[str, Any, Any, Any]] = []
     if isinstance(data, dict):
         for c, v in data.items():
             if str(c).lower() in {"status", "success", "message", "error"}:
@@ -2175,55 +3417,106 @@ def parse_prices(
             if cc:
                 _collect_price_nodes(rows, cc, v)
 
-    dedupe, out = set(), []
-    for r in rows:
-        cc, price = str(r["country"]).strip(), str(r["price"]).strip()
+    fallback = tt(lang, "fallback_country")
+    cinfo: Dict[str, Tuple[str, Optional[str]]] = {}
+    nums: Dict[str, float] = {}
+    dedupe: set = set()
+    out: List[PriceOption] = []
+    keys: List[float] = []
+    for cc, price, pid, pname in rows:
+        cc, price = cc.strip(), str(price).strip()
         if not cc or not price:
             continue
-        key = (cc, str(r.get("pid") or ""), str(r.get("pname") or ""), price)
+        key = (cc, str(pid or ""), str(pname or ""), price)
         if key in dedupe:
             continue
         dedupe.add(key)
-        c = countries.get(cc, {})
+        info = cinfo.get(cc)
+        if info is None:
+            c = countries.get(cc, {})
+            info = cinfo[cc] = (str(c.get("name") or fallback), c.get("iso2"))
+        num = nums.get(price)
+        if num is None:
+            num = nums[price] = _price_sort_key(price)
+        keys.append(num)
         out.append(
             PriceOption(
-                service_code=service_code,
-                service_name=service_name,
-                country_code=cc,
-                country_name=str(c.get("name") or tt(lang, "fallback_country")),
-                country_iso2=c.get("iso2"),
-                provider_id=str(r.get("pid")) if r.get("pid") else None,
-                provider_name=str(r.get("pname")) if r.get("pname") else None,
-                price=price,
-                base_price=price,
+                service_code,
+                service_name,
+                cc,
+                info[0],
+                info[1],
+                str(pid) if pid else None,
+                str(pname) if pname else None,
+                price,
+                price,
             )
         )
-    out.sort(key=lambda x: (float(x.price) if re.match(r"^\d+(\.\d+)?$", x.price) else 999999.0, x.country_name))
-    return out
+    order = sorted(range(len(out)), key=lambda i: out[i].country_name)
+    order.sort(key=keys.__getitem__)
+    return [out[i] for i in order]
+
+
+class PriceTable:
+    __slots__ = ("rows", "base")
+
+    def __init__(self, rows: List[PriceOption]):
+        self.rows = rows
+        self.base = [dec(x.base_price or x.price, "0") for x in rows]
+
+
+class PriceView:
+    __slots__ = ("table", "mult", "cache")
+
+    def __init__(self, table: PriceTable, role: str, profit_pct: Decimal):
+        self.table = table
+        self.mult = Decimal("1") + (profit_pct / Decimal("100")) if role == ROLE_USER else None
+        self.cache: Dict[int, PriceOption] = {}
+
+    def __len__(self) -> int:
+        return len(self.table.rows)
+
+    def __bool__(self) -> bool:
+        return bool(self.table.rows)
+
+    def __getitem__(self, i: int) -> PriceOption:
+        opt = self.cache.get(i)
+        if opt is None:
+            x, base = self.table.rows[i], self.table.base[i]
+            final = (base * self.mult).quantize(Decimal("0.001"), rounding=ROUND_HALF_UP) if self.mult is not None else base
+            opt = self.cache[i] = PriceOption(
+                x.service_code,
+                x.service_name,
+                x.country_code,
+                x.country_name,
+                x.country_iso2,
+                x.provider_id,
+                x.provider_name,
+                money(final),
+                money(base),
+            )
+        return opt
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def find(self, service_code: str, country_code: str, provider_token: str) -> Optional[PriceOption]:
+        exact = loose = None
+        for i, x in enumerate(self.table.rows):
+            if str(x.service_code) != service_code or str(x.country_code) != country_code:
+                continue
+            pid = str(x.provider_id or "none")
+            if pid == provider_token:
+                exact = i
+            if pid == "none":
+                loose = i
+        hit = exact if exact is not None else loose
+        return self[hit] if hit is not None else None
 
 
 def apply_role_prices(opts: List[PriceOption], role: str, profit_pct: Decimal) -> List[PriceOption]:
-    out: List[PriceOption] = []
-    mult = Decimal("1") + (profit_pct / Decimal("100"))
-    for x in opts:
-        base = dec(x.base_price or x.price, "0")
-        final = base
-        if role == ROLE_USER:
-            final = (base * mult).quantize(Decimal("0.001"), rounding=ROUND_HALF_UP)
-        out.append(
-            PriceOption(
-                service_code=x.service_code,
-                service_name=x.service_name,
-                country_code=x.country_code,
-                country_name=x.country_name,
-                country_iso2=x.country_iso2,
-                provider_id=x.provider_id,
-                provider_name=x.provider_name,
-                price=money(final),
-                base_price=money(base),
-            )
-        )
-    return out
+    return list(PriceView(PriceTable(opts), role, profit_pct))
 
 
 async def ensure_user(update: Update, db: Any) -> Tuple[int, int, str, str, bool]:
@@ -2233,11 +3526,10 @@ async def ensure_user(update: Update, db: Any) -> Tuple[int, int, str, str, bool
         raise RuntimeError("missing user/chat")
     username = user.username or ""
     full_name = user.full_name or ""
-    old = await adb(db.get, user.id)
+    old = await db.get(user.id)
     if old:
         forced_role = ROLE_ADMIN if user.id == ADMIN_USER_ID else None
-        row = await adb(
-            db.upsert,
+        row = await db.upsert(
             user.id,
             chat.id,
             lang=None,
@@ -2248,8 +3540,7 @@ async def ensure_user(update: Update, db: Any) -> Tuple[int, int, str, str, bool
         return user.id, chat.id, lang_from_code(row.get("lang")), role_of(row), False
     lg = lang_from_code(user.language_code)
     initial_role = ROLE_ADMIN if user.id == ADMIN_USER_ID else ROLE_PENDING
-    row = await adb(
-        db.upsert,
+    row = await db.upsert(
         user.id,
         chat.id,
         lg,
@@ -2260,28 +3551,233 @@ async def ensure_user(update: Update, db: Any) -> Tuple[int, int, str, str, bool
     return user.id, chat.id, lg, role_of(row), True
 
 
+class CatalogEntry:
+    def __init__(
+        self,
+        name: str,
+        fetch: Callable[[], Awaitable[Any]],
+        ttl: float,
+        retry: float = 30.0,
+        on_update: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        self.name = name
+        self.fetch = fetch
+        self.ttl = ttl
+        self.retry = retry
+        self.on_update = on_update
+        self.value: Any = None
+        self.ts = 0.0
+        self.retry_at = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    def refresh(self) -> asyncio.Task:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._refresh())
+            self.task.add_done_callback(self._done)
+        return self.task
+
+    def _done(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+        e = task.exception()
+        if e is not None and self.value is not None:
+            logger.warning("%s refresh failed, serving last good copy: %s", self.name, e)
+
+    async def _refresh(self) -> Any:
+        try:
+            value = await self.fetch()
+            if not value:
+                raise RuntimeError(f"{self.name} came back empty")
+        except Exception:
+            self.retry_at = time.time() + min(self.ttl, self.retry)
+            raise
+        self.value, self.ts, self.retry_at = value, time.time(), 0.0
+        if self.on_update:
+            try:
+                await self.on_update()
+            except Exception as e:
+                logger.warning("%s snapshot write failed: %s", self.name, e)
+        return value
+
+    async def get(self) -> Any:
+        if self.value is None:
+            return await asyncio.shield(self.refresh())
+        now = time.time()
+        if now - self.ts >= self.ttl and now >= self.retry_at:
+            self.refresh()
+        return self.value
+
+
+class CatalogManager:
+    def __init__(self, api: "TemplineAPI", snapshot_path: Optional[str] = CATALOG_SNAPSHOT_PATH):
+        self.api = api
+        self.snapshot_path = snapshot_path
+        self.snapshot_lock = asyncio.Lock()
+        self.services = CatalogEntry("services", self._fetch_services, 600, on_update=self.save_snapshot)
+        self.countries = CatalogEntry("countries", self._fetch_countries, 1800, on_update=self.save_snapshot)
+
+    def load_snapshot(self) -> bool:
+        if not self.snapshot_path:
+            return False
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snap = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning("catalog snapshot unreadable, ignoring: %s", e)
+            return False
+        if not isinstance(snap, dict) or snap.get("v") != CATALOG_SNAPSHOT_VERSION:
+            return False
+        services, countries = snap.get("services"), snap.get("countries")
+        if isinstance(services, list) and services:
+            self.services.value = self._services_value(services)
+            self.services.ts = float(snap.get("services_ts") or 0)
+        if isinstance(countries, dict) and countries:
+            self.countries.value = countries
+            self.countries.ts = float(snap.get("countries_ts") or 0)
+        return self.services.value is not None and self.countries.value is not None
+
+    def _write_snapshot(self, snap: Dict[str, Any]) -> None:
+        tmp = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snap, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+    async def save_snapshot(self) -> None:
+        if not self.snapshot_path:
+            return
+        snap = {
+            "v": CATALOG_SNAPSHOT_VERSION,
+            "services": (self.services.value or {}).get("items") or [],
+            "services_ts": self.services.ts,
+            "countries": self.countries.value or {},
+            "countries_ts": self.countries.ts,
+        }
+        async with self.snapshot_lock:
+            await asyncio.to_thread(self._write_snapshot, snap)
+
+    @staticmethod
+    def _services_value(items: List[Dict[str, str]]) -> Dict[str, Any]:
+        return {"items": items, "map": {s["code"]: s["name"] for s in items}, "index": ServiceIndex(items)}
+
+    async def _fetch_services(self) -> Dict[str, Any]:
+        items = parse_services(await self.api.call("getServicesList"))
+        return self._services_value(items) if items else {}
+
+    def search(self, query: str) -> List[Dict[str, str]]:
+        index = (self.services.value or {}).get("index")
+        return index.search(query) if index else []
+
+    async def _fetch_countries(self) -> Dict[str, Dict[str, Optional[str]]]:
+        return await asyncio.to_thread(parse_countries, await self.api.call("getCountries"))
+
+    def service_name(self, code: str) -> str:
+        return (self.services.value or {}).get("map", {}).get(code, code)
+
+    def country_map(self) -> Dict[str, Dict[str, Optional[str]]]:
+        return self.countries.value or {}
+
+    async def warm(self) -> None:
+        t0 = time.monotonic()
+        if self.load_snapshot():
+            logger.info("catalog snapshot loaded in %.1f ms", (time.monotonic() - t0) * 1000)
+            for entry in (self.services, self.countries):
+                if time.time() - entry.ts >= entry.ttl:
+                    entry.refresh()
+            return
+        for entry, res in zip(
+            (self.services, self.countries),
+            await asyncio.gather(self.services.refresh(), self.countries.refresh(), return_exceptions=True),
+        ):
+            if isinstance(res, Exception):
+                logger.warning("cache warm-up failed for %s: %s", entry.name, res)
+
+    async def stop(self) -> None:
+        for entry in (self.services, self.countries):
+            if entry.task and not entry.task.done():
+                entry.task.cancel()
+
+
+class PriceCache:
+    def __init__(self, api: "TemplineAPI", catalog: CatalogManager, ttl: float = PRICE_CACHE_TTL_SECONDS, size: int = PRICE_CACHE_SIZE):
+        self.api = api
+        self.catalog = catalog
+        self.ttl = ttl
+        self.size = max(1, size)
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.inflight: Dict[str, asyncio.Task] = {}
+
+    async def _load(self, service_code: str) -> Optional[Dict[str, Any]]:
+        countries = await self.catalog.countries.get()
+        payload = await self.api.get_prices(service_code)
+        if not payload:
+            return self.entries.get(service_code)
+        snap = {"ts": time.time(), "payload": payload, "countries": countries, "views": {}}
+        self.entries[service_code] = snap
+        self.entries.move_to_end(service_code)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return snap
+
+    async def snapshot(self, service_code: str) -> Optional[Dict[str, Any]]:
+        snap = self.entries.get(service_code)
+        if snap and time.time() - snap["ts"] < self.ttl:
+            return snap
+        task = self.inflight.get(service_code)
+        if task is None:
+            task = self.inflight[service_code] = asyncio.create_task(self._load(service_code))
+            task.add_done_callback(lambda _t, k=service_code: self.inflight.pop(k, None))
+        return await asyncio.shield(task)
+
+    async def options(self, service_code: str, service_name: str, lang: str, role: str, profit_pct: Decimal) -> "PriceView | List[PriceOption]":
+        snap = await self.snapshot(service_code)
+        if not snap:
+            return []
+        views = snap["views"]
+        key = (lang, ROLE_USER if role == ROLE_USER else "", str(profit_pct) if role == ROLE_USER else "")
+        if key not in views:
+            if lang not in views:
+                views[lang] = PriceTable(parse_prices(snap["payload"], service_code, service_name, snap["countries"], lang))
+            views[key] = PriceView(views[lang], role, profit_pct)
+        return views[key]
+
+
+class BrowseStateStore:
+    def __init__(self, ttl: float = BROWSE_STATE_TTL_SECONDS, size: int = BROWSE_STATE_SIZE):
+        self.ttl = ttl
+        self.size = max(1, size)
+        self.items: "OrderedDict[Tuple[int, str], Tuple[float, Any]]" = OrderedDict()
+
+    def put(self, user_id: int, key: str, value: Any) -> None:
+        k = (int(user_id), key)
+        self.items[k] = (time.monotonic() + self.ttl, value)
+        self.items.move_to_end(k)
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def get(self, user_id: int, key: str) -> Any:
+        k = (int(user_id), key)
+        hit = self.items.get(k)
+        if hit is None:
+            return None
+        if hit[0] <= time.monotonic():
+            self.items.pop(k, None)
+            return None
+        self.items.move_to_end(k)
+        return hit[1]
+
+
 async def cached_services(context: ContextTypes.DEFAULT_TYPE) -> List[Dict[str, str]]:
-    b = context.application.bot_data
-    c = b.get("svc_cache")
-    now = time.time()
-    if c and now - c["ts"] < 600:
-        return c["items"]
-    api: TemplineAPI = b["api"]
-    items = parse_services(await api.call("getServicesList"))
-    b["svc_cache"] = {"ts": now, "items": items, "map": {s["code"]: s["name"] for s in items}}
-    return items
+    catalog: CatalogManager = context.application.bot_data["catalog"]
+    return (await catalog.services.get())["items"]
 
 
 async def cached_countries(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, Dict[str, Optional[str]]]:
-    b = context.application.bot_data
-    c = b.get("country_cache")
-    now = time.time()
-    if c and now - c["ts"] < 1800:
-        return c["items"]
-    api: TemplineAPI = b["api"]
-    items = parse_countries(await api.call("getCountries"))
-    b["country_cache"] = {"ts": now, "items": items}
-    return items
+    catalog: CatalogManager = context.application.bot_data["catalog"]
+    return await catalog.countries.get()
 
 
 def svc_keyboard(items: List[Dict[str, str]], page: int, lang: str, mode: str) -> InlineKeyboardMarkup:
@@ -2324,7 +3820,8 @@ async def show_service_list(
     title: str,
     role: str = ROLE_USER,
 ) -> None:
-    context.user_data[f"svc_{mode}"] = items
+    if update.effective_user:
+        context.application.bot_data["browse"].put(update.effective_user.id, f"svc_{mode}", items)
     pages = (len(items) - 1) // PAGE_SIZE + 1 if items else 1
     text = f"📋 *{md(title)}*\n{md(f'Page {page + 1}/{pages}')}"
     if not items:
@@ -2340,124 +3837,583 @@ async def show_service_list(
 
 async def show_prices(query, context: ContextTypes.DEFAULT_TYPE, lang: str, service_code: str, page: int = 0) -> None:
     b = context.application.bot_data
-    api: TemplineAPI = b["api"]
     db = b["db"]
-    name = b.get("svc_cache", {}).get("map", {}).get(service_code, service_code)
-    countries = await cached_countries(context)
-    payload = None
-    for a in ("getPricesV3", "getPricesV2", "getPrices"):
-        try:
-            payload = await api.call(a, service=service_code)
-            if payload:
-                break
-        except Exception:
-            continue
-    opts = parse_prices(payload, service_code, name, countries, lang) if payload else []
+    name = b["catalog"].service_name(service_code)
     user_id = query.from_user.id if query and query.from_user else 0
-    user_row = await adb(db.get, user_id) if user_id else None
+    user_row = await get_user_row(context, user_id) if user_id else None
     role = role_of(user_row)
-    profit_pct = await adb(db.get_profit_percent) if hasattr(db, "get_profit_percent") else Decimal("20")
-    opts = apply_role_prices(opts, role, profit_pct)
+    profit_pct = await db.get_profit_percent()
+    opts = await b["prices"].options(service_code, name, lang, role, profit_pct)
     if not opts:
         await query.edit_message_text(f"⚠️ {md(tt(lang, 'prices_empty'))}", parse_mode=ParseMode.MARKDOWN_V2)
         return
-    context.user_data[f"price_{service_code}"] = opts
+    context.application.bot_data["browse"].put(user_id, f"price_{service_code}", opts)
     pages = (len(opts) - 1) // PAGE_SIZE + 1
     text = f"🌍 *{md(tt(lang, 'prices', service=name))}*\n{md(f'Page {page + 1}/{pages}')}"
     await query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=price_keyboard(opts, page, lang))
 
 
-async def start_poll_task(app: Application, aid: str) -> None:
+async def send_otp(app: Application, act: Dict[str, Any], otp: str) -> None:
     db = app.bot_data["db"]
+    user_id = int(act.get("user_id"))
+    poller: Optional[ActivationPoller] = app.bot_data.get("poller")
+    if poller:
+        poller.stats.observe(act, time.time() - int(act.get("created_at") or time.time()))
+    user_row = await db.get(user_id) or {}
+    lang = lang_from_code(user_row.get("lang"))
+    kb = InlineKeyboardMarkup(
+        [
+            [copy_button(tt(lang, "copy_otp"), otp, f"cp:otp:{user_id}")],
+            [InlineKeyboardButton(tt(lang, "home"), callback_data="hm")],
+        ]
+    )
+    msg = tt(lang, "otp", otp=otp)
+    await app.bot.send_message(
+        int(act.get("chat_id")),
+        md(msg).replace(md(otp), cd(otp)),
+        parse_mode=ParseMode.MARKDOWN_V2,
+        reply_markup=kb,
+    )
+
+
+async def record_otp(app: Application, aid: str, otp: str) -> None:
     api: TemplineAPI = app.bot_data["api"]
-    tasks: Dict[str, asyncio.Task] = app.bot_data["tasks"]
+    try:
+        await api.call("setStatus", id=aid, status=6)
+    except Exception:
+        pass
+    await app.bot_data["db"].set_activation_status(aid, "otp_received", otp)
 
-    async def run() -> None:
-        while True:
-            await asyncio.sleep(POLL_SECONDS)
-            act = await adb(db.get_activation, aid)
-            if not act:
-                break
-            if act.get("status") != "active":
-                break
-            created_at = int(act.get("created_at") or time.time())
-            if int(time.time()) - created_at >= MAX_MONITOR_SECONDS:
-                await adb(db.set_activation_status, aid, "expired")
-                refund = await adb(db.refund_activation_if_needed, aid)
-                if refund:
-                    user_row = await adb(db.get, int(act.get("user_id"))) or {}
-                    lang = lang_from_code(user_row.get("lang"))
-                    await app.bot.send_message(
-                        int(act.get("chat_id")),
-                        md(tt(lang, "otp_timeout_refund", amount=refund.get("amount"))),
-                        parse_mode=ParseMode.MARKDOWN_V2,
-                        reply_markup=main_menu(lang, role_of(user_row)),
-                    )
-                break
 
-            user_id = int(act.get("user_id"))
-            chat_id = int(act.get("chat_id"))
-            user_row = await adb(db.get, user_id) or {}
-            lang = lang_from_code(user_row.get("lang"))
+async def deliver_claimed(app: Application, act: Dict[str, Any], otp: str) -> None:
+    aid = str(act["activation_id"])
+    try:
+        await send_otp(app, act, otp)
+    except Exception:
+        app.bot_data["poller"].release(aid, delay=0)
+        timers: Optional[ActivationTimers] = app.bot_data.get("timers")
+        if timers:
+            timers.add(aid, act.get("created_at"))
+        raise
+    await record_otp(app, aid, otp)
+
+
+async def finish_activation(app: Application, act: Dict[str, Any], status: str, error: Optional[str] = None) -> None:
+    db = app.bot_data["db"]
+    await db.set_activation_status(str(act["activation_id"]), status)
+    await settle_activation(app, act, status, error)
+
+
+async def settle_activation(app: Application, act: Dict[str, Any], status: str, error: Optional[str] = None) -> None:
+    db = app.bot_data["db"]
+    aid = str(act["activation_id"])
+    refund = await db.refund_activation_if_needed(aid)
+    user_row = await db.get(int(act.get("user_id"))) or {}
+    lang = lang_from_code(user_row.get("lang"))
+    if status == "expired":
+        if not refund:
+            return
+        txt = tt(lang, "otp_timeout_refund", amount=refund.get("amount"))
+    else:
+        txt = tt(lang, "cancelled") if status == "cancelled" else api_error(lang, error or "UNKNOWN")
+        if refund:
+            txt = f"{txt}\n{tt(lang, 'refund_done', amount=refund.get('amount'))}"
+    await app.bot.send_message(
+        int(act.get("chat_id")),
+        md(txt),
+        parse_mode=ParseMode.MARKDOWN_V2,
+        reply_markup=main_menu(lang, role_of(user_row)),
+    )
+
+
+class OtpArrivalStats:
+    def __init__(self, default_window: float = POLL_HOT_WINDOW_SECONDS, samples: int = 50):
+        self.default_window = max(10.0, float(default_window))
+        self.samples = samples
+        self.ages: Dict[Tuple[str, str], List[float]] = {}
+
+    @staticmethod
+    def _keys(act: Dict[str, Any]) -> List[Tuple[str, str]]:
+        svc = str(act.get("service_code") or "")
+        return [(svc, str(act.get("provider_id") or "")), (svc, "*")]
+
+    def observe(self, act: Dict[str, Any], age: float) -> None:
+        if age < 0 or age > MAX_MONITOR_SECONDS:
+            return
+        for k in self._keys(act):
+            xs = self.ages.setdefault(k, [])
+            xs.append(float(age))
+            if len(xs) > self.samples:
+                del xs[0]
+
+    def hot_window(self, act: Dict[str, Any]) -> float:
+        for k in self._keys(act):
+            xs = self.ages.get(k)
+            if xs and len(xs) >= 3:
+                p80 = sorted(xs)[int(0.8 * (len(xs) - 1))]
+                return max(30.0, min(float(MAX_MONITOR_SECONDS), p80 * 1.25))
+        return self.default_window
+
+
+class ActivationPoller:
+    def __init__(
+        self,
+        app: Application,
+        interval: float = POLL_SECONDS,
+        concurrency: int = POLL_CONCURRENCY,
+        max_interval: float = POLL_MAX_SECONDS,
+        max_rps: float = POLL_MAX_RPS,
+    ):
+        self.app = app
+        self.interval = max(1.0, float(interval))
+        self.max_interval = max(self.interval, float(max_interval))
+        self.window = min(1.0, self.interval / 4)
+        self.stats = OtpArrivalStats()
+        self.budget = TokenBucket(max_rps)
+        self.members: set = set()
+        self.due: Dict[str, float] = {}
+        self.heap: List[Tuple[float, str]] = []
+        self.inflight: Dict[str, asyncio.Task] = {}
+        self.finished: "OrderedDict[str, float]" = OrderedDict()
+        self.sem = asyncio.Semaphore(max(1, int(concurrency)))
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def track(self, aid: str, delay: Optional[float] = None) -> None:
+        aid = str(aid)
+        at = time.monotonic() + (self.interval if delay is None else max(0.0, delay))
+        at = math.ceil(at / self.window) * self.window
+        self.members.add(aid)
+        self.due[aid] = at
+        heapq.heappush(self.heap, (at, aid))
+        self.wake.set()
+
+    def discard(self, aid: str) -> None:
+        aid = str(aid)
+        self.members.discard(aid)
+        self.due.pop(aid, None)
+        tsk = self.inflight.pop(aid, None)
+        if tsk and not tsk.done():
+            tsk.cancel()
+
+    def claim(self, aid: str) -> bool:
+        aid = str(aid)
+        if aid in self.finished:
+            return False
+        self.finished[aid] = time.time()
+        while len(self.finished) > 10000:
+            self.finished.popitem(last=False)
+        self.members.discard(aid)
+        self.due.pop(aid, None)
+        timers: Optional[ActivationTimers] = self.app.bot_data.get("timers")
+        if timers:
+            timers.discard(aid)
+        return True
+
+    def release(self, aid: str, delay: Optional[float] = None) -> None:
+        aid = str(aid)
+        self.finished.pop(aid, None)
+        self.track(aid, delay)
+
+    def next_delay(self, act: Dict[str, Any]) -> float:
+        age = time.time() - int(act.get("created_at") or time.time())
+        hot = self.stats.hot_window(act)
+        if age <= hot:
+            return self.interval
+        step = int((age - hot) // hot) + 1
+        return min(self.max_interval, self.interval * (2 ** min(step, 8)))
+
+    def _reschedule(self, aid: str, act: Optional[Dict[str, Any]] = None) -> None:
+        if aid in self.members:
+            self.track(aid, self.next_delay(act) if act else None)
+
+    def _pop_due(self, now: float) -> List[str]:
+        out: List[str] = []
+        while self.heap and self.heap[0][0] <= now:
+            at, aid = heapq.heappop(self.heap)
+            if self.due.get(aid) != at:
+                continue
+            del self.due[aid]
+            out.append(aid)
+        return out
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        pending = [t for t in [self.task, *self.inflight.values()] if t and not t.done()]
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self.inflight.clear()
+
+    async def run(self) -> None:
+        while True:
+            now = time.monotonic()
+            batch = self._pop_due(now)
+            if batch:
+                allowed = self.budget.take(len(batch))
+                for i, aid in enumerate(batch[allowed:], start=1):
+                    self.track(aid, i / self.budget.rate)
+                if allowed:
+                    await self._dispatch(batch[:allowed])
+                continue
+            timeout = self.heap[0][0] - now if self.heap else None
+            self.wake.clear()
             try:
-                st, val = parse_status(await api.call("getStatus", id=aid))
-            except Exception:
+                await asyncio.wait_for(self.wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self, batch: List[str]) -> None:
+        db = self.app.bot_data["db"]
+        try:
+            rows = await db.get_activations(batch)
+        except Exception as e:
+            logger.warning("poll batch load failed size=%s err=%s", len(batch), e)
+            for aid in batch:
+                self._reschedule(aid)
+            return
+        by_id = {str(r.get("activation_id")): r for r in rows}
+        for aid in batch:
+            act = by_id.get(aid)
+            if aid not in self.members:
                 continue
-            if st == "WAIT":
+            if not act or act.get("status") != "active":
+                self.members.discard(aid)
                 continue
-            if st == "OK" and val:
-                otp = str(val)
-                kb = InlineKeyboardMarkup(
-                    [
-                        [copy_button(tt(lang, "copy_otp"), otp, f"cp:otp:{user_id}")],
-                        [InlineKeyboardButton(tt(lang, "home"), callback_data="hm")],
-                    ]
-                )
-                msg = tt(lang, "otp", otp=otp)
-                await app.bot.send_message(
-                    chat_id,
-                    md(msg).replace(md(otp), cd(otp)),
-                    parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=kb,
-                )
+            self.inflight[aid] = asyncio.create_task(self._check(act))
+
+    async def _check(self, act: Dict[str, Any]) -> None:
+        aid = str(act["activation_id"])
+        try:
+            async with self.sem:
+                await self._poll_once(act)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("poll check failed aid=%s err=%s", aid, e)
+            self._reschedule(aid, act)
+        finally:
+            if self.inflight.get(aid) is asyncio.current_task():
+                self.inflight.pop(aid, None)
+
+    async def _poll_once(self, act: Dict[str, Any]) -> None:
+        aid = str(act["activation_id"])
+        api: TemplineAPI = self.app.bot_data["api"]
+        try:
+            st, val = parse_status(await api.call("getStatus", id=aid))
+        except Exception:
+            self._reschedule(aid, act)
+            return
+        if st == "OK" and val:
+            if self.claim(aid):
+                await deliver_claimed(self.app, act, str(val))
+            return
+        if st in {"CANCEL", "ERROR"}:
+            if self.claim(aid):
+                await finish_activation(self.app, act, "cancelled" if st == "CANCEL" else "error", val)
+            return
+        self._reschedule(aid, act)
+
+
+class ActivationTimers:
+    def __init__(self, app: Application, batch_size: int = 50):
+        self.app = app
+        self.batch_size = max(1, int(batch_size))
+        self.expires: Dict[str, float] = {}
+        self.unlocks: Dict[str, float] = {}
+        self.heap: List[Tuple[float, str]] = []
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def add(self, aid: str, created_at: Optional[float] = None) -> None:
+        aid = str(aid)
+        started = float(created_at) if created_at else time.time()
+        at = started + MAX_MONITOR_SECONDS
+        self.expires[aid] = at
+        self.unlocks[aid] = started + CANCEL_LOCK_SECONDS
+        heapq.heappush(self.heap, (at, aid))
+        self.wake.set()
+
+    def discard(self, aid: str) -> None:
+        self.expires.pop(str(aid), None)
+        self.unlocks.pop(str(aid), None)
+
+    def retry(self, aid: str, delay: float = 30.0) -> None:
+        aid = str(aid)
+        at = time.time() + delay
+        self.expires[aid] = at
+        heapq.heappush(self.heap, (at, aid))
+        self.wake.set()
+
+    def cancel_remaining(self, aid: str) -> Optional[int]:
+        at = self.unlocks.get(str(aid))
+        if at is None:
+            return None
+        return max(0, int(math.ceil(at - time.time())))
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def _pop_due(self, now: float) -> List[str]:
+        out: List[str] = []
+        while self.heap and self.heap[0][0] <= now:
+            at, aid = heapq.heappop(self.heap)
+            if self.expires.get(aid) != at:
+                continue
+            self.discard(aid)
+            out.append(aid)
+        return out
+
+    async def run(self) -> None:
+        while True:
+            now = time.time()
+            due = self._pop_due(now + 1)
+            for i in range(0, len(due), self.batch_size):
                 try:
-                    await api.call("setStatus", id=aid, status=6)
-                except Exception:
-                    pass
-                await adb(db.set_activation_status, aid, "otp_received", otp)
-                break
-            if st == "CANCEL":
-                await adb(db.set_activation_status, aid, "cancelled")
-                refund = await adb(db.refund_activation_if_needed, aid)
-                txt = tt(lang, "cancelled")
-                if refund:
-                    txt = f"{txt}\n{tt(lang, 'refund_done', amount=refund.get('amount'))}"
-                await app.bot.send_message(
-                    chat_id,
-                    md(txt),
-                    parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=main_menu(lang, role_of(user_row)),
-                )
-                break
-            if st == "ERROR":
-                await adb(db.set_activation_status, aid, "error")
-                refund = await adb(db.refund_activation_if_needed, aid)
-                txt = api_error(lang, val or "UNKNOWN")
-                if refund:
-                    txt = f"{txt}\n{tt(lang, 'refund_done', amount=refund.get('amount'))}"
-                await app.bot.send_message(
-                    chat_id,
-                    md(txt),
-                    parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=main_menu(lang, role_of(user_row)),
-                )
-                break
-        tasks.pop(str(aid), None)
+                    await self._expire(due[i : i + self.batch_size])
+                except Exception as e:
+                    logger.warning("expiry batch failed size=%s err=%s", len(due[i : i + self.batch_size]), e)
+            timeout = self.heap[0][0] - now if self.heap else None
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(self.wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _expire(self, aids: List[str]) -> None:
+        db = self.app.bot_data["db"]
+        poller: ActivationPoller = self.app.bot_data["poller"]
+        claimed = [aid for aid in aids if poller.claim(aid)]
+        if not claimed:
+            return
+        try:
+            rows = await db.expire_activations(claimed)
+        except Exception:
+            for aid in claimed:
+                poller.release(aid)
+                self.retry(aid)
+            raise
+        results = await asyncio.gather(*(settle_activation(self.app, act, "expired") for act in rows), return_exceptions=True)
+        for act, res in zip(rows, results):
+            if isinstance(res, Exception):
+                logger.warning("expiry refund failed aid=%s err=%s", act.get("activation_id"), res)
+        logger.info("Expired %s activation(s)", len(rows))
+
+
+class BroadcastManager:
+    def __init__(self, app: Application, rps: float = BROADCAST_RPS, concurrency: int = BROADCAST_CONCURRENCY):
+        self.app = app
+        self.bucket = TokenBucket(rps)
+        self.concurrency = concurrency
+        self.pause_until = 0.0
+        self.job: Optional[Dict[str, Any]] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    async def _save(self) -> None:
+        await self.app.bot_data["db"].set_setting(BROADCAST_JOB_KEY, json.dumps(self.job, ensure_ascii=False))
+
+    async def resume(self) -> None:
+        db = self.app.bot_data["db"]
+        try:
+            job = json.loads(await db.get_setting(BROADCAST_JOB_KEY, "") or "null")
+        except Exception as e:
+            logger.warning("broadcast job unreadable: %s", e)
+            return
+        if isinstance(job, dict) and job.get("status") == "running":
+            logger.info("resuming broadcast %s after %s", job.get("id"), job.get("cursor"))
+            self.job = job
+            self.task = asyncio.create_task(self.run())
+
+    async def start(self, text: str, chat_id: int) -> bool:
+        if self.running:
+            return False
+        msg = await self.app.bot.send_message(chat_id, md(tt("en", "broadcast_started")), parse_mode=ParseMode.MARKDOWN_V2)
+        self.job = {
+            "id": now_ts(),
+            "text": text,
+            "chat_id": int(chat_id),
+            "message_id": msg.message_id,
+            "cursor": None,
+            "total": 0,
+            "ok": 0,
+            "failed": 0,
+            "pruned": 0,
+            "status": "running",
+        }
+        await self._save()
+        self.task = asyncio.create_task(self.run())
+        return True
+
+    async def stop(self) -> None:
+        if self.task and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+    async def _slot(self) -> None:
+        while True:
+            wait = self.pause_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            elif self.bucket.take():
+                return
+            else:
+                await asyncio.sleep(1.0 / self.bucket.rate)
+
+    async def _send(self, row: Dict[str, Any]) -> str:
+        uid, chat_id = int(row["user_id"]), int(row["chat_id"])
+        for _ in range(3):
+            await self._slot()
+            try:
+                await self.app.bot.send_message(chat_id, self.job["text"])
+                return "ok"
+            except RetryAfter as e:
+                ra = e.retry_after
+                secs = ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+                self.pause_until = max(self.pause_until, time.monotonic() + secs + 0.5)
+            except Forbidden:
+                await self.app.bot_data["db"].clear_chat(uid)
+                return "pruned"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    await self.app.bot_data["db"].clear_chat(uid)
+                    return "pruned"
+                return "failed"
+            except (TimedOut, NetworkError):
+                await asyncio.sleep(1.0)
+            except Exception as e:
+                logger.warning("broadcast to %s failed: %s", uid, e)
+                return "failed"
+        return "failed"
+
+    async def _report(self, final: bool = False) -> None:
+        job = self.job
+        done = job["ok"] + job["failed"] + job["pruned"]
+        if final:
+            text = tt("en", "broadcast_done", ok=job["ok"], total=job["total"], failed=job["failed"], pruned=job["pruned"])
+        else:
+            text = tt("en", "broadcast_progress", done=done, total=job["total"], ok=job["ok"], failed=job["failed"], pruned=job["pruned"])
+        try:
+            await self.app.bot.edit_message_text(md(text), chat_id=job["chat_id"], message_id=job["message_id"], parse_mode=ParseMode.MARKDOWN_V2)
+        except Exception as e:
+            logger.debug("broadcast progress edit failed: %s", e)
+
+    def _advance(self, batch: List[Dict[str, Any]], results: Dict[int, str]) -> None:
+        for u in batch:
+            if u.get("chat_id"):
+                res = results.get(int(u["user_id"]))
+                if res is None:
+                    return
+                self.job[res] += 1
+            self.job["cursor"] = [int(u.get("created") or 0), int(u["user_id"])]
+
+    async def run(self) -> None:
+        job = self.job
+        db = self.app.bot_data["db"]
+        sem = asyncio.Semaphore(self.concurrency)
+        results: Dict[int, str] = {}
+
+        async def one(row: Dict[str, Any]) -> None:
+            async with sem:
+                results[int(row["user_id"])] = await self._send(row)
+
+        try:
+            if not job["total"]:
+                stats = await db.user_stats()
+                job["total"] = int(stats.get("total", 0)) - int(stats.get(ROLE_BLOCKED, 0))
+            await self._report()
+            reported = time.monotonic()
+            after = tuple(job["cursor"]) if job.get("cursor") else None
+            async for page in iter_user_pages(db, after=after, exclude_role=ROLE_BLOCKED, columns="user_id,chat_id,created"):
+                for i in range(0, len(page), BROADCAST_BATCH):
+                    batch = page[i : i + BROADCAST_BATCH]
+                    results.clear()
+                    try:
+                        await asyncio.gather(*(one(u) for u in batch if u.get("chat_id")))
+                    finally:
+                        self._advance(batch, results)
+                        await self._save()
+                    if time.monotonic() - reported >= BROADCAST_PROGRESS_SECONDS:
+                        await self._report()
+                        reported = time.monotonic()
+            job["total"] = job["ok"] + job["failed"] + job["pruned"]
+            job["status"] = "done"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("broadcast %s aborted: %s", job.get("id"), e)
+            job["status"] = "failed"
+        await self._save()
+        await self._report(final=True)
+
+
+def watch_activation(app: Application, aid: str, created_at: Optional[float] = None, delay: Optional[float] = None) -> None:
+    app.bot_data["poller"].track(aid, delay)
+    app.bot_data["timers"].add(aid, created_at)
+
+
+class SmsWebhookInbox:
+    def __init__(self, app: Application, max_seen: int = 5000):
+        self.app = app
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.seen: "OrderedDict[str, float]" = OrderedDict()
+        self.pending: set = set()
+        self.max_seen = max_seen
+        self.lock = threading.Lock()
+
+    def _mark_seen(self, aid: str) -> None:
+        with self.lock:
+            self.seen[aid] = time.time()
+            while len(self.seen) > self.max_seen:
+                self.seen.popitem(last=False)
+
+    def submit(self, payload: Any) -> bool:
+        aid, code = parse_sms_webhook(payload)
+        if not aid or not code:
+            logger.info("Ignored SMS webhook payload without activation/code")
+            return True
+        with self.lock:
+            if aid in self.seen or aid in self.pending:
+                return True
+            if self.loop is None:
+                return False
+            self.pending.add(aid)
+        asyncio.run_coroutine_threadsafe(self.handle(aid, code), self.loop)
+        return True
 
-    cur = tasks.get(str(aid))
-    if cur and not cur.done():
-        cur.cancel()
-    tasks[str(aid)] = asyncio.create_task(run())
+    async def handle(self, aid: str, code: str) -> None:
+        db = self.app.bot_data["db"]
+        poller: ActivationPoller = self.app.bot_data["poller"]
+        try:
+            act = await db.get_activation(aid)
+            if not act or act.get("status") != "active":
+                return
+            if not poller.claim(aid):
+                self._mark_seen(aid)
+                return
+            await deliver_claimed(self.app, act, code)
+            self._mark_seen(aid)
+            logger.info("OTP delivered from SMS webhook aid=%s", aid)
+        except Exception as e:
+            logger.warning("SMS webhook handling failed aid=%s err=%s", aid, e)
+        finally:
+            with self.lock:
+                self.pending.discard(aid)
 
 
 def approval_keyboard(user_id: int) -> InlineKeyboardMarkup:
@@ -2512,7 +4468,7 @@ async def notify_admin_new_user(context: ContextTypes.DEFAULT_TYPE, row: Dict[st
             parse_mode=ParseMode.MARKDOWN_V2,
             reply_markup=approval_keyboard(uid),
         )
-        await adb(db.mark_approval_notified, uid)
+        await db.mark_approval_notified(uid)
     except Exception as e:
         logger.warning("failed to notify admin for new user %s: %s", uid, e)
 
@@ -2520,7 +4476,7 @@ async def notify_admin_new_user(context: ContextTypes.DEFAULT_TYPE, row: Dict[st
 async def h_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     db = context.application.bot_data["db"]
     user_id, _, lang, role, is_new = await ensure_user(update, db)
-    row = await adb(db.get, user_id) or {}
+    row = await get_user_row(context, user_id) or {}
     role = role_of(row) if row else role
     logger.info("Received /start from user_id=%s", update.effective_user.id if update.effective_user else None)
     if role == ROLE_PENDING and (is_new or not bool(row.get("approval_notified"))):
@@ -2543,7 +4499,7 @@ async def h_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def h_lang(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     db = context.application.bot_data["db"]
     await ensure_user(update, db)
-    row = await adb(db.get, update.effective_user.id) or {}
+    row = await get_user_row(context, update.effective_user.id) or {}
     lang = lang_from_code(row.get("lang"))
     await safe_reply_markdown(update.effective_message, md(tt(lang, "lang_pick")), reply_markup=lang_keyboard())
 
@@ -2557,8 +4513,8 @@ async def cb_lang(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     lg = q.data.split(":", 1)[1] if ":" in q.data else "en"
     if lg not in LANGS:
         lg = "en"
-    await adb(db.set_lang, q.from_user.id, q.message.chat_id, lg)
-    row = await adb(db.get, q.from_user.id) or {}
+    await db.set_lang(q.from_user.id, q.message.chat_id, lg)
+    row = await get_user_row(context, q.from_user.id) or {}
     await q.message.reply_text(
         md(tt(lg, "lang_saved")),
         parse_mode=ParseMode.MARKDOWN_V2,
@@ -2569,7 +4525,7 @@ async def cb_lang(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def h_select(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     db = context.application.bot_data["db"]
     _, _, lang, role, _ = await ensure_user(update, db)
-    if not context.application.bot_data.get("svc_cache"):
+    if context.application.bot_data["catalog"].services.value is None:
         await update.effective_message.reply_text(
             md(tt(lang, "load_services")),
             parse_mode=ParseMode.MARKDOWN_V2,
@@ -2618,7 +4574,7 @@ async def h_search_input(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             reply_markup=main_menu(lang, role),
         )
         return ConversationHandler.END
-    matched = match_services(query, items)
+    matched = context.application.bot_data["catalog"].search(query) if items else []
     if not matched:
         await update.effective_message.reply_text(
             md(tt(lang, "search_empty")),
@@ -2635,8 +4591,7 @@ async def cb_service_page(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not q or not q.from_user:
         return
     await safe_answer_callback(q)
-    db: DB = context.application.bot_data["db"]
-    row = await adb(db.get, q.from_user.id) or {}
+    row = await get_user_row(context, q.from_user.id) or {}
     lang = lang_from_code(row.get("lang"))
     try:
         _, mode, p = q.data.split(":")
@@ -2644,7 +4599,7 @@ async def cb_service_page(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     except Exception:
         await safe_answer_callback(q, tt(lang, "expired"), show_alert=True)
         return
-    items = context.user_data.get(f"svc_{mode}") or []
+    items = context.application.bot_data["browse"].get(q.from_user.id, f"svc_{mode}") or []
     if not items:
         await safe_answer_callback(q, tt(lang, "expired"), show_alert=True)
         return
@@ -2658,8 +4613,7 @@ async def cb_service_select(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not q or not q.from_user:
         return
     await safe_answer_callback(q)
-    db = context.application.bot_data["db"]
-    row = await adb(db.get, q.from_user.id) or {}
+    row = await get_user_row(context, q.from_user.id) or {}
     lang = lang_from_code(row.get("lang"))
     service_code = q.data.split(":", 1)[1] if ":" in q.data else ""
     if not service_code:
@@ -2681,8 +4635,7 @@ async def cb_price_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if not q or not q.from_user:
         return
     await safe_answer_callback(q)
-    db: DB = context.application.bot_data["db"]
-    row = await adb(db.get, q.from_user.id) or {}
+    row = await get_user_row(context, q.from_user.id) or {}
     lang = lang_from_code(row.get("lang"))
     try:
         _, code, p = q.data.split(":")
@@ -2690,7 +4643,7 @@ async def cb_price_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     except Exception:
         await safe_answer_callback(q, tt(lang, "expired"), show_alert=True)
         return
-    opts = context.user_data.get(f"price_{code}") or []
+    opts = context.application.bot_data["browse"].get(q.from_user.id, f"price_{code}") or []
     if not opts:
         await safe_answer_callback(q, tt(lang, "expired"), show_alert=True)
         return
@@ -2706,7 +4659,7 @@ async def cb_buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await safe_answer_callback(q)
     db = context.application.bot_data["db"]
     api: TemplineAPI = context.application.bot_data["api"]
-    row = await adb(db.get, q.from_user.id) or {}
+    row = await get_user_row(context, q.from_user.id) or {}
     lang = lang_from_code(row.get("lang"))
     role = role_of(row)
 
@@ -2716,7 +4669,7 @@ async def cb_buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     except Exception:
         await safe_answer_callback(q, tt(lang, "expired"), show_alert=True)
         return
-    opts = context.user_data.get(f"price_{code}") or []
+    opts = context.application.bot_data["browse"].get(q.from_user.id, f"price_{code}") or []
     if idx < 0 or idx >= len(opts):
         await safe_answer_callback(q, tt(lang, "expired"), show_alert=True)
         return
@@ -2726,7 +4679,7 @@ async def cb_buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     base_cost = dec(opt.base_price or opt.price, "0")
     deducted = False
     if role in {ROLE_USER, ROLE_SUPER}:
-        bal = await adb(db.adjust_balance, q.from_user.id, -charge, require_non_negative=True)
+        bal = await db.adjust_balance(q.from_user.id, -charge, require_non_negative=True)
         if bal is None:
             await safe_answer_callback(q, tt(lang, "insufficient_wallet"), show_alert=True)
             return
@@ -2744,18 +4697,17 @@ async def cb_buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     except Exception as e:
         logger.warning("getNumber failed (buy) user=%s args=%s err=%s", q.from_user.id, buy_args, e)
         if deducted:
-            await adb(db.adjust_balance, q.from_user.id, charge)
+            await db.adjust_balance(q.from_user.id, charge)
         await q.message.reply_text(md(tt(lang, "generic_fail")), parse_mode=ParseMode.MARKDOWN_V2, reply_markup=main_menu(lang, role))
         return
     aid, phone, err = parse_number(payload)
     if err or not aid or not phone:
         if deducted:
-            await adb(db.adjust_balance, q.from_user.id, charge)
+            await db.adjust_balance(q.from_user.id, charge)
         await q.message.reply_text(md(api_error(lang, err or "UNKNOWN")), parse_mode=ParseMode.MARKDOWN_V2, reply_markup=main_menu(lang, role))
         return
 
-    await adb(
-        db.add_activation,
+    await db.add_activation(
         q.from_user.id,
         q.message.chat_id,
         aid,
@@ -2766,10 +4718,10 @@ async def cb_buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         base_price=base_cost,
         charged_price=charge if role in {ROLE_USER, ROLE_SUPER} else 0,
     )
-    await adb(db.set_activation, q.from_user.id, q.message.chat_id, aid, opt.service_code, opt.country_code, opt.provider_id, phone)
+    await db.set_activation(q.from_user.id, q.message.chat_id, aid, opt.service_code, opt.country_code, opt.provider_id, phone)
 
     provider = opt.provider_name or tt(lang, "fallback_provider")
-    countries = context.application.bot_data.get("country_cache", {}).get("items") or {}
+    countries = context.application.bot_data["catalog"].country_map()
     cinfo = countries.get(str(opt.country_code), {}) if isinstance(countries, dict) else {}
     resolved_name = str(
         cinfo.get("name")
@@ -2799,7 +4751,7 @@ async def cb_buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         parse_mode=ParseMode.MARKDOWN_V2,
         reply_markup=kb,
     )
-    await start_poll_task(context.application, aid)
+    watch_activation(context.application, aid)
 
 
 async def cb_another(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -2809,7 +4761,7 @@ async def cb_another(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     await safe_answer_callback(q)
     db = context.application.bot_data["db"]
     api: TemplineAPI = context.application.bot_data["api"]
-    row = await adb(db.get, q.from_user.id) or {}
+    row = await get_user_row(context, q.from_user.id) or {}
     lang = lang_from_code(row.get("lang"))
     role = role_of(row)
 
@@ -2821,22 +4773,27 @@ async def cb_another(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
     provider_id: Optional[str] = None if provider_token in {"", "none", "null"} else provider_token
 
+    b = context.application.bot_data
+    opts = b["browse"].get(q.from_user.id, f"price_{service_code}")
+    if not isinstance(opts, PriceView):
+        name = b["catalog"].service_name(service_code)
+        opts = await b["prices"].options(service_code, name, lang, role, await db.get_profit_percent())
+        if isinstance(opts, PriceView):
+            b["browse"].put(q.from_user.id, f"price_{service_code}", opts)
+    opt = opts.find(service_code, country_code, provider_token) if isinstance(opts, PriceView) else None
+    if opt is None:
+        await safe_answer_callback(q, tt(lang, "expired"), show_alert=True)
+        return
+
     await q.message.reply_text(
         md(tt(lang, "wait")),
         parse_mode=ParseMode.MARKDOWN_V2,
     )
-    price_map: Dict[Tuple[str, str, str], PriceOption] = {}
-    for v in (context.user_data.get(f"price_{service_code}") or []):
-        k = (str(v.service_code), str(v.country_code), str(v.provider_id or "none"))
-        price_map[k] = v
-    opt = price_map.get((service_code, country_code, provider_token))
-    if opt is None:
-        opt = price_map.get((service_code, country_code, "none"))
-    charge = dec(opt.price, "0") if opt else Decimal("0")
-    base_cost = dec(opt.base_price or opt.price, "0") if opt else Decimal("0")
+    charge = dec(opt.price, "0")
+    base_cost = dec(opt.base_price or opt.price, "0")
     deducted = False
     if role in {ROLE_USER, ROLE_SUPER}:
-        bal = await adb(db.adjust_balance, q.from_user.id, -charge, require_non_negative=True)
+        bal = await db.adjust_balance(q.from_user.id, -charge, require_non_negative=True)
         if bal is None:
             await safe_answer_callback(q, tt(lang, "insufficient_wallet"), show_alert=True)
             return
@@ -2853,19 +4810,18 @@ async def cb_another(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     except Exception as e:
         logger.warning("getNumber failed (another) user=%s args=%s err=%s", q.from_user.id, buy_args, e)
         if deducted:
-            await adb(db.adjust_balance, q.from_user.id, charge)
+            await db.adjust_balance(q.from_user.id, charge)
         await q.message.reply_text(md(tt(lang, "generic_fail")), parse_mode=ParseMode.MARKDOWN_V2, reply_markup=main_menu(lang, role))
         return
 
     aid, phone, err = parse_number(payload)
     if err or not aid or not phone:
         if deducted:
-            await adb(db.adjust_balance, q.from_user.id, charge)
+            await db.adjust_balance(q.from_user.id, charge)
         await q.message.reply_text(md(api_error(lang, err or "UNKNOWN")), parse_mode=ParseMode.MARKDOWN_V2, reply_markup=main_menu(lang, role))
         return
 
-    await adb(
-        db.add_activation,
+    await db.add_activation(
         q.from_user.id,
         q.message.chat_id,
         aid,
@@ -2876,9 +4832,9 @@ async def cb_another(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         base_price=base_cost,
         charged_price=charge if role in {ROLE_USER, ROLE_SUPER} else 0,
     )
-    await adb(db.set_activation, q.from_user.id, q.message.chat_id, aid, service_code, country_code, provider_id, phone)
+    await db.set_activation(q.from_user.id, q.message.chat_id, aid, service_code, country_code, provider_id, phone)
 
-    countries = context.application.bot_data.get("country_cache", {}).get("items") or {}
+    countries = context.application.bot_data["catalog"].country_map()
     cinfo = countries.get(str(country_code), {}) if isinstance(countries, dict) else {}
     resolved_name = str(cinfo.get("name") or tt(lang, "fallback_country")).strip()
     resolved_iso2 = cinfo.get("iso2") or country_name_to_iso2(resolved_name)
@@ -2896,14 +4852,14 @@ async def cb_another(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         ]
     )
     await q.message.reply_text(md(text).replace(md(phone), cd(phone)).replace(md(aid), cd(aid)), parse_mode=ParseMode.MARKDOWN_V2, reply_markup=kb)
-    await start_poll_task(context.application, aid)
+    watch_activation(context.application, aid)
 
 
 async def h_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     db = context.application.bot_data["db"]
     _, _, lang, role, _ = await ensure_user(update, db)
     if role in {ROLE_USER, ROLE_SUPER}:
-        bal = money(await adb(db.get_balance, update.effective_user.id))
+        bal = money(await db.get_balance(update.effective_user.id))
         await update.effective_message.reply_text(
             md(tt(lang, "wallet", balance=bal)),
             parse_mode=ParseMode.MARKDOWN_V2,
@@ -2932,11 +4888,11 @@ async def cb_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         return
     await safe_answer_callback(q)
     db = context.application.bot_data["db"]
-    row = await adb(db.get, q.from_user.id) or {}
+    row = await get_user_row(context, q.from_user.id) or {}
     lang = lang_from_code(row.get("lang"))
     role = role_of(row)
     if role in {ROLE_USER, ROLE_SUPER}:
-        bal = money(await adb(db.get_balance, q.from_user.id))
+        bal = money(await db.get_balance(q.from_user.id))
         await q.message.reply_text(
             md(tt(lang, "wallet", balance=bal)),
             parse_mode=ParseMode.MARKDOWN_V2,
@@ -2958,21 +4914,20 @@ async def cb_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 async def cancel_core(context: ContextTypes.DEFAULT_TYPE, aid: str, user_id: Optional[int] = None) -> None:
     db = context.application.bot_data["db"]
     api: TemplineAPI = context.application.bot_data["api"]
-    tasks: Dict[str, asyncio.Task] = context.application.bot_data["tasks"]
+    poller: ActivationPoller = context.application.bot_data["poller"]
+    timers: ActivationTimers = context.application.bot_data["timers"]
     try:
         await api.call("setStatus", id=aid, status=8)
     except Exception:
         pass
-    tsk = tasks.get(str(aid))
-    if tsk and not tsk.done():
-        tsk.cancel()
-        tasks.pop(str(aid), None)
-    await adb(db.set_activation_status, str(aid), "cancelled")
-    refund = await adb(db.refund_activation_if_needed, str(aid))
+    poller.discard(str(aid))
+    timers.discard(str(aid))
+    await db.set_activation_status(str(aid), "cancelled")
+    refund = await db.refund_activation_if_needed(str(aid))
     if user_id is not None:
-        row = await adb(db.get, user_id) or {}
+        row = await get_user_row(context, user_id) or {}
         if str(row.get("activation_id") or "") == str(aid):
-            await adb(db.clear_activation, user_id)
+            await db.clear_activation(user_id)
         if refund and int(refund.get("user_id") or 0) == int(user_id):
             lang = lang_from_code(row.get("lang"))
             try:
@@ -2991,14 +4946,14 @@ async def cb_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not q or not q.from_user:
         return
     db = context.application.bot_data["db"]
-    row = await adb(db.get, q.from_user.id) or {}
+    row = await get_user_row(context, q.from_user.id) or {}
     lang = lang_from_code(row.get("lang"))
     aid = q.data.split(":", 1)[1] if ":" in q.data else None
     if not aid:
         await safe_answer_callback(q, tt(lang, "expired"), show_alert=True)
         return
 
-    act = await adb(db.get_activation, str(aid))
+    act = await db.get_activation(str(aid))
     if not act:
         legacy_aid = row.get("activation_id")
         if str(legacy_aid or "") == str(aid) and int(row.get("polling") or 0) == 1:
@@ -3026,8 +4981,11 @@ async def cb_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await safe_answer_callback(q, tt(lang, "no_active"), show_alert=True)
         return
 
-    if not can_cancel_activation(act):
+    timers: ActivationTimers = context.application.bot_data["timers"]
+    remaining = timers.cancel_remaining(str(aid))
+    if remaining is None:
         remaining = cancel_remaining_seconds(act)
+    if remaining > 0:
         await safe_answer_callback(q, cancel_lock_message(lang, remaining), show_alert=True)
         return
     await safe_answer_callback(q)
@@ -3042,9 +5000,9 @@ async def cb_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def cmd_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     db = context.application.bot_data["db"]
     _, _, lang, role, _ = await ensure_user(update, db)
-    act = await adb(db.latest_active_activation_for_user, update.effective_user.id)
+    act = await db.latest_active_activation_for_user(update.effective_user.id)
     if not act:
-        row = await adb(db.get, update.effective_user.id) or {}
+        row = await get_user_row(context, update.effective_user.id) or {}
         aid = row.get("activation_id")
         if aid and int(row.get("polling") or 0) == 1:
             act = {
@@ -3061,8 +5019,11 @@ async def cmd_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             reply_markup=main_menu(lang, role),
         )
         return ConversationHandler.END
-    if not can_cancel_activation(act):
+    timers: ActivationTimers = context.application.bot_data["timers"]
+    remaining = timers.cancel_remaining(str(act["activation_id"]))
+    if remaining is None:
         remaining = cancel_remaining_seconds(act)
+    if remaining > 0:
         await update.effective_message.reply_text(
             md(cancel_lock_message(lang, remaining)),
             parse_mode=ParseMode.MARKDOWN_V2,
@@ -3083,8 +5044,7 @@ async def cb_home(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not q or not q.from_user:
         return
     await safe_answer_callback(q)
-    db = context.application.bot_data["db"]
-    row = await adb(db.get, q.from_user.id) or {}
+    row = await get_user_row(context, q.from_user.id) or {}
     lang = lang_from_code(row.get("lang"))
     await q.message.reply_text(
         md(tt(lang, "welcome")),
@@ -3151,8 +5111,7 @@ async def gate_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.info("Incoming message update from user_id=%s", update.effective_user.id)
     if not update.effective_user or not update.effective_message:
         return
-    db = context.application.bot_data["db"]
-    row = await adb(db.get, update.effective_user.id)
+    row = await get_user_row(context, update.effective_user.id)
     if not row:
         txt = update.effective_message.text or ""
         if txt.startswith("/start") or txt.startswith("/language"):
@@ -3178,8 +5137,7 @@ async def gate_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not q or not q.from_user:
         return
     logger.info("Incoming callback from user_id=%s data=%s", q.from_user.id, q.data)
-    db = context.application.bot_data["db"]
-    row = await adb(db.get, q.from_user.id)
+    row = await get_user_row(context, q.from_user.id)
     if not row:
         return
     role = role_of(row)
@@ -3210,9 +5168,9 @@ async def cb_user_approval(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await safe_answer_callback(q, tt("en", "expired"), show_alert=True)
         return
     db = context.application.bot_data["db"]
-    await adb(db.set_role, uid, role, approved_by=q.from_user.id)
+    await db.set_role(uid, role, approved_by=q.from_user.id)
     await safe_answer_callback(q, tt("en", "role_updated"))
-    target = await adb(db.get, uid) or {}
+    target = await get_user_row(context, uid) or {}
     chat_id = target.get("chat_id")
     if chat_id:
         msg_key = "approved_user" if role == ROLE_USER else "approved_super"
@@ -3235,8 +5193,7 @@ async def h_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if not update.effective_user:
         return
     if not is_admin(update):
-        db = context.application.bot_data["db"]
-        row = await adb(db.get, update.effective_user.id) or {}
+        row = await get_user_row(context, update.effective_user.id) or {}
         lang = lang_from_code(row.get("lang"))
         await update.effective_message.reply_text(md(tt(lang, "admin_only")), parse_mode=ParseMode.MARKDOWN_V2)
         return
@@ -3255,17 +5212,27 @@ async def cb_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await safe_answer_callback(q, tt("en", "admin_only"), show_alert=True)
         return
     db = context.application.bot_data["db"]
-    action = (q.data or "").split(":", 1)[1] if ":" in (q.data or "") else ""
+    parts = (q.data or "").split(":")[1:]
+    action = parts[0] if parts else ""
     await safe_answer_callback(q)
     if action == "pending":
-        items = await adb(db.list_pending_users)
+        after = (int(parts[1]), int(parts[2])) if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit() else None
+        items = await db.list_users_page(after=after, limit=PENDING_PAGE_SIZE, role=ROLE_PENDING)
         if not items:
             await q.message.reply_text(md(tt("en", "pending_none")), parse_mode=ParseMode.MARKDOWN_V2)
             return
-        for r in items[:20]:
+        for r in items:
             name = r.get("full_name") or r.get("username") or f"user_{r['user_id']}"
             txt = tt("en", "new_user_alert", name=name, user_id=r["user_id"], user_lang=r.get("lang") or "en")
             await q.message.reply_text(md(txt), parse_mode=ParseMode.MARKDOWN_V2, reply_markup=approval_keyboard(int(r["user_id"])))
+        if len(items) == PENDING_PAGE_SIZE:
+            last = items[-1]
+            nxt = f"ad:pending:{int(last.get('created') or 0)}:{int(last['user_id'])}"
+            await q.message.reply_text(
+                md(tt("en", "pending_more")),
+                parse_mode=ParseMode.MARKDOWN_V2,
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(tt("en", "pending_more"), callback_data=nxt)]]),
+            )
         return
     if action == "broadcast":
         context.user_data["admin_state"] = BROADCAST_STATE
@@ -3273,19 +5240,19 @@ async def cb_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     if action == "payments":
         context.user_data["admin_state"] = PAYMENT_EDIT_STATE
-        settings = await adb(db.get_payment_settings)
+        settings = await db.get_payment_settings()
         lines = payment_settings_to_lines(settings)
         await q.message.reply_text(md(tt("en", "payment_show", lines=lines)), parse_mode=ParseMode.MARKDOWN_V2)
         await q.message.reply_text(md(tt("en", "payment_prompt")), parse_mode=ParseMode.MARKDOWN_V2)
         return
     if action == "profit":
         context.user_data["admin_state"] = PROFIT_EDIT_STATE
-        pct = money(await adb(db.get_profit_percent))
+        pct = money(await db.get_profit_percent())
         await q.message.reply_text(md(tt("en", "profit_current", pct=pct)), parse_mode=ParseMode.MARKDOWN_V2)
         await q.message.reply_text(md(tt("en", "profit_prompt")), parse_mode=ParseMode.MARKDOWN_V2)
         return
     if action == "stats":
-        s = await adb(db.user_stats)
+        s = await db.user_stats()
         text = (
             f"📊 Users\n"
             f"Total: {s.get('total', 0)}\n"
@@ -3313,17 +5280,17 @@ async def cb_deposit_review(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await safe_answer_callback(q, tt("en", "expired"), show_alert=True)
         return
     db = context.application.bot_data["db"]
-    dep = await adb(db.get_deposit, dep_id)
+    dep = await db.get_deposit(dep_id)
     if not dep:
         await safe_answer_callback(q, tt("en", "deposit_not_found"), show_alert=True)
         return
     status = "approved" if action == "ap" else "rejected"
-    ok = await adb(db.update_deposit_status, dep_id, status, q.from_user.id)
+    ok = await db.update_deposit_status(dep_id, status, q.from_user.id)
     if not ok:
         await safe_answer_callback(q, tt("en", "deposit_not_found"), show_alert=True)
         return
     await safe_answer_callback(q, tt("en", "deposit_reviewed"))
-    usr = await adb(db.get, int(dep["user_id"])) or {}
+    usr = await get_user_row(context, int(dep["user_id"])) or {}
     lang = lang_from_code(usr.get("lang"))
     key = "deposit_approved_user" if status == "approved" else "deposit_rejected_user"
     try:
@@ -3342,8 +5309,7 @@ async def cb_deposit_review(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 async def h_deposit_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = context.application.bot_data["db"]
-    row = await adb(db.get, update.effective_user.id) or {}
+    row = await get_user_row(context, update.effective_user.id) or {}
     role = role_of(row)
     lang = lang_from_code(row.get("lang"))
     if role not in {ROLE_USER, ROLE_SUPER}:
@@ -3361,13 +5327,13 @@ async def h_photo_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     if not update.effective_user or not update.effective_message:
         return
     db = context.application.bot_data["db"]
-    row = await adb(db.get, update.effective_user.id) or {}
+    row = await get_user_row(context, update.effective_user.id) or {}
     role = role_of(row)
     lang = lang_from_code(row.get("lang"))
     dep_state = context.user_data.get("dep_state")
     dep_id = context.user_data.get("dep_id")
     if dep_state != DEPOSIT_PROOF_STATE or not dep_id:
-        open_dep = await adb(db.latest_open_deposit_for_user, update.effective_user.id)
+        open_dep = await db.latest_open_deposit_for_user(update.effective_user.id)
         if not open_dep:
             return
         dep_id = int(open_dep["id"])
@@ -3385,8 +5351,8 @@ async def h_photo_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await update.effective_message.reply_text(md(tt(lang, "deposit_waiting_photo")), parse_mode=ParseMode.MARKDOWN_V2)
         return
     file_id = photos[-1].file_id
-    await adb(db.set_deposit_proof, int(dep_id), txid, file_id)
-    dep = await adb(db.get_deposit, int(dep_id)) or {}
+    await db.set_deposit_proof(int(dep_id), txid, file_id)
+    dep = await db.get_deposit(int(dep_id)) or {}
     _clear_deposit_state(context)
     await update.effective_message.reply_text(
         md(tt(lang, "deposit_sent")),
@@ -3414,7 +5380,7 @@ async def process_text_state(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not update.effective_user or not update.effective_message:
         return False
     db = context.application.bot_data["db"]
-    row = await adb(db.get, update.effective_user.id) or {}
+    row = await get_user_row(context, update.effective_user.id) or {}
     role = role_of(row)
     lang = lang_from_code(row.get("lang"))
     text = (update.effective_message.text or "").strip()
@@ -3423,21 +5389,10 @@ async def process_text_state(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     admin_state = context.user_data.get("admin_state")
     if update.effective_user.id == ADMIN_USER_ID and admin_state == BROADCAST_STATE:
-        users = await adb(db.list_all_users, include_blocked=False)
-        ok = 0
-        total = 0
-        for u in users:
-            chat_id = u.get("chat_id")
-            if not chat_id:
-                continue
-            total += 1
-            try:
-                await context.bot.send_message(int(chat_id), text)
-                ok += 1
-            except Exception:
-                pass
+        broadcast: BroadcastManager = context.application.bot_data["broadcast"]
         _clear_admin_state(context)
-        await update.effective_message.reply_text(md(tt("en", "broadcast_done", ok=ok, total=total)), parse_mode=ParseMode.MARKDOWN_V2)
+        if not await broadcast.start(text, update.effective_chat.id):
+            await update.effective_message.reply_text(md(tt("en", "broadcast_busy")), parse_mode=ParseMode.MARKDOWN_V2)
         return True
     if update.effective_user.id == ADMIN_USER_ID and admin_state == PAYMENT_EDIT_STATE:
         parsed: Dict[str, str] = {}
@@ -3447,14 +5402,14 @@ async def process_text_state(update: Update, context: ContextTypes.DEFAULT_TYPE)
             k, v = line.split("=", 1)
             parsed[k.strip()] = v.strip()
         if parsed:
-            await adb(db.update_payment_settings, parsed)
+            await db.update_payment_settings(parsed)
             await update.effective_message.reply_text(md(tt("en", "payment_saved")), parse_mode=ParseMode.MARKDOWN_V2)
         _clear_admin_state(context)
         return True
     if update.effective_user.id == ADMIN_USER_ID and admin_state == PROFIT_EDIT_STATE:
         try:
             pct = dec(text)
-            await adb(db.set_profit_percent, pct)
+            await db.set_profit_percent(pct)
             await update.effective_message.reply_text(md(tt("en", "profit_saved", pct=money(pct))), parse_mode=ParseMode.MARKDOWN_V2)
         except Exception:
             await update.effective_message.reply_text(md(tt("en", "generic_fail")), parse_mode=ParseMode.MARKDOWN_V2)
@@ -3463,7 +5418,7 @@ async def process_text_state(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     dep_state = context.user_data.get("dep_state")
     if dep_state != DEPOSIT_AMOUNT_STATE and dep_state != DEPOSIT_PROOF_STATE:
-        open_dep = await adb(db.latest_open_deposit_for_user, update.effective_user.id)
+        open_dep = await db.latest_open_deposit_for_user(update.effective_user.id)
         if open_dep:
             dep_state = DEPOSIT_PROOF_STATE
             context.user_data["dep_state"] = DEPOSIT_PROOF_STATE
@@ -3473,13 +5428,13 @@ async def process_text_state(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if amount < MIN_DEPOSIT_USD:
             await update.effective_message.reply_text(md(tt(lang, "deposit_min", min=money(MIN_DEPOSIT_USD))), parse_mode=ParseMode.MARKDOWN_V2)
             return True
-        dep_id = await adb(db.create_deposit, update.effective_user.id, amount)
+        dep_id = await db.create_deposit(update.effective_user.id, amount)
         context.user_data["dep_state"] = DEPOSIT_PROOF_STATE
         context.user_data["dep_id"] = dep_id
         context.user_data["dep_amount"] = money(amount)
-        pay = await adb(db.get_payment_settings)
+        pay = await db.get_payment_settings()
         if not pay.get("telegram_username"):
-            admin_row = await adb(db.get, ADMIN_USER_ID) or {}
+            admin_row = await get_user_row(context, ADMIN_USER_ID) or {}
             admin_un = str(admin_row.get("username") or "").strip()
             if admin_un:
                 pay["telegram_username"] = f"@{admin_un}" if not admin_un.startswith("@") else admin_un
@@ -3518,7 +5473,7 @@ async def log_raw_update(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def post_init(app: Application) -> None:
     logger.info("Templine bot post-init started (admin_user_id=%s)", ADMIN_USER_ID)
     db = app.bot_data["db"]
-    await adb(db.ensure_admin_user, ADMIN_USER_ID)
+    await db.init()
     await app.bot.set_my_commands(
         [
             BotCommand("start", "Start"),
@@ -3528,43 +5483,42 @@ async def post_init(app: Application) -> None:
         ]
     )
     db = app.bot_data["db"]
-    api: TemplineAPI = app.bot_data["api"]
+    await app.bot_data["catalog"].warm()
+
+    poller: ActivationPoller = app.bot_data["poller"]
+    poller.start()
+    app.bot_data["timers"].start()
+    inbox: Optional[SmsWebhookInbox] = app.bot_data.get("sms_inbox")
+    if inbox:
+        inbox.loop = asyncio.get_running_loop()
     try:
-        svc_res, ctry_res = await asyncio.gather(
-            api.call("getServicesList"),
-            api.call("getCountries"),
-            return_exceptions=True,
-        )
-        now = time.time()
-        if not isinstance(svc_res, Exception):
-            services = parse_services(svc_res)
-            app.bot_data["svc_cache"] = {
-                "ts": now,
-                "items": services,
-                "map": {s["code"]: s["name"] for s in services},
-            }
-        if not isinstance(ctry_res, Exception):
-            countries = parse_countries(ctry_res)
-            app.bot_data["country_cache"] = {"ts": now, "items": countries}
+        for row in await db.list_active_activations():
+            watch_activation(app, str(row["activation_id"]), created_at=row.get("created_at"), delay=0)
     except Exception as e:
-        logger.warning("cache warm-up failed: %s", e)
-
-    for row in await adb(db.list_active_activations):
-        try:
-            await start_poll_task(app, str(row["activation_id"]))
-        except Exception as e:
-            logger.warning("resume polling failed user=%s err=%s", row.get("user_id"), e)
+        logger.warning("resume polling failed: %s", e)
+    await app.bot_data["broadcast"].resume()
     logger.info("Templine bot post-init complete")
 
 
 async def post_shutdown(app: Application) -> None:
-    tasks: Dict[str, asyncio.Task] = app.bot_data.get("tasks", {})
-    for tsk in list(tasks.values()):
-        if not tsk.done():
-            tsk.cancel()
+    poller: Optional[ActivationPoller] = app.bot_data.get("poller")
+    if poller:
+        await poller.stop()
+    timers: Optional[ActivationTimers] = app.bot_data.get("timers")
+    if timers:
+        await timers.stop()
+    catalog: Optional[CatalogManager] = app.bot_data.get("catalog")
+    if catalog:
+        await catalog.stop()
+    broadcast: Optional[BroadcastManager] = app.bot_data.get("broadcast")
+    if broadcast:
+        await broadcast.stop()
     api: TemplineAPI = app.bot_data.get("api")
     if api:
         await api.close()
+    db = app.bot_data.get("db")
+    if db is not None:
+        await db.close()
 
 
 async def app_error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -3583,7 +5537,7 @@ def validate_telegram_token(token: str) -> None:
         raise SystemExit("BOT_TOKEN is placeholder. Set real token from BotFather.")
     try:
         url = f"https://api.telegram.org/bot{token}/getMe"
-        r = httpx.get(url, timeout=10)
+        r = sync_http().get(url, timeout=10)
         r.raise_for_status()
         data = r.json()
         if not data.get("ok"):
@@ -3602,7 +5556,7 @@ def clear_telegram_webhook_if_polling(token: str) -> None:
     last_err = None
     for i in range(1, 4):
         try:
-            r1 = httpx.get(del_url, params={"drop_pending_updates": "true"}, timeout=25)
+            r1 = sync_http().get(del_url, params={"drop_pending_updates": "true"}, timeout=25)
             r1.raise_for_status()
             logger.info("deleteWebhook attempt %s OK: %s", i, r1.text)
             break
@@ -3614,7 +5568,7 @@ def clear_telegram_webhook_if_polling(token: str) -> None:
         logger.warning("Could not clear webhook before polling after retries: %s", last_err)
 
     try:
-        r2 = httpx.get(info_url, timeout=25)
+        r2 = sync_http().get(info_url, timeout=25)
         r2.raise_for_status()
         body = r2.json()
         wh_url = ((body or {}).get("result") or {}).get("url")
@@ -3631,17 +5585,22 @@ def build_app() -> Application:
         Application.builder()
         .token(BOT_TOKEN)
         .concurrent_updates(True)
-        .get_updates_connect_timeout(10)
-        .get_updates_read_timeout(20)
-        .get_updates_write_timeout(20)
-        .get_updates_pool_timeout(10)
+        .request(telegram_request(TELEGRAM_POOL_SIZE, pool_timeout=5.0))
+        .get_updates_request(telegram_request(1, connect_timeout=10, read_timeout=20, write_timeout=20, pool_timeout=10))
         .post_init(post_init)
         .post_shutdown(post_shutdown)
         .build()
     )
-    app.bot_data["db"] = SupabaseRESTDB()
+    app.bot_data["db"] = UserRowCache(open_repository())
     app.bot_data["api"] = TemplineAPI(API_KEY, BASE_URL)
-    app.bot_data["tasks"] = {}
+    app.bot_data["catalog"] = CatalogManager(app.bot_data["api"])
+    app.bot_data["prices"] = PriceCache(app.bot_data["api"], app.bot_data["catalog"])
+    app.bot_data["browse"] = BrowseStateStore()
+    app.bot_data["broadcast"] = BroadcastManager(app)
+    app.bot_data["poller"] = ActivationPoller(app, interval=SMS_WEBHOOK_POLL_SECONDS if SMS_WEBHOOK_SECRET else POLL_SECONDS)
+    app.bot_data["timers"] = ActivationTimers(app)
+    if SMS_WEBHOOK_SECRET:
+        app.bot_data["sms_inbox"] = SmsWebhookInbox(app)
 
     app.add_handler(TypeHandler(Update, log_raw_update), group=-2)
     app.add_handler(CallbackQueryHandler(gate_user_callback), group=-1)
@@ -3709,14 +5668,44 @@ def should_use_webhook() -> bool:
 
 
 class _HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self) -> None:
-        body = b"OK"
-        self.send_response(200)
+    inbox: Optional[SmsWebhookInbox] = None
+    api: Optional[TemplineAPI] = None
+
+    def _reply(self, code: int, body: bytes) -> None:
+        self.send_response(code)
         self.send_header("Content-Type", "text/plain; charset=utf-8")
         self.send_header("Content-Length", str(len(body)))
         self.end_headers()
         self.wfile.write(body)
 
+    def do_GET(self) -> None:
+        api = type(self).api
+        if api is not None and urlparse(self.path).path.rstrip("/") == "/metrics":
+            self._reply(200, api.metrics().encode("utf-8"))
+            return
+        self._reply(200, b"OK")
+
+    def do_POST(self) -> None:
+        parsed = urlparse(self.path)
+        inbox = type(self).inbox
+        if inbox is None or parsed.path.rstrip("/") != SMS_WEBHOOK_PATH.rstrip("/"):
+            self._reply(404, b"Not Found")
+            return
+        token = parse_qs(parsed.query).get("token", [""])[0] or self.headers.get("X-Webhook-Token", "")
+        if not hmac.compare_digest(token.encode("utf-8"), SMS_WEBHOOK_SECRET.encode("utf-8")):
+            self._reply(403, b"Forbidden")
+            return
+        try:
+            length = min(int(self.headers.get("Content-Length") or 0), 65536)
+        except ValueError:
+            length = 0
+        raw = self.rfile.read(length).decode("utf-8", "replace") if length > 0 else ""
+        payload = json_maybe(raw) if raw else {}
+        if isinstance(payload, str):
+            payload = dict(parse_qsl(payload))
+        ok = inbox.submit(payload)
+        self._reply(200 if ok else 503, b"OK" if ok else b"Retry")
+
     def do_HEAD(self) -> None:
         self.send_response(200)
         self.send_header("Content-Type", "text/plain; charset=utf-8")
@@ -3729,10 +5718,11 @@ class _HealthHandler(BaseHTTPRequestHandler):
 
 def start_health_server_if_needed(use_webhook: bool) -> Optional[ThreadingHTTPServer]:
     if use_webhook:
+        port_raw = os.getenv("SMS_WEBHOOK_PORT", "").strip() if SMS_WEBHOOK_SECRET else ""
+    elif SMS_WEBHOOK_SECRET or env_truthy("ENABLE_HEALTH_SERVER", default=bool(os.getenv("RENDER"))):
+        port_raw = os.getenv("PORT", "").strip()
+    else:
         return None
-    if not env_truthy("ENABLE_HEALTH_SERVER", default=bool(os.getenv("RENDER"))):
-        return None
-    port_raw = os.getenv("PORT", "").strip()
     if not port_raw:
         return None
     try:
@@ -3745,12 +5735,30 @@ def start_health_server_if_needed(use_webhook: bool) -> Optional[ThreadingHTTPSe
         t = threading.Thread(target=server.serve_forever, daemon=True, name="health-server")
         t.start()
         logger.info("Health server listening on 0.0.0.0:%s", port)
+        if SMS_WEBHOOK_SECRET:
+            logger.info("SMS webhook receiver enabled at %s (port %s)", SMS_WEBHOOK_PATH, port)
         return server
     except OSError as e:
         logger.warning("Health server bind failed on port %s: %s", port, e)
         return None
 
 
+def self_check_main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Run the repository conformance tests against storage backends.")
+    parser.add_argument("--self-check", action="store_true", required=True)
+    parser.add_argument("--backend", action="append", choices=STORAGE_BACKENDS, help="repeat to compare; defaults to STORAGE_BACKEND")
+    parser.add_argument("--bench", type=int, default=0, metavar="N", help="also time N calls per operation")
+    args, extra = parser.parse_known_args(argv)
+    try:
+        import pytest
+    except ImportError:
+        raise SystemExit("--self-check needs pytest (pip install -r requirements-dev.txt)")
+    os.environ["REPO_TEST_BACKENDS"] = ",".join(args.backend or [STORAGE_BACKEND])
+    os.environ["REPO_BENCH_ROUNDS"] = str(max(0, args.bench))
+    tests = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "test_repository.py")
+    return int(pytest.main(["-q", "-W", "ignore::pytest.PytestAssertRewriteWarning", *(["-s"] if args.bench > 0 else []), tests, *extra]))
+
+
 def main() -> None:
     logging.basicConfig(format="%(asctime)s | %(levelname)s | %(name)s | %(message)s", level=logging.INFO)
     logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -3761,9 +5769,11 @@ def main() -> None:
         raise SystemExit("BOT_TOKEN missing (.env or environment variable required)")
     if not API_KEY:
         raise SystemExit("TEMPLINE_API_KEY/SMSBOWER_API_KEY missing (.env or environment variable required)")
-    if not SUPABASE_URL:
+    if STORAGE_BACKEND not in STORAGE_BACKENDS:
+        raise SystemExit(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}; use one of: {', '.join(STORAGE_BACKENDS)}")
+    if STORAGE_BACKEND == "postgrest" and not SUPABASE_URL:
         raise SystemExit("SUPABASE_URL missing (.env or environment variable required)")
-    if not SUPABASE_KEY:
+    if STORAGE_BACKEND == "postgrest" and not SUPABASE_KEY:
         raise SystemExit("SUPABASE_SERVICE_ROLE_KEY বা SUPABASE_KEY বা SUPABASE_SECRET_KEY missing")
     if "YOUR_REAL_SMSBOWER_API_KEY" in API_KEY:
         raise SystemExit("SMSBOWER API key is placeholder. Set real API key.")
@@ -3785,14 +5795,17 @@ def main() -> None:
         pass
 
     logger.info(
-        "Startup config: ADMIN_USER_ID=%s | BASE_URL=%s | SUPABASE_URL=%s | MODE=supabase-py",
+        "Startup config: ADMIN_USER_ID=%s | BASE_URL=%s | SUPABASE_URL=%s | MODE=%s",
         ADMIN_USER_ID,
         BASE_URL,
         SUPABASE_URL,
+        STORAGE_BACKEND,
     )
     use_webhook = should_use_webhook()
     health_server = start_health_server_if_needed(use_webhook)
     app = build_app()
+    _HealthHandler.inbox = app.bot_data.get("sms_inbox")
+    _HealthHandler.api = app.bot_data.get("api")
     logger.info("Templine bot boot complete. Role-based mode enabled. Admin user_id=%s", ADMIN_USER_ID)
     webhook_url = os.getenv("WEBHOOK_URL", "").strip()
     try:
@@ -3828,4 +5841,6 @@ def main() -> None:
 
 
 if __name__ == "__main__":
+    if "--self-check" in sys.argv[1:]:
+        raise SystemExit(self_check_main(sys.argv[1:]))
     main()
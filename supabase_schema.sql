@@ -58,7 +58,14 @@ create table if not exists public.settings (
   updated bigint not null default extract(epoch from now())::bigint
 );
 
+create table if not exists public.user_role_counts (
+  role text primary key,
+  n bigint not null default 0
+);
+
 create index if not exists idx_users_role on public.users(role);
+create index if not exists idx_users_created on public.users(created, user_id);
+create index if not exists idx_users_role_created on public.users(role, created, user_id);
 create index if not exists idx_activations_user_status on public.activations(user_id, status);
 create index if not exists idx_deposits_status on public.deposits(status);
 
@@ -66,3 +73,106 @@ alter table public.users disable row level security;
 alter table public.activations disable row level security;
 alter table public.deposits disable row level security;
 alter table public.settings disable row level security;
+alter table public.user_role_counts disable row level security;
+
+create or replace function public.bot_adjust_balance(p_user_id bigint, p_delta numeric, p_require_non_negative boolean default false)
+returns numeric
+language sql
+as $$
+  update public.users
+     set balance = balance + p_delta,
+         updated = extract(epoch from now())::bigint
+   where user_id = p_user_id
+     and (not p_require_non_negative or balance + p_delta >= 0)
+  returning balance;
+$$;
+
+create or replace function public.bot_refund_activation(p_activation_id text)
+returns table(user_id bigint, amount numeric)
+language sql
+as $$
+  with claimed as (
+    update public.activations
+       set refunded = true,
+           refund_amount = charged_price,
+           updated_at = extract(epoch from now())::bigint
+     where activation_id = p_activation_id
+       and not refunded
+       and charged_price > 0
+    returning activations.user_id, activations.charged_price
+  ), credited as (
+    update public.users u
+       set balance = u.balance + c.charged_price,
+           updated = extract(epoch from now())::bigint
+      from claimed c
+     where u.user_id = c.user_id
+    returning u.user_id
+  )
+  select c.user_id, c.charged_price from claimed c;
+$$;
+
+create or replace function public.bot_review_deposit(p_deposit_id bigint, p_status text, p_reviewed_by bigint, p_note text default null)
+returns boolean
+language sql
+as $$
+  with reviewed as (
+    update public.deposits
+       set status = p_status,
+           reviewed_by = p_reviewed_by,
+           reviewed_at = extract(epoch from now())::bigint,
+           note = p_note,
+           updated_at = extract(epoch from now())::bigint
+     where id = p_deposit_id
+       and status in ('pending', 'awaiting_proof')
+    returning deposits.user_id, deposits.amount
+  ), credited as (
+    update public.users u
+       set balance = u.balance + r.amount,
+           updated = extract(epoch from now())::bigint
+      from reviewed r
+     where p_status = 'approved'
+       and u.user_id = r.user_id
+    returning u.user_id
+  )
+  select exists(select 1 from reviewed);
+$$;
+
+create or replace function public.bot_track_user_role()
+returns trigger
+language plpgsql
+as $$
+begin
+  if tg_op = 'UPDATE' and new.role is not distinct from old.role then
+    return null;
+  end if;
+  if tg_op in ('UPDATE', 'DELETE') then
+    update public.user_role_counts set n = n - 1 where role = old.role;
+  end if;
+  if tg_op in ('INSERT', 'UPDATE') then
+    insert into public.user_role_counts(role, n) values (new.role, 1)
+    on conflict (role) do update set n = public.user_role_counts.n + 1;
+  end if;
+  return null;
+end;
+$$;
+
+drop trigger if exists trg_users_role_counts on public.users;
+create trigger trg_users_role_counts
+after insert or delete or update of role on public.users
+for each row execute function public.bot_track_user_role();
+
+insert into public.user_role_counts(role, n)
+select role, count(*) from public.users group by role
+on conflict (role) do update set n = excluded.n;
+
+update public.user_role_counts c
+   set n = 0
+ where not exists (select 1 from public.users u where u.role = c.role);
+
+create or replace function public.bot_user_stats()
+returns table(role text, n bigint)
+language sql
+stable
+as $$
+  select c.role, c.n from public.user_role_counts c where c.n > 0;
+$$;
@@ -0,0 +1,57 @@
+import asyncio
+import os
+import random
+import sys
+
+import httpx
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("SUPABASE_URL", "http://postgrest.invalid")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "test-key")
+
+import smsbower_premium_bot as bot  # noqa: E402
+from fake_postgrest import FakePostgREST  # noqa: E402
+
+# sqlite, sqlite-cached and postgrest-mock run anywhere; postgres/postgrest hit the configured live database.
+BACKENDS = [b.strip() for b in os.getenv("REPO_TEST_BACKENDS", "sqlite,sqlite-cached,postgrest-mock").split(",") if b.strip()]
+
+
+async def open_backend(name: str, tmp_path) -> bot.Repository:
+    if name == "postgrest-mock":
+        repo = bot.SupabaseRESTDB()
+        await repo.http.aclose()
+        repo.fake = FakePostgREST()
+        repo.http = httpx.AsyncClient(base_url="http://postgrest.invalid/rest/v1", transport=repo.fake.transport())
+        return repo
+    if name == "sqlite-cached":
+        return bot.UserRowCache(bot.open_repository("sqlite", sqlite_path=str(tmp_path / "repo.sqlite3")))
+    return bot.open_repository(name, sqlite_path=str(tmp_path / "repo.sqlite3"))
+
+
+@pytest.fixture(params=BACKENDS)
+def run_repo(request, tmp_path):
+    def run(scenario):
+        async def go():
+            repo = await open_backend(request.param, tmp_path)
+            await repo.init()
+            try:
+                return await scenario(repo)
+            finally:
+                if request.param in bot.STORAGE_BACKENDS and request.param != "sqlite":
+                    for uid in run.uids:
+                        await repo.set_role(uid, bot.ROLE_BLOCKED)
+                await repo.close()
+
+        return asyncio.run(go())
+
+    def uid():
+        run.uids.append(9_000_000_000_000 + random.randrange(1_000_000_000))
+        return run.uids[-1]
+
+    run.backend = request.param
+    run.uids = []
+    run.uid = uid
+    return run
@@ -0,0 +1,241 @@
+import json
+import re
+import time
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+KEYS = {"users": "user_id", "activations": "activation_id", "deposits": "id", "settings": "key"}
+DEFAULTS: Dict[str, Dict[str, Any]] = {
+    "users": {
+        "chat_id": None,
+        "username": None,
+        "full_name": None,
+        "lang": "en",
+        "role": "pending",
+        "approval_notified": False,
+        "approved_by": None,
+        "approved_at": None,
+        "balance": Decimal("0"),
+        "activation_id": None,
+        "activation_started_at": None,
+        "service_code": None,
+        "country_code": None,
+        "provider_id": None,
+        "phone": None,
+        "polling": 0,
+    },
+    "activations": {
+        "service_code": None,
+        "country_code": None,
+        "provider_id": None,
+        "phone": None,
+        "status": "active",
+        "otp_code": None,
+        "base_price": Decimal("0"),
+        "charged_price": Decimal("0"),
+        "refunded": False,
+        "refund_amount": Decimal("0"),
+    },
+    "deposits": {"txid": None, "screenshot_file_id": None, "status": "awaiting_proof", "reviewed_by": None, "reviewed_at": None, "note": None},
+    "settings": {},
+}
+NUMERIC = {"balance", "base_price", "charged_price", "refund_amount", "amount"}
+STAMPS = {"users": ("created", "updated"), "activations": ("created_at", "updated_at"), "deposits": ("created_at", "updated_at"), "settings": ("updated",)}
+
+
+def _split(s: str) -> List[str]:
+    out, depth, cur, quoted = [], 0, "", False
+    for ch in s:
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == "(":
+            depth += 1
+        elif not quoted and ch == ")":
+            depth -= 1
+        elif not quoted and ch == "," and depth == 0:
+            out.append(cur)
+            cur = ""
+            continue
+        cur += ch
+    out.append(cur)
+    return out
+
+
+def _cmp(a: Any, b: str) -> Tuple[Any, Any]:
+    if isinstance(a, bool):
+        return str(a).lower(), b
+    if isinstance(a, (int, Decimal)):
+        try:
+            return Decimal(a), Decimal(b)
+        except Exception:
+            pass
+    return str(a), b
+
+
+def _test(row: Dict[str, Any], col: str, expr: str) -> bool:
+    op, _, val = expr.partition(".")
+    cur = row.get(col)
+    if op == "in":
+        vals = [v.strip('"').replace('\\"', '"') for v in _split(val[1:-1])]
+        return cur is not None and str(cur) in vals
+    if op == "is":
+        return cur is None if val == "null" else str(cur).lower() == val
+    if cur is None:
+        return False
+    a, b = _cmp(cur, val)
+    return {"eq": a == b, "neq": a != b, "gt": a > b, "gte": a >= b, "lt": a < b, "lte": a <= b}[op]
+
+
+def _logic(row: Dict[str, Any], kind: str, body: str) -> bool:
+    results = []
+    for part in _split(body):
+        m = re.match(r"^(and|or)\((.*)\)$", part)
+        if m:
+            results.append(_logic(row, m.group(1), m.group(2)))
+        else:
+            col, _, expr = part.partition(".")
+            results.append(_test(row, col, expr))
+    return all(results) if kind == "and" else any(results)
+
+
+class FakePostgREST:
+    """In-memory stand-in for the PostgREST endpoints and RPCs SupabaseRESTDB uses."""
+
+    def __init__(self):
+        self.tables: Dict[str, Dict[Any, Dict[str, Any]]] = {t: {} for t in KEYS}
+        self.seq = 0
+        self.requests: List[Tuple[str, str]] = []
+        self.rpcs: Dict[str, Callable[[Dict[str, Any]], Any]] = {
+            "bot_adjust_balance": self._adjust_balance,
+            "bot_refund_activation": self._refund_activation,
+            "bot_review_deposit": self._review_deposit,
+            "bot_user_stats": self._user_stats,
+        }
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def _match(self, table: str, params: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        rows = list(self.tables[table].values())
+        for k, v in params:
+            if k in {"select", "order", "limit", "on_conflict"}:
+                continue
+            if k in {"or", "and"}:
+                rows = [r for r in rows if _logic(r, k, v[1:-1])]
+            else:
+                rows = [r for r in rows if _test(r, k, v)]
+        return rows
+
+    @staticmethod
+    def _shape(rows: List[Dict[str, Any]], params: Dict[str, str]) -> List[Dict[str, Any]]:
+        for term in reversed([t for t in params.get("order", "").split(",") if t]):
+            col, _, way = term.partition(".")
+            rows = sorted(rows, key=lambda r: (r.get(col) is None, r.get(col)), reverse=way.startswith("desc"))
+        if "limit" in params:
+            rows = rows[: int(params["limit"])]
+        cols = params.get("select", "*")
+        if cols != "*":
+            keep = [c.strip() for c in cols.split(",")]
+            rows = [{c: r.get(c) for c in keep} for r in rows]
+        return rows
+
+    def _insert(self, table: str, body: Dict[str, Any], resolution: str) -> Optional[Dict[str, Any]]:
+        key = KEYS[table]
+        if table == "deposits" and "id" not in body:
+            self.seq += 1
+            body = {"id": self.seq, **body}
+        pk = str(body[key])
+        row = self.tables[table].get(pk)
+        if row is not None:
+            if resolution == "ignore-duplicates":
+                return None
+            if resolution != "merge-duplicates":
+                raise KeyError(f"duplicate key {pk}")
+            row.update(self._coerce(body))
+            return row
+        ts = int(time.time())
+        row = {**DEFAULTS[table], **{c: ts for c in STAMPS[table]}, **self._coerce(body)}
+        self.tables[table][pk] = row
+        return row
+
+    @staticmethod
+    def _coerce(body: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: Decimal(str(v)) if k in NUMERIC and v is not None else v for k, v in body.items()}
+
+    @staticmethod
+    def _json(data: Any, status: int = 200, headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+        def enc(o: Any) -> Any:
+            if isinstance(o, Decimal):
+                return float(o)
+            raise TypeError(type(o))
+
+        return httpx.Response(status, content=json.dumps(data, default=enc).encode(), headers={"content-type": "application/json", **(headers or {})})
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.split("/rest/v1/", 1)[1]
+        self.requests.append((request.method, path))
+        body = json.loads(request.content) if request.content else None
+        if path.startswith("rpc/"):
+            fn = self.rpcs.get(path[4:])
+            if fn is None:
+                return self._json({"code": "PGRST202", "message": f"function {path[4:]} not found"}, 404)
+            return self._json(fn(body or {}))
+        if path not in self.tables:
+            return self._json({"code": "42P01", "message": f"relation {path} does not exist"}, 404)
+        items = list(request.url.params.multi_items())
+        params = dict(items)
+        prefer = request.headers.get("prefer", "")
+        if request.method in {"GET", "HEAD"}:
+            rows = self._match(path, items)
+            if request.method == "HEAD":
+                return httpx.Response(200, headers={"content-range": f"0-{max(0, len(rows) - 1)}/{len(rows)}"})
+            return self._json(self._shape(rows, params))
+        if request.method == "PATCH":
+            rows = self._match(path, items)
+            for r in rows:
+                r.update(self._coerce(body))
+            return self._json(rows if "return=representation" in prefer else [])
+        if request.method == "POST":
+            resolution = (re.search(r"resolution=([\w-]+)", prefer) or [None, ""])[1]
+            try:
+                rows = [r for r in (self._insert(path, b, resolution) for b in (body if isinstance(body, list) else [body])) if r]
+            except KeyError as e:
+                return self._json({"code": "23505", "message": str(e)}, 409)
+            return self._json(rows if "return=representation" in prefer else [], 201)
+        return httpx.Response(405)
+
+    def _adjust_balance(self, a: Dict[str, Any]) -> Any:
+        row = self.tables["users"].get(str(a["p_user_id"]))
+        delta = Decimal(str(a["p_delta"]))
+        if row is None or (a.get("p_require_non_negative") and row["balance"] + delta < 0):
+            return None
+        row["balance"] += delta
+        return row["balance"]
+
+    def _refund_activation(self, a: Dict[str, Any]) -> Any:
+        act = self.tables["activations"].get(str(a["p_activation_id"]))
+        if act is None or act["refunded"] or act["charged_price"] <= 0:
+            return []
+        act.update(refunded=True, refund_amount=act["charged_price"])
+        user = self.tables["users"].get(str(act["user_id"]))
+        if user is not None:
+            user["balance"] += act["charged_price"]
+        return [{"user_id": act["user_id"], "amount": act["charged_price"]}]
+
+    def _review_deposit(self, a: Dict[str, Any]) -> Any:
+        dep = self.tables["deposits"].get(str(a["p_deposit_id"]))
+        if dep is None or dep["status"] not in {"pending", "awaiting_proof"}:
+            return False
+        dep.update(status=a["p_status"], reviewed_by=a["p_reviewed_by"], note=a.get("p_note"), reviewed_at=int(time.time()))
+        user = self.tables["users"].get(str(dep["user_id"]))
+        if a["p_status"] == "approved" and user is not None:
+            user["balance"] += dep["amount"]
+        return True
+
+    def _user_stats(self, a: Dict[str, Any]) -> Any:
+        counts: Dict[str, int] = {}
+        for r in self.tables["users"].values():
+            counts[r["role"]] = counts.get(r["role"], 0) + 1
+        return [{"role": k, "n": v} for k, v in counts.items()]
@@ -0,0 +1,82 @@
+import asyncio
+
+from telegram.error import TimedOut
+
+import smsbower_premium_bot as bot
+
+
+class FakeBot:
+    def __init__(self, failures):
+        self.failures = failures
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise TimedOut("telegram timed out")
+        self.sent.append((chat_id, text))
+
+
+class FakeAPI:
+    def __init__(self):
+        self.calls = []
+
+    async def call(self, action, **params):
+        self.calls.append((action, params))
+        return "STATUS_OK:482913" if action == "getStatus" else "ACCESS_ACTIVATION"
+
+
+class FakeApp:
+    def __init__(self, db, failures):
+        self.bot = FakeBot(failures)
+        self.bot_data = {"db": db, "api": FakeAPI()}
+
+
+def with_app(tmp_path, failures, scenario):
+    async def go():
+        db = bot.open_repository("sqlite", sqlite_path=str(tmp_path / "repo.sqlite3"))
+        app = FakeApp(db, failures)
+        app.bot_data["poller"] = bot.ActivationPoller(app)
+        app.bot_data["timers"] = bot.ActivationTimers(app)
+        await db.upsert(7, 70)
+        await db.add_activation(7, 70, "a1", "tg", "6", None, "+6200000000", charged_price="0.5")
+        try:
+            return await scenario(app, await db.get_activation("a1"))
+        finally:
+            await db.close()
+
+    return asyncio.run(go())
+
+
+def test_poller_redelivers_after_send_failure(tmp_path):
+    async def scenario(app, act):
+        poller, timers = app.bot_data["poller"], app.bot_data["timers"]
+        poller.track("a1")
+        timers.add("a1", act["created_at"])
+        await poller._check(act)
+        assert app.bot.sent == []
+        assert "a1" in poller.members and "a1" not in poller.finished
+        assert "a1" in timers.expires
+        assert (await app.bot_data["db"].get_activation("a1"))["status"] == "active"
+        await poller._check(act)
+        assert [chat for chat, _ in app.bot.sent] == [70]
+        assert "a1" not in poller.members and "a1" not in timers.expires
+        got = await app.bot_data["db"].get_activation("a1")
+        assert got["status"] == "otp_received" and got["otp_code"] == "482913"
+        await poller._check(act)
+        assert len(app.bot.sent) == 1
+
+    with_app(tmp_path, 1, scenario)
+
+
+def test_webhook_redelivers_after_send_failure(tmp_path):
+    async def scenario(app, act):
+        inbox = bot.SmsWebhookInbox(app)
+        await inbox.handle("a1", "111222")
+        assert app.bot.sent == [] and "a1" not in inbox.seen
+        assert "a1" in app.bot_data["poller"].members and "a1" in app.bot_data["timers"].expires
+        await inbox.handle("a1", "111222")
+        assert len(app.bot.sent) == 1 and "a1" in inbox.seen
+        assert (await app.bot_data["db"].get_activation("a1"))["otp_code"] == "111222"
+
+    with_app(tmp_path, 1, scenario)
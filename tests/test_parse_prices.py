@@ -0,0 +1,93 @@
+import os
+import random
+import time
+from decimal import Decimal
+
+import pytest
+
+import smsbower_premium_bot as bot
+
+BENCH_ROUNDS = int(os.getenv("PARSE_BENCH_ROUNDS", "0"))
+
+COUNTRIES = {
+    "0": {"name": "Russia", "iso2": "RU"},
+    "6": {"name": "Indonesia", "iso2": "ID"},
+    "16": {"name": "United Kingdom", "iso2": "GB"},
+}
+
+# Expected rows were produced by the recursive parser this one replaced: (country, provider_id, provider_name, price).
+GOLDEN = {
+    "v1": (
+        {"0": {"tg": {"cost": 0.35, "count": 100}}, "6": {"tg": {"cost": "0.12", "count": 5}}, "16": {"tg": {"cost": 0.5, "count": 0}}},
+        [("6", None, None, "0.12"), ("0", None, None, "0.35"), ("16", None, None, "0.5")],
+    ),
+    "v3": (
+        {
+            "6": {"tg": {"2001": {"price": 0.2, "count": 4, "provider_id": 2001}, "2002": {"price": 0.15, "count": 9, "provider_id": 2002}}},
+            "0": {"tg": {"11": {"price": 0.3, "count": 1, "provider_id": 11}}},
+        },
+        [("6", "2002", None, "0.15"), ("6", "2001", None, "0.2"), ("0", "11", None, "0.3")],
+    ),
+    "list": (
+        {"data": [{"country": "16", "cost": "0.9", "count": 2}, {"country": "0", "price": 0.31, "count": 7}, {"country": "0", "price": 0.31, "count": 7}]},
+        [("0", None, None, "0.31"), ("16", None, None, "0.9")],
+    ),
+    "providers": (
+        {"status": "success", "data": [{"country": "6", "providers": [{"providerName": "op1", "cost": "1.5"}, {"providerName": "op2", "cost": "2"}]}]},
+        [("6", None, "op1", "1.5"), ("6", None, "op2", "2")],
+    ),
+    "nested": (
+        {"0": {"tg": {"a": {"price": 1, "nested": {"b": {"cost": 2}}}, "7": {"cost": "3"}, "l": [{"price": 4}, [{"price": 5}]]}}},
+        [("0", None, "a", "1"), ("0", None, "b", "2"), ("0", "7", None, "3"), ("0", None, "l", "4"), ("0", None, "l", "5")],
+    ),
+    "junk": ({"status": "success", "0": {"tg": "oops"}, "6": None}, []),
+}
+
+
+@pytest.mark.parametrize("name", GOLDEN)
+def test_parse_prices_matches_golden(name):
+    payload, want = GOLDEN[name]
+    got = bot.parse_prices(payload, "tg", "Telegram", COUNTRIES, "en")
+    assert [(o.country_code, o.provider_id, o.provider_name, str(o.price)) for o in got] == want
+    assert all(o.service_code == "tg" and o.service_name == "Telegram" for o in got)
+
+
+def test_parse_prices_fills_country_names():
+    got = bot.parse_prices(GOLDEN["v1"][0], "tg", "Telegram", COUNTRIES, "en")
+    assert [(o.country_name, o.country_iso2) for o in got] == [("Indonesia", "ID"), ("Russia", "RU"), ("United Kingdom", "GB")]
+
+
+def test_price_view_applies_profit_only_to_users():
+    table = bot.PriceTable(bot.parse_prices(GOLDEN["v1"][0], "tg", "Telegram", COUNTRIES, "en"))
+    user = bot.PriceView(table, bot.ROLE_USER, Decimal("20"))
+    assert [(o.price, o.base_price) for o in user] == [("0.144", "0.12"), ("0.42", "0.35"), ("0.6", "0.5")]
+    assert [o.price for o in bot.PriceView(table, bot.ROLE_SUPER, Decimal("20"))] == ["0.12", "0.35", "0.5"]
+    assert user.find("tg", "0", "none").price == "0.42"
+    assert user.find("tg", "1", "none") is None
+    assert bot.apply_role_prices(table.rows, bot.ROLE_USER, Decimal("20")) == list(user)
+
+
+def synthetic_payloads():
+    rnd = random.Random(7)
+    countries = {str(i): {"name": f"Country {i}", "iso2": "US"} for i in range(200)}
+    v1 = {str(c): {"tg": {"cost": round(rnd.uniform(0.05, 3), 3), "count": 10}} for c in range(200)}
+    v3 = {}
+    for c in range(200):
+        pids = rnd.sample(range(10000), 22 if c % 2 else 23)
+        v3[str(c)] = {"tg": {str(p): {"count": rnd.randint(0, 500), "price": round(rnd.uniform(0.05, 3), 2), "provider_id": p} for p in pids}}
+    return countries, {"v1": v1, "v3": v3}
+
+
+@pytest.mark.skipif(BENCH_ROUNDS <= 0, reason="set PARSE_BENCH_ROUNDS to time parse_prices on synthetic payloads")
+def test_benchmark_parse_prices():
+    countries, payloads = synthetic_payloads()
+    assert sum(len(v["tg"]) for v in payloads["v3"].values()) == 4500
+    for name, payload in payloads.items():
+        rows = len(bot.parse_prices(payload, "tg", "Telegram", countries, "en"))
+        samples = []
+        for _ in range(BENCH_ROUNDS):
+            t0 = time.perf_counter()
+            bot.parse_prices(payload, "tg", "Telegram", countries, "en")
+            samples.append((time.perf_counter() - t0) * 1000)
+        samples.sort()
+        print(f"[parse_prices {name}] rows={rows} p50={samples[len(samples) // 2]:8.3f}ms mean={sum(samples) / len(samples):8.3f}ms")
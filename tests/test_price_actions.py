@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+import smsbower_premium_bot as bot
+
+
+def make_api(answers):
+    calls = []
+
+    async def call(action, service=None, **params):
+        calls.append(action)
+        return answers.get(action)
+
+    api = bot.TemplineAPI.__new__(bot.TemplineAPI)
+    api.price_pref = {}
+    api.call = call
+    return api, calls
+
+
+def test_prefers_v3_and_remembers_it():
+    api, calls = make_api({"getPricesV3": {"6": {"tg": {}}}, "getPricesV2": {"6": {"tg": {}}}})
+
+    async def go():
+        await api.get_prices("tg")
+        calls.clear()
+        await api.get_prices("tg")
+
+    asyncio.run(go())
+    assert calls == ["getPricesV3"]
+    assert api.price_pref["tg"][0] == "getPricesV3"
+
+
+def test_failed_preference_is_not_retried_in_same_lookup():
+    api, calls = make_api({"getPrices": {"6": {"tg": {"cost": 1}}}})
+    api.price_pref["tg"] = ("getPricesV3", time.time() + 60)
+    assert asyncio.run(api.get_prices("tg")) == {"6": {"tg": {"cost": 1}}}
+    assert sorted(calls) == ["getPrices", "getPricesV2", "getPricesV3"]
+    assert api.price_pref["tg"][0] == "getPrices"
+
+
+def test_failed_fallback_preference_is_skipped_after_race():
+    api, calls = make_api({})
+    api.price_pref["tg"] = ("getPrices", time.time() + 60)
+    assert asyncio.run(api.get_prices("tg")) is None
+    assert calls[0] == "getPrices" and sorted(calls) == ["getPrices", "getPricesV2", "getPricesV3"]
+    assert "tg" not in api.price_pref
@@ -0,0 +1,314 @@
+import asyncio
+import os
+import time
+from decimal import Decimal
+
+import pytest
+
+import smsbower_premium_bot as bot
+from smsbower_premium_bot import ROLE_BLOCKED, ROLE_PENDING, ROLE_USER, dec, role_of
+
+BENCH_ROUNDS = int(os.getenv("REPO_BENCH_ROUNDS", "0"))
+
+
+def test_async_repository_exposes_contract(tmp_path):
+    async def go():
+        repo = bot.open_repository("sqlite", sqlite_path=str(tmp_path / "repo.sqlite3"))
+        try:
+            missing = [n for n in bot.REPOSITORY_METHODS if not callable(getattr(repo, n, None))]
+            assert missing == []
+            with pytest.raises(AttributeError):
+                repo.write
+            assert (await repo.upsert(1, 1))["user_id"] == 1
+            assert await repo.get(1) == await asyncio.get_running_loop().run_in_executor(None, repo.backend.get, 1)
+        finally:
+            await repo.close()
+
+    asyncio.run(go())
+
+
+def test_rest_backend_exposes_contract():
+    missing = [n for n in bot.REPOSITORY_METHODS if not asyncio.iscoroutinefunction(getattr(bot.SupabaseRESTDB, n, None))]
+    assert missing == []
+
+
+def test_users_and_roles(run_repo):
+    uid = run_repo.uid()
+
+    async def scenario(repo):
+        row = await repo.upsert(uid, uid, lang="en", username="alice", full_name="Alice")
+        assert role_of(row) == ROLE_PENDING
+        assert (await repo.upsert(uid, uid))["username"] == "alice"
+        await repo.set_lang(uid, uid, "ru")
+        assert (await repo.get(uid))["lang"] == "ru"
+        await repo.set_role(uid, ROLE_USER, approved_by=uid)
+        row = await repo.get(uid)
+        assert role_of(row) == ROLE_USER
+        assert bool(row["approval_notified"]) and int(row["approved_by"]) == uid and row["approved_at"]
+        await repo.clear_chat(uid)
+        assert (await repo.get(uid))["chat_id"] is None
+        assert await repo.get(run_repo.uid()) is None
+
+    run_repo(scenario)
+
+
+def test_admin_user(run_repo):
+    uid = run_repo.uid()
+
+    async def scenario(repo):
+        await repo.ensure_admin_user(uid)
+        row = await repo.get(uid)
+        assert role_of(row) == bot.ROLE_ADMIN and bool(row["approval_notified"])
+        await repo.set_role(uid, ROLE_USER)
+        await repo.ensure_admin_user(uid)
+        assert role_of(await repo.get(uid)) == bot.ROLE_ADMIN
+
+    run_repo(scenario)
+
+
+def test_balance(run_repo):
+    uid = run_repo.uid()
+
+    async def scenario(repo):
+        await repo.upsert(uid, uid)
+        assert await repo.adjust_balance(uid, Decimal("1.5")) == Decimal("1.5")
+        assert await repo.adjust_balance(uid, Decimal("-5"), require_non_negative=True) is None
+        assert await repo.adjust_balance(uid, Decimal("-0.25"), require_non_negative=True) == Decimal("1.25")
+        assert await repo.get_balance(uid) == Decimal("1.25")
+        await asyncio.gather(*(repo.adjust_balance(uid, Decimal("0.01")) for _ in range(50)))
+        assert await repo.get_balance(uid) == Decimal("1.75")
+        assert await repo.adjust_balance(run_repo.uid(), Decimal("1")) is None
+
+    run_repo(scenario)
+
+
+def test_activation_and_refund(run_repo):
+    uid = run_repo.uid()
+    aid = f"t-{uid}-1"
+
+    async def scenario(repo):
+        await repo.upsert(uid, uid)
+        await repo.add_activation(uid, uid, aid, "tg", "6", "2001", "+6200000000", base_price="0.5", charged_price="0.75")
+        await repo.set_activation(uid, uid, aid, "tg", "6", "2001", "+6200000000")
+        act = await repo.get_activation(aid)
+        assert act["status"] == "active" and dec(act["charged_price"]) == Decimal("0.75")
+        assert any(int(r["user_id"]) == uid for r in await repo.active_rows())
+        assert (await repo.latest_active_activation_for_user(uid))["activation_id"] == aid
+        assert aid in {str(r["activation_id"]) for r in await repo.list_active_activations()}
+        await repo.set_activation_status(aid, "otp_received", "123456")
+        act = await repo.get_activation(aid)
+        assert act["status"] == "otp_received" and act["otp_code"] == "123456"
+        assert not (await repo.get(uid))["polling"]
+        refund = await repo.refund_activation_if_needed(aid)
+        assert refund == {"user_id": uid, "amount": "0.75"}
+        assert await repo.refund_activation_if_needed(aid) is None
+        assert await repo.get_balance(uid) == Decimal("0.75")
+        await repo.clear_activation(uid)
+        row = await repo.get(uid)
+        assert not row["activation_id"] and not row["polling"]
+        assert await repo.latest_active_activation_for_user(uid) is None
+
+    run_repo(scenario)
+
+
+def test_free_activation_is_not_refunded(run_repo):
+    uid = run_repo.uid()
+
+    async def scenario(repo):
+        await repo.upsert(uid, uid)
+        await repo.add_activation(uid, uid, f"t-{uid}-free", "tg", "6", None, "+6200000001")
+        assert await repo.refund_activation_if_needed(f"t-{uid}-free") is None
+        assert await repo.get_balance(uid) == Decimal("0")
+
+    run_repo(scenario)
+
+
+def test_expire_activations(run_repo):
+    uid = run_repo.uid()
+    ids = [f"t-{uid}-{i}" for i in range(3)]
+
+    async def scenario(repo):
+        await repo.upsert(uid, uid)
+        for aid in ids:
+            await repo.add_activation(uid, uid, aid, "tg", "6", None, "+6200000000")
+        await repo.set_activation(uid, uid, ids[0], "tg", "6", None, "+6200000000")
+        await repo.set_activation_status(ids[2], "cancelled")
+        assert len(await repo.get_activations(ids + [f"t-{uid}-missing"])) == 3
+        expired = await repo.expire_activations(ids)
+        assert sorted(str(r["activation_id"]) for r in expired) == ids[:2]
+        assert {r["status"] for r in expired} == {"expired"}
+        assert await repo.expire_activations(ids) == []
+        assert (await repo.get_activation(ids[2]))["status"] == "cancelled"
+        assert not (await repo.get(uid))["polling"]
+        assert not set(ids) & {str(r["activation_id"]) for r in await repo.list_active_activations()}
+
+    run_repo(scenario)
+
+
+def test_deposits(run_repo):
+    uid = run_repo.uid()
+
+    async def scenario(repo):
+        await repo.upsert(uid, uid)
+        dep_id = await repo.create_deposit(uid, Decimal("3"))
+        assert int((await repo.latest_open_deposit_for_user(uid))["id"]) == dep_id
+        await repo.set_deposit_proof(dep_id, "tx-1", "file-1")
+        dep = await repo.get_deposit(dep_id)
+        assert dep["status"] == "pending" and dep["txid"] == "tx-1" and dep["screenshot_file_id"] == "file-1"
+        assert await repo.latest_open_deposit_for_user(uid) is None
+        assert await repo.update_deposit_status(dep_id, "approved", uid, note="ok") is True
+        assert await repo.update_deposit_status(dep_id, "approved", uid) is False
+        dep = await repo.get_deposit(dep_id)
+        assert dep["status"] == "approved" and int(dep["reviewed_by"]) == uid and dep["note"] == "ok"
+        assert await repo.get_balance(uid) == Decimal("3")
+        rejected = await repo.create_deposit(uid, Decimal("2"))
+        assert await repo.update_deposit_status(rejected, "rejected", uid) is True
+        assert await repo.get_balance(uid) == Decimal("3")
+        assert await repo.get_deposit(10**12) is None
+
+    run_repo(scenario)
+
+
+def test_settings(run_repo):
+    key = f"test_{run_repo.uid()}"
+
+    async def scenario(repo):
+        assert await repo.get_setting(key, "d") == "d"
+        await repo.set_setting(key, "1")
+        await repo.set_setting(key, "2")
+        assert await repo.get_setting(key) == "2"
+        saved = [(k, await repo.get_setting(k)) for k in ("profit_percent", "payment_methods")]
+        try:
+            await repo.set_profit_percent(Decimal("900"))
+            assert await repo.get_profit_percent() == Decimal("500")
+            await repo.set_profit_percent(Decimal("12.5"))
+            assert await repo.get_profit_percent() == Decimal("12.5")
+            cur = await repo.update_payment_settings({" USDT ": " addr ", "": "x"})
+            assert cur["usdt"] == "addr" and "" not in cur
+            assert (await repo.get_payment_settings())["usdt"] == "addr"
+        finally:
+            for k, v in saved:
+                await repo.set_setting(k, v)
+
+    run_repo(scenario)
+
+
+def test_keyset_pages_cover_ties_once(run_repo):
+    uids = [run_repo.uid() for _ in range(7)]
+
+    async def scenario(repo):
+        for u in uids:
+            await repo.upsert(u, u, role=ROLE_USER)
+        await repo.set_role(uids[3], ROLE_BLOCKED)
+        created = {u: int((await repo.get(u))["created"]) for u in uids if u != uids[3]}
+        expected = sorted(created, key=lambda u: (created[u], u))
+        seen = []
+        async for page in bot.iter_user_pages(repo, page_size=2, role=ROLE_USER):
+            assert len(page) <= 2
+            seen.extend(int(r["user_id"]) for r in page)
+        assert len(seen) == len(set(seen))
+        ours = [u for u in seen if u in uids]
+        assert ours == expected
+        rest = []
+        async for page in bot.iter_user_pages(repo, page_size=3, exclude_role=ROLE_BLOCKED, columns="user_id,created"):
+            assert set(page[0]) == {"user_id", "created"}
+            rest.extend(int(r["user_id"]) for r in page)
+        assert uids[3] not in rest and set(ours) <= set(rest)
+        keys = [(int(r["created"]), int(r["user_id"])) for r in await repo.list_users_page(limit=1000)]
+        assert keys == sorted(keys)
+
+    run_repo(scenario)
+
+
+def test_user_stats(run_repo):
+    uids = [run_repo.uid() for _ in range(3)]
+
+    async def scenario(repo):
+        before = await repo.user_stats()
+        for u in uids:
+            await repo.upsert(u, u)
+        await repo.set_role(uids[0], ROLE_USER)
+        await repo.set_role(uids[1], ROLE_BLOCKED)
+        after = await repo.user_stats()
+        assert after["total"] - before["total"] == 3
+        assert after[ROLE_PENDING] - before[ROLE_PENDING] == 1
+        assert after[ROLE_USER] - before[ROLE_USER] == 1
+        assert after[ROLE_BLOCKED] - before[ROLE_BLOCKED] == 1
+        assert sum(v for k, v in after.items() if k != "total") == after["total"]
+
+    run_repo(scenario)
+
+
+def test_role_filtered_pages(run_repo):
+    uids = [run_repo.uid() for _ in range(2)]
+
+    async def scenario(repo):
+        for u in uids:
+            await repo.upsert(u, u)
+        await repo.set_role(uids[1], ROLE_BLOCKED)
+
+        async def drain(**filters):
+            return {int(r["user_id"]) async for page in bot.iter_user_pages(repo, page_size=50, **filters) for r in page}
+
+        assert uids[0] in await drain(role=ROLE_PENDING) and uids[1] not in await drain(role=ROLE_PENDING)
+        assert set(uids) <= await drain()
+        active = await drain(exclude_role=ROLE_BLOCKED)
+        assert uids[1] not in active and uids[0] in active
+        await repo.mark_approval_notified(uids[0])
+        assert bool((await repo.get(uids[0]))["approval_notified"])
+
+    run_repo(scenario)
+
+
+@pytest.mark.skipif(BENCH_ROUNDS <= 0, reason="set REPO_BENCH_ROUNDS (or use --self-check --bench N)")
+def test_benchmark(run_repo):
+    uid = run_repo.uid()
+
+    async def scenario(repo):
+        await repo.upsert(uid, uid)
+        ops = {
+            "get": lambda: repo.get(uid),
+            "upsert": lambda: repo.upsert(uid, uid),
+            "adjust_balance": lambda: repo.adjust_balance(uid, Decimal("0")),
+            "get_setting": lambda: repo.get_setting("profit_percent"),
+            "list_users_page": lambda: repo.list_users_page(limit=50),
+            "user_stats": lambda: repo.user_stats(),
+        }
+        for name, op in ops.items():
+            samples = []
+            for _ in range(BENCH_ROUNDS):
+                t0 = time.perf_counter()
+                await op()
+                samples.append((time.perf_counter() - t0) * 1000)
+            samples.sort()
+            p50, p95 = samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+            print(f"[{run_repo.backend}] {name:<26} p50={p50:8.3f}ms p95={p95:8.3f}ms mean={sum(samples) / len(samples):8.3f}ms")
+        t0 = time.perf_counter()
+        await asyncio.gather(*(repo.adjust_balance(uid, Decimal("0.01")) for _ in range(BENCH_ROUNDS)))
+        ms = (time.perf_counter() - t0) * 1000 / BENCH_ROUNDS
+        print(f"[{run_repo.backend}] {'adjust_balance_concurrent':<26} {ms:8.3f}ms/call")
+        assert await repo.get_balance(uid) == Decimal("0.01") * BENCH_ROUNDS
+
+    run_repo(scenario)
+
+
+def test_rest_user_stats_falls_back_to_counts(tmp_path):
+    from conftest import open_backend
+
+    async def go():
+        repo = await open_backend("postgrest-mock", tmp_path)
+        try:
+            del repo.fake.rpcs["bot_user_stats"]
+            for u in (1, 2, 3):
+                await repo.upsert(u, u)
+            await repo.set_role(3, ROLE_USER)
+            stats = await repo.user_stats()
+            assert stats["total"] == 3 and stats[ROLE_PENDING] == 2 and stats[ROLE_USER] == 1
+            assert repo.stats_rpc_after > time.monotonic()
+            calls = len(repo.fake.requests)
+            assert await repo.user_stats() == stats
+            assert ("POST", "rpc/bot_user_stats") not in repo.fake.requests[calls:]
+        finally:
+            await repo.close()
+
+    asyncio.run(go())
@@ -0,0 +1,42 @@
+import smsbower_premium_bot as bot
+
+SERVICES = [
+    {"code": "tg", "name": "Telegram"},
+    {"code": "wa", "name": "WhatsApp"},
+    {"code": "fb", "name": "Facebook"},
+    {"code": "go", "name": "Google, YouTube, Gmail"},
+    {"code": "ig", "name": "Instagram + Threads"},
+    {"code": "TG ", "name": "Telegram duplicate"},
+    {"code": "ot", "name": "Any other"},
+]
+
+
+def codes(hits):
+    return [s["code"] for s in hits]
+
+
+def test_dedupes_by_normalized_code():
+    idx = bot.ServiceIndex(SERVICES)
+    assert len(idx.items) == 6
+    assert idx.items[idx.codes["tg"]]["name"] == "Telegram"
+    assert "Telegram duplicate" not in {s["name"] for s in idx.search("telegram")}
+
+
+def test_code_prefix_substring_and_alias():
+    idx = bot.ServiceIndex(SERVICES)
+    assert codes(idx.search("TG"))[0] == "tg"
+    assert codes(idx.search("tele"))[0] == "tg"
+    assert codes(idx.search("youtube")) == ["go"]
+    assert codes(idx.search("threads")) == ["ig"]
+    assert codes(idx.search("insta"))[0] == "ig"
+    assert codes(idx.search("телеграм"))[0] == "tg"
+    assert idx.search("   ") == []
+
+
+def test_fuzzy_and_memo():
+    idx = bot.ServiceIndex(SERVICES)
+    assert codes(idx.search("whatsap"))[0] == "wa"
+    first = idx.search("facebok")
+    assert codes(first)[0] == "fb"
+    assert idx.search("FACEBOK") is first
+    assert bot.match_services("tg", SERVICES) == idx.search("tg")
@@ -0,0 +1,109 @@
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import pytest
+
+import smsbower_premium_bot as bot
+
+
+@pytest.fixture
+def db(tmp_path):
+    d = bot.DB(str(tmp_path / "db.sqlite3"))
+    yield d
+    d.close()
+
+
+def test_wal_and_readonly_readers(db):
+    assert db.wconn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    with pytest.raises(sqlite3.OperationalError):
+        db.conn().execute("INSERT INTO settings(key, value) VALUES('x', 'y')")
+
+
+def test_failed_write_rolls_back_only_its_savepoint(db, monkeypatch):
+    monkeypatch.setattr(bot, "SQLITE_BATCH_WAIT_MS", 50.0)
+    db.upsert(1, 1)
+    gate = threading.Barrier(8)
+
+    def credit(i):
+        gate.wait()
+        if i == 3:
+
+            def boom(c):
+                c.execute("UPDATE users SET balance='999' WHERE user_id=1")
+                raise ValueError("boom")
+
+            return db.write(boom)
+        return db.adjust_balance(1, Decimal("1"))
+
+    commits = []
+    db.wconn.set_trace_callback(lambda sql: commits.append(sql) if sql == "COMMIT" else None)
+    with ThreadPoolExecutor(8) as ex:
+        futs = [ex.submit(credit, i) for i in range(8)]
+    db.wconn.set_trace_callback(None)
+    with pytest.raises(ValueError):
+        futs[3].result()
+    assert sorted(f.result() for i, f in enumerate(futs) if i != 3) == [Decimal(n) for n in range(1, 8)]
+    assert db.get_balance(1) == Decimal("7")
+    assert len(commits) < 7
+
+
+def test_concurrent_credits_sum_exactly(db):
+    db.upsert(1, 1)
+    with ThreadPoolExecutor(16) as ex:
+        list(ex.map(lambda _: db.adjust_balance(1, Decimal("0.01")), range(400)))
+    assert db.get_balance(1) == Decimal("4")
+    assert db.adjust_balance(1, Decimal("-5"), require_non_negative=True) is None
+    assert db.get_balance(1) == Decimal("4")
+
+
+def test_write_is_reentrant_on_writer_thread(db):
+    def outer(c):
+        c.execute("INSERT INTO settings(key, value) VALUES('a', '1')")
+        return db.write(lambda c2: c2.execute("SELECT value FROM settings WHERE key='a'").fetchone()[0])
+
+    assert db.write(outer) == "1"
+    assert db.get_setting("a") == "1"
+
+
+def test_close_stops_writer(tmp_path):
+    d = bot.DB(str(tmp_path / "db.sqlite3"))
+    d.set_setting("k", "v")
+    d.close()
+    assert not d.writer.is_alive()
+    d = bot.DB(str(tmp_path / "db.sqlite3"))
+    assert d.get_setting("k") == "v"
+    d.close()
+
+
+def test_migrates_legacy_schema(tmp_path):
+    path = str(tmp_path / "legacy.sqlite3")
+    c = sqlite3.connect(path)
+    c.execute(
+        """
+        CREATE TABLE users(
+          user_id INTEGER PRIMARY KEY,
+          chat_id INTEGER,
+          lang TEXT NOT NULL DEFAULT 'en',
+          activation_id TEXT,
+          service_code TEXT,
+          country_code TEXT,
+          provider_id TEXT,
+          phone TEXT,
+          polling INTEGER NOT NULL DEFAULT 0,
+          updated INTEGER NOT NULL DEFAULT (strftime('%s','now'))
+        )
+        """
+    )
+    c.execute("INSERT INTO users(user_id, chat_id, lang, updated) VALUES(5, 5, 'ru', 1700000000)")
+    c.commit()
+    c.close()
+    d = bot.DB(path)
+    try:
+        row = d.get(5)
+        assert row["lang"] == "ru" and row["role"] == bot.ROLE_PENDING and row["created"] == 1700000000
+        assert d.adjust_balance(5, Decimal("2.5")) == Decimal("2.5")
+        assert [int(r["user_id"]) for r in d.list_users_page(role=bot.ROLE_PENDING)] == [5]
+    finally:
+        d.close()